@@ -85,6 +85,8 @@ setup(
         es-index-listener = snovault.elasticsearch.es_index_listener:main
 
         add-date-created = encoded.commands.add_date_created:main
+        benchmark-region-parser = encoded.commands.benchmark_region_parser:main
+        build-rsid-index = encoded.commands.build_rsid_index:main
         check-rendering = encoded.commands.check_rendering:main
         deploy = encoded.commands.deploy:main
         extract_test_data = encoded.commands.extract_test_data:main
@@ -242,6 +242,7 @@ def main(global_config, **local_config):
             timeout=60,
             maxsize=50
         )
+        config.include('.regulome_atlas')
         config.include('.regulome_search')
         config.include('.regulome_indexer')
     config.include(static_resources)
@@ -5,7 +5,6 @@ from pyramid.view import view_config
 from pyramid.response import Response
 from snovault import TYPES
 from snovault.util import simple_path_ids
-from snovault.elasticsearch.interfaces import SNP_SEARCH_ES
 from urllib.parse import (
     parse_qs,
     urlencode,
@@ -17,7 +16,7 @@ import io
 import json
 import time  # DEBUG: timing
 import datetime
-from .regulome_atlas import RegulomeAtlas
+from .regulome_atlas import REGULOME_ATLAS
 
 import logging
 log = logging.getLogger(__name__)
@@ -262,7 +261,7 @@ def peak_metadata(context, request):
 def regulome_download(context, request):
     begin = time.time()  # DEBUG: timing
     format_json = request.url.endswith('.json')
-    atlas = RegulomeAtlas(request.registry[SNP_SEARCH_ES])
+    atlas = request.registry[REGULOME_ATLAS]
     try:
         page_parts = request.url.split('/')[-1].split('.')[0].split('_')
         reg_format = page_parts[1]
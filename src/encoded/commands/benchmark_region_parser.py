@@ -0,0 +1,140 @@
+"""\
+Compare the region indexer's bed row parsers on local bed.gz files
+
+Times the csv based tsv() + region()/snp() parsing against the block split
+rows() + region_parser()/snp_bytes() parsing used for indexing, and checks both
+produce the same documents.
+
+Examples
+
+Run on the test fixtures:
+
+    %(prog)s
+
+Run on a dbSNP reference file, parsed as SNPs:
+
+    %(prog)s --snps dbsnp151.hg19.bed.gz
+
+Run on a peak file with the columns of a collection type:
+
+    %(prog)s --collection-type DNase-seq ENCFF002COS.bed.gz
+
+"""
+import gc
+import gzip
+import logging
+import os
+import time
+from pkg_resources import resource_filename
+
+from encoded.regulome_indexer import (
+    REGULOME_VALUE_STRAND_COL,
+    RemoteReader,
+)
+
+EPILOG = __doc__
+
+logger = logging.getLogger(__name__)
+
+# Test fixtures with the collection type their columns are indexed as
+FIXTURES = [
+    ('ENCFF001UYL.bed.gz', 'ChIP-seq'),
+    ('ENCFF002COS.bed.gz', 'DNase-seq'),
+    ('ENCFF122TST.bed.gz', 'eQTLs'),
+    ('ENCFF284TST.bed.gz', 'PWMs'),
+    ('ENCFF542TST.bed.gz', None),
+    ('ENCFF852TST.bed.gz', 'Footprints'),
+    ('ENCFF943TST.bed.gz', 'chromatin state'),
+]
+
+
+def csv_parse(path, collection_type, snps):
+    columns = REGULOME_VALUE_STRAND_COL.get(collection_type, {})
+    docs = []
+    with gzip.open(path, mode='rt') as file_handle:
+        for row in RemoteReader.tsv(file_handle):
+            if row[0].startswith('#'):
+                continue
+            if snps:
+                docs.append(RemoteReader.snp(row))
+            else:
+                docs.append(RemoteReader.region(
+                    row,
+                    value_col=columns.get('value_col'),
+                    strand_col=columns.get('strand_col')
+                ))
+    return docs
+
+
+def bytes_parse(path, collection_type, snps):
+    if snps:
+        parse_row = RemoteReader.snp_bytes
+    else:
+        parse_row = RemoteReader.region_parser(**REGULOME_VALUE_STRAND_COL.get(collection_type, {}))
+    docs = []
+    with gzip.open(path, mode='rb') as file_handle:
+        for row in RemoteReader.rows(file_handle):
+            if row[0].startswith(b'#'):
+                continue
+            docs.append(parse_row(row))
+    return docs
+
+
+def best_of(repeat, parse, *args):
+    best = None
+    for _ in range(repeat):
+        # as timeit does, or collections of the docs held for comparison dominate
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            docs = parse(*args)
+            took = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = took if best is None else min(best, took)
+    return (best, docs)
+
+
+def run(files, repeat):
+    print('%-24s %-16s %9s %9s %9s %8s' % (
+        'file', 'parsed as', 'rows', 'csv (s)', 'bytes (s)', 'speedup'
+    ))
+    for (path, collection_type, snps) in files:
+        (csv_took, csv_docs) = best_of(repeat, csv_parse, path, collection_type, snps)
+        (bytes_took, bytes_docs) = best_of(repeat, bytes_parse, path, collection_type, snps)
+        if csv_docs != bytes_docs:
+            logger.error('%s: parsers disagree', path)
+        print('%-24s %-16s %9d %9.3f %9.3f %7.1fx' % (
+            os.path.basename(path), 'SNPs' if snps else collection_type, len(csv_docs),
+            csv_took, bytes_took, csv_took / bytes_took
+        ))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark region indexer bed parsing", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--collection-type', help="Collection type the files' columns are indexed as"
+    )
+    parser.add_argument('--snps', action='store_true', help="Parse the files as dbSNP references")
+    parser.add_argument('--repeat', default=3, type=int, help="Best of this many runs")
+    parser.add_argument('files', nargs='*', help="bed.gz files, defaults to the test fixtures")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.files:
+        files = [(path, args.collection_type, args.snps) for path in args.files]
+    else:
+        filedir = resource_filename('encoded', 'tests/data/files/')
+        files = [
+            (os.path.join(filedir, filename), collection_type, collection_type is None)
+            for (filename, collection_type) in FIXTURES
+        ]
+    run(files, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""\
+Build a local rsid -> coordinate index from a dbSNP bed.gz
+
+The index is read by regulome search to map rsids in queries to coordinates
+without asking elasticsearch or the Ensembl REST API.  Build it from the same
+dbSNP file the region indexer ingests for the assembly, then point the app at
+it with the regulome.rsid_index.<assembly> setting.
+
+Examples
+
+Build the hg19 index from a local file:
+
+    %(prog)s dbsnp151.hg19.bed.gz /srv/regulome/rsids/hg19
+
+Build the GRCh38 index straight from a download url:
+
+    %(prog)s https://www.encodeproject.org/files/ENCFF000ABC/@@download/ENCFF000ABC.bed.gz \\
+        /srv/regulome/rsids/GRCh38
+
+"""
+import logging
+import time
+
+from encoded.regulome_atlas import RsidIndex
+from encoded.regulome_indexer import RemoteReader
+
+EPILOG = __doc__
+
+logger = logging.getLogger(__name__)
+
+
+def bed_snps(file_handle):
+    '''Yields (chrom, start, end, rsid) from a dbSNP bed, as snp_bytes() reads them'''
+    for row in RemoteReader.rows(file_handle):
+        if row[0].startswith(b'#'):
+            continue
+        start, end = int(row[1]), int(row[2])
+        if start == end:
+            end = end + 1
+        yield (row[0].decode(), start, end, row[3].decode())
+
+
+def build(source, path):
+    readable_file = source
+    if source.startswith(('http://', 'https://')):
+        response = RemoteReader().http.request('GET', source, preload_content=False)
+        if response.status != 200:
+            raise IOError('Failed to read %s: %s' % (source, response.status))
+        readable_file = response
+    with RemoteReader.open_gzip(readable_file) as file_handle:
+        return RsidIndex.build(bed_snps(file_handle), path)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build a local rsid index", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('source', help="dbSNP bed.gz file or url")
+    parser.add_argument('path', help="Directory to write the index to")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    start = time.time()
+    count = build(args.source, args.path)
+    logger.info('Indexed %d rsids into %s in %.1fs', count, args.path, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,27 @@
 from pyramid.paster import get_app
+from multiprocessing import Pool
 import logging
 import json
 import time  # DEBUG: timing
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
 from ..regulome_indexer import (
+    RegionIndexerState,
+    REGULOME_ATLAS,
     SUPPORTED_CHROMOSOMES,
     REGULOME_SUPPORTED_ASSEMBLIES
 )
 from ..regulome_atlas import (
-    RegulomeAtlas
+    RegulomeAtlas,
+    ScoreStore
 )
 
 from snovault.elasticsearch.interfaces import (
+    ELASTIC_SEARCH,
     SNP_SEARCH_ES
 )
 
@@ -19,6 +30,250 @@ EPILOG = __doc__
 
 log = logging.getLogger(__name__)
 
+# Sizes of the supported chromosomes, so scoring stops at their ends
+CHROM_SIZES = {
+    'hg19': {
+        'chr1': 249250621, 'chr2': 243199373, 'chr3': 198022430, 'chr4': 191154276,
+        'chr5': 180915260, 'chr6': 171115067, 'chr7': 159138663, 'chr8': 146364022,
+        'chr9': 141213431, 'chr10': 135534747, 'chr11': 135006516, 'chr12': 133851895,
+        'chr13': 115169878, 'chr14': 107349540, 'chr15': 102531392, 'chr16': 90354753,
+        'chr17': 81195210, 'chr18': 78077248, 'chr19': 59128983, 'chr20': 63025520,
+        'chr21': 48129895, 'chr22': 51304566, 'chrX': 155270560, 'chrY': 59373566,
+    },
+    'GRCh38': {
+        'chr1': 248956422, 'chr2': 242193529, 'chr3': 198295559, 'chr4': 190214555,
+        'chr5': 181538259, 'chr6': 170805979, 'chr7': 159345973, 'chr8': 145138636,
+        'chr9': 138394717, 'chr10': 133797422, 'chr11': 135086622, 'chr12': 133275309,
+        'chr13': 114364328, 'chr14': 107043718, 'chr15': 101991189, 'chr16': 90338345,
+        'chr17': 83257441, 'chr18': 80373285, 'chr19': 58617616, 'chr20': 64444167,
+        'chr21': 46709983, 'chr22': 50818468, 'chrX': 156040895, 'chrY': 57227415,
+    },
+}
+
+# Bases of a chromosome scored by one worker process at a time
+SHARD_SIZE = 10000000
+
+# bgzip compresses at most this much in each block, tabix indexes by block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# The app of a worker process, each has its own es client and bigWig handles
+WORKER_APP = None
+
+
+def bed_header(signal=False):
+    if signal:
+        columns = ['#chrom', 'start', 'end', 'num_score']  # bedGraph
+    else:
+        columns = ['#chrom', 'start', 'end', 'rsid', 'num_score', 'score']  # bed 5 +
+        columns.extend(RegulomeAtlas.evidence_categories())
+    return '\t'.join(columns) + '\n'
+
+
+def format_signal(chrom, pos_start, pos_end, pos_score, format_json=False):
+    if format_json:
+        pos_json = {'chrom': chrom, 'start': pos_start, 'end': pos_end,
+                    'num_score': pos_score}
+        return json.dumps(pos_json, sort_keys=True)[1:-1] + ','
+    return "%s\t%d\t%d\t%d" % (chrom, pos_start - 1, pos_end, pos_score)
+    #                              - 1 because bed format is 'half open'
+
+
+def format_snp(atlas, chrom, pos, format_json=False):
+    # SNP coordinates are already bed style, 0-based half open
+    start = pos['coordinates']['gte']
+    end = pos['coordinates']['lt']
+    coordinates = '{}:{}-{}'.format(chrom, start, end)
+    if format_json:
+        return json.dumps({pos.get('rsid', coordinates): pos}, sort_keys=True)[1:-1] + ','
+    score = (pos.get('score') or {}).get('ranking', '')
+    num_score = atlas.numeric_score(score)
+    formatted_pos = "%s\t%d\t%d\t%s\t%d\t%s" % \
+                    (chrom, start, end, pos.get('rsid', coordinates), num_score, score)
+    case = atlas.make_a_case(pos)
+    for category in atlas.evidence_categories():  # in order
+        formatted_pos += '\t%s' % case.get(category, '')
+    return formatted_pos
+
+
+def store_rows(atlas, assembly, chrom, start, end):
+    '''Yields score store rows for the single base SNPs of a region'''
+    for snp in atlas.iter_scored_snps(assembly, chrom, start, end):
+        if snp['coordinates']['lt'] - snp['coordinates']['gte'] != 1:
+            continue  # only single bases are looked up in the store
+        yield ScoreStore.encode(snp['coordinates']['gte'], snp.get('score'), snp.get('evidence'))
+
+
+class BgzfWriter(object):
+    '''Writes a file compressed in blocks as bgzip does, so tabix can index it'''
+
+    def __init__(self, file_handle):
+        self.file_handle = file_handle
+        self.buffer = bytearray()
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)  # raw deflate
+        deflated = compressor.compress(data) + compressor.flush()
+        # gzip header with the 'BC' extra subfield holding the block size - 1
+        self.file_handle.write(struct.pack(
+            '<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25
+        ))
+        self.file_handle.write(deflated)
+        self.file_handle.write(struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.file_handle.write(BGZF_EOF)
+
+
+def shards(assembly, chroms, shard_size=SHARD_SIZE):
+    '''Splits chromosomes into (assembly, chrom, start, end) ranges of at most shard_size bases'''
+    return [
+        (assembly, chrom, start, min(start + shard_size, CHROM_SIZES[assembly][chrom]))
+        for chrom in chroms
+        for start in range(0, CHROM_SIZES[assembly][chrom], shard_size)
+    ]
+
+
+def init_worker(config_uri, app_name):
+    global WORKER_APP
+    WORKER_APP = get_app(config_uri, app_name)
+    # Loading app will have configured from config file. Reconfigure here:
+    logging.getLogger('encoded').setLevel(logging.DEBUG)
+
+
+def write_shard(args):
+    '''Worker: scores a shard into a bed file of its own, returns the shard's SNP count.
+       A SNP spanning two shards is only written by the shard it starts in, so the merged
+       file stays sorted.  Signal is already cut at the shard's bounds.'''
+    (shard_dir, (assembly, chrom, start, end), signal) = args
+    atlas = WORKER_APP.registry[REGULOME_ATLAS]
+    count = 0
+    with open(shard_file_name(shard_dir, chrom, start), 'w') as shard_file:
+        if signal:
+            lines = (
+                format_signal(chrom, pos_start, pos_end, pos_score)
+                for (pos_start, pos_end, pos_score)
+                in atlas.iter_scored_signal(assembly, chrom, start, end)
+            )
+        else:
+            lines = (
+                format_snp(atlas, chrom, pos)
+                for pos in atlas.iter_scored_snps(assembly, chrom, start, end)
+                if pos['coordinates']['gte'] >= start
+            )
+        for line in lines:
+            shard_file.write(line + '\n')
+            count += 1
+    return count
+
+
+def shard_file_name(shard_dir, chrom, start):
+    return os.path.join(shard_dir, '%s_%d.bed' % (chrom, start))
+
+
+def merge_shards(bed_file_name, header, shard_dir, assembly_shards):
+    '''Concatenates shard files into one bgzip compressed file.
+       Shards are in chromosome then start order, as is each shard itself.'''
+    with open(bed_file_name, 'wb') as bed_file:
+        writer = BgzfWriter(bed_file)
+        writer.write(header.encode())
+        for (_assembly, chrom, start, _end) in assembly_shards:
+            with open(shard_file_name(shard_dir, chrom, start), 'rb') as shard_file:
+                for block in iter(lambda: shard_file.read(BGZF_BLOCK_SIZE), b''):
+                    writer.write(block)
+        writer.close()
+
+
+def store_chrom(args):
+    '''Worker: precomputes the score store columns of a chromosome'''
+    (path, assembly, chrom) = args
+    atlas = WORKER_APP.registry[REGULOME_ATLAS]
+    return ScoreStore.write_chrom(
+        path, chrom, store_rows(atlas, assembly, chrom, 0, CHROM_SIZES[assembly][chrom])
+    )
+
+
+def chosen(chosen_assembly, chosen_chrom):
+    '''Returns [(assembly, [chroms])] to generate'''
+    return [
+        (assembly, [
+            chrom for chrom in SUPPORTED_CHROMOSOMES
+            if chrom == chosen_chrom or chosen_chrom.lower() == 'all'
+        ])
+        for assembly in REGULOME_SUPPORTED_ASSEMBLIES
+        if assembly == chosen_assembly or chosen_assembly.lower() == 'all'
+    ]
+
+
+def run_store(config_uri, app_name, store, chosen_assembly='GRCh38', chosen_chrom='all',
+              processes=1):
+    '''Precomputes scores of all SNPs into a score store directory for each assembly,
+       a chromosome per worker process'''
+    init_worker(config_uri, app_name)
+    # Scores hold until the region indexer's next cycle
+    generation = RegionIndexerState(
+        WORKER_APP.registry[ELASTIC_SEARCH],
+        WORKER_APP.registry.settings['snovault.elasticsearch.index']
+    ).cycle_generation()
+    pool = None
+    if processes > 1:
+        pool = Pool(processes, initializer=init_worker, initargs=(config_uri, app_name))
+    try:
+        for (assembly, chroms) in chosen(chosen_assembly, chosen_chrom):
+            path = os.path.join(store, assembly)
+            begin = time.time()
+            count = 0
+            counts = (pool.imap if pool else map)(
+                store_chrom, [(path, assembly, chrom) for chrom in chroms]
+            )
+            for chrom, count_by_chrom in zip(chroms, counts):
+                count += count_by_chrom
+                log.info('stored scores of %d SNPs for %s in %s', count_by_chrom, chrom, path)
+            ScoreStore.write_meta(path, chroms, generation)
+            log.info('stored scores of %d SNPs in %s in %.3fs', count, path, time.time() - begin)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def run_sharded(config_uri, app_name, processes, chosen_assembly='GRCh38', chosen_chrom='all',
+                signal=False, shard_size=SHARD_SIZE):
+    '''Scores shards of the chromosomes across a pool of processes, then merges them
+       in order into a bgzip compressed bed file, indexed if tabix is installed'''
+    header = bed_header(signal)
+    with Pool(processes, initializer=init_worker, initargs=(config_uri, app_name)) as pool:
+        for (assembly, chroms) in chosen(chosen_assembly, chosen_chrom):
+            bed_file_name = 'regulome_SNPs_%s.bed.gz' % assembly
+            if signal:
+                bed_file_name = 'regulome_signal_%s.bedGraph.gz' % assembly
+            log.info('Starting to generate %s with %d processes', bed_file_name, processes)
+            begin = time.time()
+            shard_dir = tempfile.mkdtemp(prefix='regulome_shards_', dir='.')
+            try:
+                assembly_shards = shards(assembly, chroms, shard_size)
+                count = 0
+                for (shard, shard_count) in zip(assembly_shards, pool.imap(
+                    write_shard, [(shard_dir, shard, signal) for shard in assembly_shards]
+                )):
+                    count += shard_count
+                    log.info('scored %d SNPs on %s:%d-%d', shard_count, *shard[1:])
+                merge_shards(bed_file_name, header, shard_dir, assembly_shards)
+            finally:
+                shutil.rmtree(shard_dir)
+            if shutil.which('tabix'):
+                subprocess.check_call(['tabix', '-f', '-p', 'bed', bed_file_name])
+            log.info('wrote %d SNPs to %s in %.3fs', count, bed_file_name, time.time() - begin)
+
 
 def run(app, format_json=False, chosen_assembly='GRCh38', chosen_chrom='all', signal=False):
 
@@ -38,61 +293,35 @@ def run(app, format_json=False, chosen_assembly='GRCh38', chosen_chrom='all', si
         if format_json:
             header = '{\n'
         else:
-            if signal:
-                columns = ['#chrom', 'start', 'end', 'num_score']  # bedGraph
-            else:
-                columns = ['#chrom', 'start', 'end', 'rsid', 'num_score', 'score']  # bed 5 +
-                columns.extend(atlas.evidence_categories())
-            header = '\t'.join(columns) + '\n'
+            header = bed_header(signal)
         bed_file.write(header)
         for chrom in SUPPORTED_CHROMOSOMES:
             if chrom != chosen_chrom and chosen_chrom.lower() != 'all':
                 continue
             count_by_chrom = 0
             start = 0
-            end = 200000000   # chrom.sizes ?? (e.g. /files/GRCh38_EBV.chrom.sizes/)
-            # Not really necessary to have an accurate end, just don't stop too soon.
+            end = CHROM_SIZES[assembly][chrom]
 
             # NOTE: Alternative to calling atlas directly:
             #       call path regulome_download/regulome_evidence_{assembly}_{chrom}_0_{end}.bed
             #       then append all chrom files into bed_file (grep -v $# to remove comments)
             if signal:
-                for (pos_start, pos_end, pos_score) in atlas.iter_scored_signal(assembly, chrom,
-                                                                                start, end):
-                    count += 1
-                    count_by_chrom += 1
-                    if format_json:
-                        pos_json = {'chrom': chrom, 'start': pos_start, 'end': pos_end,
-                                    'num_score': pos_score}
-                        formatted_pos = json.dumps(pos_json, sort_keys=True)[1:-1] + ','
-                    else:
-                        formatted_pos = "%s\t%d\t%d\t%d" % \
-                                        (chrom, pos_start - 1, pos_end, pos_score)
-                        #                                 - 1 because bed format is 'half open'
-                    bed_file.write(formatted_pos + '\n')
-                    if (count % 1000000) == 0:  # Make some noise every 10 minutes
-                        print("%d", count)
+                lines = (
+                    format_signal(chrom, pos_start, pos_end, pos_score, format_json)
+                    for (pos_start, pos_end, pos_score)
+                    in atlas.iter_scored_signal(assembly, chrom, start, end)
+                )
             else:
-                for pos in atlas.iter_scored_snps(assembly, chrom, start, end):
-                    count += 1
-                    count_by_chrom += 1
-                    coordinates = '{}:{}-{}'.format(chrom, pos['start'], pos['end'])
-                    if format_json:
-                        formatted_pos = json.dumps({pos.get('rsid', coordinates): pos},
-                                                   sort_keys=True)[1:-1] + ','
-                    else:
-                        score = pos.get('score', {}).get('ranking', '')
-                        num_score = atlas.numeric_score(score)
-                        formatted_pos = "%s\t%d\t%d\t%s\t%d\t%s" % \
-                                        (chrom, pos['start'] - 1, pos['end'],
-                                         pos.get('rsid', coordinates), num_score, score)
-                        #                                    - 1 because bed format is 'half open'
-                        case = atlas.make_a_case(pos)
-                        for category in atlas.evidence_categories():  # in order
-                            formatted_pos += '\t%s' % case.get(category, '')
-                    bed_file.write(formatted_pos + '\n')
-                    if (count % 1000000) == 0:  # Make some noise every 10 minutes
-                        print("%d", count)
+                lines = (
+                    format_snp(atlas, chrom, pos, format_json)
+                    for pos in atlas.iter_scored_snps(assembly, chrom, start, end)
+                )
+            for formatted_pos in lines:
+                count += 1
+                count_by_chrom += 1
+                bed_file.write(formatted_pos + '\n')
+                if (count % 1000000) == 0:  # Make some noise every 10 minutes
+                    print("%d", count)
 
             if format_json:
                 bed_file.write('"%s_count": %d,\n' % (chrom, count_by_chrom))
@@ -104,7 +333,7 @@ def run(app, format_json=False, chosen_assembly='GRCh38', chosen_chrom='all', si
             bed_file.write('"took": %s,\n"chrom_count": %d,\n"count": %d\n}\n' %
                            (took, chrom_count, count))
         else:
-            yield bytes('# took: %s, count: %d\n' % (took, count), 'utf-8')
+            bed_file.write('# took: %s, count: %d\n' % (took, count))
         bed_file.close()
         print("wrote %d SNPs to %s", count, bed_file_name)
     print("Done (finally)")
@@ -128,9 +357,23 @@ def main():
                         action='store_true', required=False)
     parser.add_argument('--json', help="Output JSON instead of default bed.",
                         action='store_true', required=False)
+    parser.add_argument('--store', help="Precompute scores into a score store in this "
+                        "directory (one subdirectory per assembly) instead.", required=False)
+    parser.add_argument('--processes', help="Score shards of the chromosomes in this many "
+                        "processes, into a bgzip compressed file. Default: 1",
+                        type=int, default=1, required=False)
     args = parser.parse_args()
 
     logging.basicConfig()
+    if args.store:
+        return run_store(args.config_uri, args.app_name, args.store, args.assembly, args.chrom,
+                         args.processes)
+    if args.processes > 1:
+        if args.json:
+            parser.error('--json output is not generated by --processes')
+        return run_sharded(args.config_uri, args.app_name, args.processes, args.assembly,
+                           args.chrom, args.signal)
+
     app = get_app(args.config_uri, args.app_name)
 
     # Loading app will have configured from config file. Reconfigure here:
@@ -5,16 +5,15 @@ from multiprocessing import Pool
 from pkg_resources import resource_filename
 import sys
 
-import pyBigWig
 from pyramid.paster import get_app
 
 from ..regulome_search import (
     get_coordinate,
     region_get_hits,
+    region_stored_score,
     evidence_to_features
 )
-from ..regulome_atlas import RegulomeAtlas
-from snovault.elasticsearch.interfaces import SNP_SEARCH_ES
+from ..regulome_atlas import REGULOME_ATLAS
 
 
 class RegulomeSearch:
@@ -40,24 +39,9 @@ class RegulomeSearch:
         try:
             return self._atlas
         except AttributeError:
+            # bigWigs are opened by each process on first use
             app = get_app(self.config_file, self.app_name)
-            # So that different process won't compete for one bigWig handle
-            instance_specific_bws = {
-                'IC_matched_max': pyBigWig.open(
-                    resource_filename(
-                        'encoded', '../../bigwig_files/IC_matched_max.bw'
-                    )
-                ),
-                'IC_max': pyBigWig.open(
-                    resource_filename(
-                        'encoded', '../../bigwig_files/IC_max.bw'
-                    )
-                ),
-            }
-            self._atlas = RegulomeAtlas(
-                app.registry[SNP_SEARCH_ES],
-                bw_signal_map=instance_specific_bws,
-            )
+            self._atlas = app.registry[REGULOME_ATLAS]
             return self._atlas
 
     def __call__(self, region_query):
@@ -86,6 +70,11 @@ class RegulomeSearch:
             'start': start,
             'end': end,
         }
+        if not self.return_peaks and not self.matched_pwm_peak_bed_only:
+            stored_score = region_stored_score(self.atlas, self.assembly, chrom, start, end)
+            if stored_score is not None:
+                (result['score'], result['features']) = stored_score
+                return 0, json.dumps(result)
         try:
             all_hits = region_get_hits(
                 self.atlas,
@@ -1,23 +1,44 @@
 import pickle
 from pkg_resources import resource_filename
 
+from collections import OrderedDict
 from operator import itemgetter
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
 
 from elasticsearch.exceptions import (
     NotFoundError
 )
+from elasticsearch.helpers import (
+    scan
+)
 import math
+import numpy
 import pyBigWig
+from pyramid.settings import asbool
 from snovault.elasticsearch.indexer_state import SEARCH_MAX
+from snovault.elasticsearch.interfaces import (
+    ELASTIC_SEARCH,
+    SNP_SEARCH_ES,
+)
 
 from .regulome_indexer import (
     snp_index_key,
+    RegionIndexerState,
+    REGULOME_ATLAS,
     RESIDENT_REGIONSET_KEY,
     FOR_REGULOME_DB,
     REGULOME_ALLOWED_STATUSES,
     REGULOME_DATASET_TYPES
 )
 
+log = logging.getLogger(__name__)
+
 # ##################################
 # RegionAtlas and RegulomeAtlas classes encapsulate the methods
 # for querying regions and SNPs from the region_index.
@@ -26,29 +47,982 @@ from .regulome_indexer import (
 # when iterating scored snps or bases, chunk calls to index for efficiency
 # NOTE: failures seen when chunking is too large
 REGDB_SCORE_CHUNK_SIZE = 30000
+# Before iterating, SNPs or peaks are counted in windows of this many bases; empty windows
+# are skipped and the rest are cut into chunks of about REGDB_SCORE_CHUNK_MAX_HITS hits
+REGDB_DENSITY_WINDOW = 1000000
+REGDB_SCORE_CHUNK_MAX_HITS = 5000
+
+# Number of region queries sent to es in one _msearch request
+REGDB_MSEARCH_BATCH_SIZE = 100
+
+# Hits per page when SNPs or peaks of a region are streamed, and how long es keeps a scroll open
+REGDB_SCROLL_SIZE = 1000
+REGDB_SCROLL_TIMEOUT = '1m'
+
+# Number of SNPs fetched by rsid in one _mget request
+REGDB_MGET_BATCH_SIZE = 1000
+
+# Max bases of bigWig signal read at once for nearby variants on a chromosome
+REGDB_SIGNAL_WINDOW = 1000000
+
+# SNPs gathered into numpy arrays at a time while building rsid indices or score stores
+REGDB_NUMPY_BLOCK_SIZE = 1000000
+
+# Peak _source returned to each kind of caller: scoring only needs to know which file
+# a peak belongs to and where it is, details pages and downloads show the whole peak
+REGDB_PEAK_SOURCE_PROFILES = {
+    'scoring': ['uuid', 'coordinates'],
+    'detail': True,
+}
+
+# Max number of resident_regionsets details held in the process-local cache
+REGDB_RESIDENT_CACHE_CAPACITY = 10000
+# Seconds between checks of the region indexer state for a finished cycle
+REGDB_RESIDENT_CACHE_CHECK_INTERVAL = 60
+# Max number of scored region results kept by a result cache
+REGDB_RESULT_CACHE_CAPACITY = 100000
+
+# The only resident details needed to score: evidence categories, targets and briefs
+REGDB_SCORING_RESIDENT_FIELDS = [
+    'uuid',
+    'file.@id',
+    'dataset.uuid',
+    'dataset.@id',
+    'dataset.collection_type',
+    'dataset.target',
+    'dataset.biosample_term_name',
+]
 
 # RegulomeDB scores for bigWig (bedGraph) are converted to numeric and can be converted back
 REGDB_STR_SCORES = ['1a', '1b', '1c', '1d', '1e', '1f', '2a', '2b', '2c', '3a', '3b', '4', '5', '6']
 REGDB_NUM_SCORES = [1000, 950, 900, 850, 800, 750, 600, 550, 500, 450, 400, 300, 200, 100]
 
-# def includeme(config):
-#    config.scan(__name__)
-#    registry = config.registry
-#    registry['region'+INDEXER] = RegionIndexer(registry)
+# Evidence features, in the order the trained random forest model expects them
+REGDB_BINARY_FEATURES = [
+    'ChIP', 'DNase', 'PWM', 'Footprint', 'QTL', 'PWM_matched', 'Footprint_matched'
+]
+REGDB_NUMERIC_FEATURES = ['IC_max', 'IC_matched_max']
+
+# Heuristic rankings: the first rule whose evidence is all present wins
+REGDB_RANKING_RULES = [
+    (('QTL', 'ChIP', 'DNase', 'PWM_matched', 'Footprint_matched'), '1a'),
+    (('QTL', 'ChIP', 'DNase', 'PWM', 'Footprint'), '1b'),
+    (('QTL', 'ChIP', 'DNase', 'PWM_matched'), '1c'),
+    (('QTL', 'ChIP', 'DNase', 'PWM'), '1d'),
+    (('QTL', 'ChIP', 'DNase'), '1f'),
+    (('QTL', 'ChIP', 'PWM_matched'), '1e'),
+    (('QTL', 'ChIP'), '1f'),
+    (('QTL', 'DNase'), '1f'),
+    (('QTL', 'PWM'), '6'),
+    (('QTL', 'Footprint'), '6'),
+    (('QTL',), '7'),
+    (('ChIP', 'DNase', 'PWM_matched', 'Footprint_matched'), '2a'),
+    (('ChIP', 'DNase', 'PWM', 'Footprint'), '2b'),
+    (('ChIP', 'DNase', 'PWM_matched'), '2c'),
+    (('ChIP', 'DNase', 'PWM'), '3a'),
+    (('ChIP', 'DNase'), '4'),
+    (('ChIP', 'PWM_matched'), '3b'),
+    (('ChIP',), '5'),
+    (('DNase',), '5'),
+    (('PWM',), '6'),
+    (('Footprint',), '6'),
+    ((), '7'),
+]
+
+
+def evidence_bits(characterization):
+    '''Returns the bitmask of REGDB_BINARY_FEATURES found in a characterization'''
+    bits = 0
+    for (bit, feature) in enumerate(REGDB_BINARY_FEATURES):
+        if feature in characterization:
+            bits |= 1 << bit
+    return bits
+
+
+def _ranking_table():
+    '''private: the ranking of every evidence bitmask, indexed by bitmask'''
+    rules = [(evidence_bits(required), ranking) for (required, ranking) in REGDB_RANKING_RULES]
+    return [
+        next(ranking for (required, ranking) in rules if bits & required == required)
+        for bits in range(1 << len(REGDB_BINARY_FEATURES))
+    ]
+
+
+REGDB_RANKINGS = _ranking_table()
+
+
+def includeme(config):
+    registry = config.registry
+    generation = None
+    if ELASTIC_SEARCH in registry:
+        # resident details only change when the region indexer finishes a cycle
+        generation = RegionIndexerState(
+            registry[ELASTIC_SEARCH],
+            registry.settings['snovault.elasticsearch.index']
+        ).cycle_generation
+    check_interval = float(registry.settings.get(
+        'regulome.resident_cache.check_interval', REGDB_RESIDENT_CACHE_CHECK_INTERVAL
+    ))
+    resident_table = None
+    if asbool(registry.settings.get('regulome.preload_residents', False)):
+        resident_table = ResidentDetailsTable(
+            registry[SNP_SEARCH_ES],
+            generation=generation,
+            check_interval=check_interval,
+        )
+        resident_table.load()
+    resident_cache = ResidentDetailsCache(
+        capacity=int(registry.settings.get(
+            'regulome.resident_cache.capacity', REGDB_RESIDENT_CACHE_CAPACITY
+        )),
+        generation=generation,
+        check_interval=check_interval,
+    )
+    result_cache_type = registry.settings.get('regulome.result_cache', 'memory')
+    result_cache_capacity = int(registry.settings.get(
+        'regulome.result_cache.capacity', REGDB_RESULT_CACHE_CAPACITY
+    ))
+    result_cache = None
+    if result_cache_type == 'memory':
+        result_cache = RegionResultCache(
+            capacity=result_cache_capacity,
+            generation=generation,
+            check_interval=check_interval,
+        )
+    elif result_cache_type == 'sqlite':
+        result_cache = SqliteRegionResultCache(
+            registry.settings['regulome.result_cache.path'],
+            capacity=result_cache_capacity,
+            generation=generation,
+            check_interval=check_interval,
+        )
+    if asbool(registry.settings.get('regulome.warm_up', False)):
+        # Unpickle the model before workers fork so they share it.  bigWigs are
+        # reopened in each worker on first use anyway.
+        SCORING_RESOURCES.warm_up()
+    registry[REGULOME_ATLAS] = RegulomeAtlas(
+        registry[SNP_SEARCH_ES],
+        msearch_batch_size=int(registry.settings.get(
+            'regulome.msearch_batch_size', REGDB_MSEARCH_BATCH_SIZE
+        )),
+        mget_batch_size=int(registry.settings.get(
+            'regulome.mget_batch_size', REGDB_MGET_BATCH_SIZE
+        )),
+        resident_cache=resident_cache,
+        resident_table=resident_table,
+        result_cache=result_cache,
+        rsid_indices={
+            assembly: RsidIndex(registry.settings['regulome.rsid_index.' + assembly])
+            for assembly in ('hg19', 'GRCh38')
+            if registry.settings.get('regulome.rsid_index.' + assembly)
+        },
+        rsid_fallback=asbool(registry.settings.get('regulome.rsid_index.fallback', True)),
+        score_stores={
+            assembly: ScoreStore(
+                registry.settings['regulome.score_store.' + assembly],
+                generation=generation,
+                check_interval=check_interval,
+            )
+            for assembly in ('hg19', 'GRCh38')
+            if registry.settings.get('regulome.score_store.' + assembly)
+        },
+    )
+
+
+class ScoringResources(object):
+    '''The trained random forest model and the bigWig files scoring needs.
+
+    Nothing is loaded until first used, so processes that never score don't
+    pay for it.  Both are then cached for the process.  pyBigWig handles
+    can't be shared by forked processes, so a child reopens its own while
+    keeping the model it inherited.
+    '''
+
+    def __init__(self, model_file, bigwig_files):
+        self.model_file = model_file
+        self.bigwig_files = bigwig_files
+        self._lock = threading.Lock()
+        self._model = None
+        self._bigwigs = None
+        self._bigwigs_pid = None
+
+    @property
+    def model(self):
+        '''Trained random forest model, to make predictions on query data'''
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    with open(self.model_file, 'rb') as model_file:
+                        self._model = pickle.load(model_file)
+        return self._model
+
+    @property
+    def bigwigs(self):
+        '''{signal: pyBigWig handle} opened by this process'''
+        pid = os.getpid()
+        if self._bigwigs is None or self._bigwigs_pid != pid:
+            with self._lock:
+                if self._bigwigs is None or self._bigwigs_pid != pid:
+                    self._bigwigs = {
+                        k: pyBigWig.open(path) for k, path in self.bigwig_files.items()
+                    }
+                    self._bigwigs_pid = pid
+        return self._bigwigs
+
+    def warm_up(self):
+        '''Loads everything now rather than on the first scoring request'''
+        return (self.model, self.bigwigs)
+
 
-# Make prediction on query data with trained random forest model load trained model
-TRAINED_REG_MODEL = pickle.load(
-    open(resource_filename('encoded', '../../rf_model.sav'), 'rb')
+SCORING_RESOURCES = ScoringResources(
+    resource_filename('encoded', '../../rf_model.sav'),
+    {
+        'IC_matched_max': resource_filename('encoded', '../../bigwig_files/IC_matched_max.bw'),
+        'IC_max': resource_filename('encoded', '../../bigwig_files/IC_max.bw'),
+    },
 )
 
-LOCAL_BIGWIGS = {
-    'IC_matched_max': pyBigWig.open(
-        resource_filename('encoded', '../../bigwig_files/IC_matched_max.bw')
-    ),
-    'IC_max': pyBigWig.open(
-        resource_filename('encoded', '../../bigwig_files/IC_max.bw')
-    ),
-}
+
+class GenerationLRUCache(object):
+    '''Process-local, size-bounded LRU cache of values derived from the region index.
+
+    Values only change when the region indexer runs a cycle, so the whole
+    cache is dropped whenever the indexer state generation changes.
+    '''
+
+    def __init__(
+        self,
+        capacity=REGDB_RESIDENT_CACHE_CAPACITY,
+        generation=None,
+        check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL,
+    ):
+        self.capacity = capacity
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._generation = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _validate(self):
+        '''private: clears the cache if the region indexer finished a cycle since last check'''
+        if self.generation is None:
+            return
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            generation = self.generation()
+        except Exception:
+            return
+        if generation != self._generation:
+            with self._lock:
+                self._values.clear()
+                self._generation = generation
+
+    def get_many(self, keys):
+        '''Returns (values of cached keys, list of keys not cached)'''
+        self._validate()
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._values:
+                    self._values.move_to_end(key)
+                    found[key] = self._values[key]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+                    self.misses += 1
+        return (found, missing)
+
+    def _put(self, items):
+        '''private: caches (key, value) pairs, dropping the least recently used beyond capacity'''
+        self._validate()
+        with self._lock:
+            for (key, value) in items:
+                self._values[key] = value
+                self._values.move_to_end(key)
+            while len(self._values) > self.capacity:
+                self._values.popitem(last=False)
+
+    def put_many(self, keys, values):
+        '''Caches the values of those keys that have one'''
+        self._put((key, values[key]) for key in keys if key in values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        '''Returns cache size and hit/miss counters'''
+        return {
+            'capacity': self.capacity,
+            'size': len(self._values),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ResidentDetailsCache(GenerationLRUCache):
+    '''Process-local, size-bounded LRU cache of resident_regionsets details keyed by file uuid.
+
+    Uuids looked up but not found are cached too, as known not to be regulome residents.
+    '''
+
+    def get_many(self, uuids):
+        '''Returns (details of cached uuids, list of uuids not cached)'''
+        (found, missing) = super(ResidentDetailsCache, self).get_many(uuids)
+        # None: known not to be a regulome resident
+        return ({uuid: detail for (uuid, detail) in found.items() if detail is not None}, missing)
+
+    def put_many(self, uuids, details):
+        '''Caches details of looked up uuids, remembering those that were not found'''
+        self._put((uuid, details.get(uuid)) for uuid in uuids)
+
+
+class RegionResultCache(GenerationLRUCache):
+    '''Process-local, size-bounded LRU cache of scored region results keyed by
+    (assembly, chrom, start, end, profile).
+
+    Only computed results are cached, a key without a result is left out.
+    '''
+
+
+class SqliteRegionResultCache(object):
+    '''Scored region results in a local sqlite file shared by all processes of a host.
+
+    Same get_many/put_many interface as RegionResultCache.  Results of an older indexer
+    generation are deleted by the first process noticing the change.  Unlike the LRU
+    RegionResultCache, eviction is first in first out: beyond capacity the earliest
+    written results are dropped, so hits never write to the shared file.
+    '''
+
+    def __init__(
+        self,
+        path,
+        capacity=REGDB_RESULT_CACHE_CAPACITY,
+        generation=None,
+        check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL,
+    ):
+        self.path = path
+        self.capacity = capacity
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._connection = None  # opened on first use, after workers fork
+        self._checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)'
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(list(key))
+
+    def _validate(self):
+        '''private: clears the cache if the region indexer finished a cycle since last check'''
+        if self.generation is None:
+            return
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            generation = json.dumps(self.generation())
+        except Exception:
+            return
+        with self._lock, self.connection as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE name = 'generation'"
+            ).fetchone()
+            if row is None or row[0] != generation:
+                connection.execute('DELETE FROM results')
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,)
+                )
+
+    def get_many(self, keys):
+        '''Returns (results of cached keys, list of keys not cached)'''
+        self._validate()
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                row = self.connection.execute(
+                    'SELECT value FROM results WHERE key = ?', (self._key(key),)
+                ).fetchone()
+                if row is None:
+                    missing.append(key)
+                    self.misses += 1
+                else:
+                    found[key] = json.loads(row[0])
+                    self.hits += 1
+        return (found, missing)
+
+    def put_many(self, keys, results):
+        '''Caches the results of keys'''
+        self._validate()
+        with self._lock, self.connection as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?)',
+                [(self._key(key), json.dumps(results[key])) for key in keys if key in results]
+            )
+            connection.execute(
+                'DELETE FROM results WHERE rowid <= (SELECT MAX(rowid) FROM results) - ?',
+                (self.capacity,)
+            )
+
+    def clear(self):
+        with self._lock, self.connection as connection:
+            connection.execute('DELETE FROM results')
+
+    def stats(self):
+        '''Returns cache size and hit/miss counters'''
+        with self._lock:
+            size = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {
+            'capacity': self.capacity,
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ResidentDetailsTable(object):
+    '''In-process table of every regulome resident, trimmed to the details scoring uses.
+
+    An alternative to per request es lookups: the whole resident_regionsets
+    index is loaded once and reloaded in a background thread whenever the
+    region indexer finishes a cycle.
+    '''
+
+    def __init__(
+        self,
+        region_es,
+        generation=None,
+        check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL,
+    ):
+        self.region_es = region_es
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self.details = None  # until loaded
+        self._generation = None
+        self._refresher = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        '''private: reads compact details of all regulome residents from es'''
+        details = {}
+        datasets = {}  # many files share one dataset, so share one dict
+        for hit in scan(
+            self.region_es,
+            index=RESIDENT_REGIONSET_KEY,
+            doc_type=FOR_REGULOME_DB,
+            query={'_source': REGDB_SCORING_RESIDENT_FIELDS},
+        ):
+            source = hit['_source']
+            dataset = source.get('dataset', {})
+            dataset = datasets.setdefault(dataset.get('@id'), dataset)
+            details[source['uuid']] = {
+                'uuid': source['uuid'],
+                'file': source.get('file', {}),
+                'dataset': dataset,
+            }
+        return details
+
+    def load(self):
+        '''(Re)loads the table, keeping the previous one on failure'''
+        try:
+            generation = self.generation() if self.generation is not None else None
+            details = self._read()
+        except Exception:
+            log.warning('Failed to load resident details table', exc_info=True)
+            return False
+        self.details = details
+        self._generation = generation
+        log.info('Loaded %d resident details', len(details))
+        return True
+
+    def refresh(self):
+        '''Reloads the table if the region indexer finished a cycle since it was loaded'''
+        try:
+            generation = self.generation()
+        except Exception:
+            return False
+        if generation == self._generation:
+            return False
+        return self.load()
+
+    def _refresh(self):
+        '''private: background loop reloading the table after each region indexer cycle'''
+        while not self._stopped.wait(self.check_interval):
+            self.refresh()
+
+    def _ensure_refresher(self):
+        '''private: (re)starts the refresh thread, which does not survive forking'''
+        if self.generation is None or self._stopped.is_set():
+            return
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(
+                    target=self._refresh, name='resident-details-refresh', daemon=True
+                )
+                self._refresher.start()
+
+    def stop(self):
+        '''Stops the refresh thread, the table is no longer reloaded'''
+        self._stopped.set()
+        if self._refresher is not None:
+            self._refresher.join()
+
+    @property
+    def loaded(self):
+        return self.details is not None
+
+    def get_many(self, uuids):
+        '''Returns details for the uuids that are regulome residents'''
+        self._ensure_refresher()
+        if self.details is None:
+            self.load()
+        details = self.details or {}
+        return {uuid: details[uuid] for uuid in uuids if uuid in details}
+
+
+class PeakIntervalIndex(object):
+    '''Sorted, array backed index of peaks for overlap lookups on many positions.
+
+    Built once per chunk of peaks.  A peak overlaps a position when
+    gte <= position <= lt, as region scoring has always treated them, or when
+    half_open, gte <= position < lt as es matches a position to a peak.
+    '''
+
+    def __init__(self, peaks, half_open=False):
+        self.half_open = half_open
+        by_chrom = {}
+        for peak in peaks:
+            coordinates = peak['_source']['coordinates']
+            if coordinates['gte'] > coordinates['lt'] - (1 if half_open else 0):
+                continue  # can't overlap anything
+            by_chrom.setdefault(peak['_index'], []).append(
+                (coordinates['gte'], coordinates['lt'], peak['_source']['uuid'])
+            )
+        self.chroms = {}
+        for chrom, intervals in by_chrom.items():
+            starts = numpy.array([interval[0] for interval in intervals], dtype=numpy.int64)
+            ends = numpy.array([interval[1] for interval in intervals], dtype=numpy.int64)
+            by_start = numpy.argsort(starts, kind='mergesort')
+            by_end = numpy.argsort(ends, kind='mergesort')
+            self.chroms[chrom] = {
+                'starts': starts[by_start],
+                'start_uuids': [intervals[i][2] for i in by_start],
+                'ends': ends[by_end],
+                'end_uuids': [intervals[i][2] for i in by_end],
+            }
+
+    def overlaps(self, chrom, positions):
+        '''Returns a list with the set of overlapping peak uuids for each position'''
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        overlaps = [set() for _ in range(len(positions))]
+        intervals = self.chroms.get(chrom)
+        if intervals is None or len(positions) == 0:
+            return overlaps
+
+        # Sweep line over sorted positions: peaks enter once started (gte <= pos)
+        # and leave once ended (lt < pos, or lt <= pos when half open).  Counts are
+        # needed since one file (uuid) may have several overlapping peaks.
+        order = numpy.argsort(positions, kind='mergesort')
+        sorted_positions = positions[order]
+        started = numpy.searchsorted(intervals['starts'], sorted_positions, side='right')
+        ended = numpy.searchsorted(
+            intervals['ends'], sorted_positions, side='right' if self.half_open else 'left'
+        )
+        start_uuids = intervals['start_uuids']
+        end_uuids = intervals['end_uuids']
+        active = {}
+        last_started = 0
+        last_ended = 0
+        for ix, n_started, n_ended in zip(order, started, ended):
+            for uuid in start_uuids[last_started:n_started]:
+                active[uuid] = active.get(uuid, 0) + 1
+            for uuid in end_uuids[last_ended:n_ended]:
+                active[uuid] -= 1
+                if active[uuid] == 0:
+                    del active[uuid]
+            last_started = n_started
+            last_ended = n_ended
+            overlaps[ix] = set(active)
+        return overlaps
+
+    def segments(self, chrom, start, end):
+        '''Yields (first_base, last_base, uuids) for runs of bases in [start, end)
+           that overlap the same set of peaks'''
+        if end <= start:
+            return
+        bounds = [numpy.array([start], dtype=numpy.int64)]
+        intervals = self.chroms.get(chrom)
+        if intervals is not None:
+            # overlap sets can only change where a peak starts or just past where one ends
+            bounds.append(intervals['starts'])
+            bounds.append(intervals['ends'] if self.half_open else intervals['ends'] + 1)
+        bounds = numpy.unique(numpy.concatenate(bounds))
+        bounds = bounds[(bounds >= start) & (bounds < end)]
+        lasts = numpy.append(bounds[1:] - 1, end - 1)
+        for first_base, last_base, uuids in zip(
+            bounds, lasts, self.overlaps(chrom, bounds)
+        ):
+            yield (int(first_base), int(last_base), uuids)
+
+
+class BigWigSignals(object):
+    '''Mean bigWig signals (IC_max, IC_matched_max) over many regions.
+
+    Regions are sorted and grouped into windows of nearby regions on a
+    chromosome.  Each bigWig is read once per window into a numpy array and
+    the mean for every region is sliced out of it.  A region with any base
+    lacking signal (NaN) gets a signal of 0.0.
+    '''
+
+    def __init__(self, bw_signal_map=None, max_window=REGDB_SIGNAL_WINDOW):
+        self.bw_signal_map = bw_signal_map
+        self.max_window = max_window
+
+    @property
+    def bigwigs(self):
+        if self.bw_signal_map is not None:
+            return self.bw_signal_map
+        return SCORING_RESOURCES.bigwigs
+
+    @staticmethod
+    def read(bw, chrom, start, end):
+        '''Returns signal values for bases [start, end) as a numpy array'''
+        if end <= start:
+            return numpy.empty(0)
+        if pyBigWig.numpy:
+            return bw.values(chrom, start, end, numpy=True)
+        return numpy.array(bw.values(chrom, start, end), dtype=float)
+
+    @staticmethod
+    def mean(values):
+        if len(values) == 0:
+            return 0.0
+        average = float(values.mean())
+        return 0.0 if math.isnan(average) else average
+
+    def windows(self, regions):
+        '''Yields (chrom, start, end, region indices) grouping sorted regions into windows'''
+        order = sorted(range(len(regions)), key=lambda ix: (regions[ix][0], regions[ix][1]))
+        window = None
+        for ix in order:
+            (chrom, start, end) = regions[ix]
+            if (
+                window is not None and chrom == window[0]
+                and max(window[2], end) - window[1] <= self.max_window
+            ):
+                window[2] = max(window[2], end)
+                window[3].append(ix)
+                continue
+            if window is not None:
+                yield tuple(window)
+            window = [chrom, start, end, [ix]]
+        if window is not None:
+            yield tuple(window)
+
+    def means(self, regions):
+        '''Given (chrom, start, end) regions returns a {signal: mean} dict for each, in order'''
+        signals = [{} for _ in regions]
+        for (chrom, window_start, window_end, indices) in self.windows(regions):
+            for k, bw in self.bigwigs.items():
+                try:
+                    values = self.read(bw, chrom, window_start, window_end)
+                except RuntimeError:
+                    values = None  # e.g. past the chromosome end: each region on its own
+                for ix in indices:
+                    (_chrom, start, end) = regions[ix]
+                    if values is None:
+                        signals[ix][k] = self.mean(self.read(bw, chrom, start, end))
+                    else:
+                        signals[ix][k] = self.mean(
+                            values[start - window_start:max(end, start) - window_start]
+                        )
+        return signals
+
+
+def first_of_sorted(keys):
+    '''Returns the indices sorting keys, keeping only the first index of equal keys'''
+    order = numpy.argsort(keys, kind='mergesort')  # stable, so first wins
+    keys = keys[order]
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return order[first]
+
+
+def save_column(file_name, values):
+    '''Saves a numpy column under a temporary name first,
+       so a serving process never maps half a file'''
+    tmp_file = file_name[:-len('.npy')] + '.tmp.npy'
+    numpy.save(tmp_file, values)
+    os.replace(tmp_file, file_name)
+
+
+class RsidIndex(object):
+    '''Local rsid -> (chrom, start, end) lookup, built from a dbSNP bed.
+
+    A directory of .npy columns sorted by rsid number, memory-mapped so that
+    worker processes share the pages and a lookup only reads the few pages
+    its binary search touches.  Build one with the build-rsid-index command.
+    '''
+
+    COLUMNS = (
+        ('rsid', numpy.uint64),
+        ('chrom', numpy.uint8),
+        ('start', numpy.uint32),
+        ('end', numpy.uint32),
+    )
+    CHROMS = ['chr%d' % n for n in range(1, 23)] + ['chrX', 'chrY', 'chrM']
+
+    def __init__(self, path):
+        self.path = path
+        self._columns = None
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = {
+                name: numpy.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+                for (name, _dtype) in self.COLUMNS
+            }
+        return self._columns
+
+    def __len__(self):
+        return len(self.columns['rsid'])
+
+    @staticmethod
+    def rsid_number(rsid):
+        '''rs123 -> 123, or None for anything that is not a dbSNP id'''
+        if not rsid[:2].lower() == 'rs' or not rsid[2:].isdigit():
+            return None
+        return int(rsid[2:])
+
+    def lookup(self, rsids):
+        '''Returns {rsid: (chrom, start, end)} for those of the rsids in the index'''
+        numbered = [(rsid, self.rsid_number(rsid)) for rsid in rsids]
+        numbered = [(rsid, number) for (rsid, number) in numbered if number is not None]
+        if not numbered:
+            return {}
+        columns = self.columns
+        numbers = numpy.array([number for (_rsid, number) in numbered], dtype=numpy.uint64)
+        found = numpy.searchsorted(columns['rsid'], numbers)
+        coordinates = {}
+        for (rsid, number), ix in zip(numbered, found):
+            if ix < len(columns['rsid']) and columns['rsid'][ix] == number:
+                coordinates[rsid] = (
+                    self.CHROMS[columns['chrom'][ix]],
+                    int(columns['start'][ix]),
+                    int(columns['end'][ix]),
+                )
+        return coordinates
+
+    @classmethod
+    def build(cls, snps, path):
+        '''Writes an index of (chrom, start, end, rsid) SNPs to the path directory.
+           SNPs on other chromosomes than CHROMS are left out and where an rsid
+           maps to more than one place the first is kept, as the indexer does.'''
+        chrom_codes = {chrom: code for (code, chrom) in enumerate(cls.CHROMS)}
+        blocks = {name: [] for (name, _dtype) in cls.COLUMNS}
+        block = {name: [] for (name, _dtype) in cls.COLUMNS}
+
+        def flush():
+            for (name, dtype) in cls.COLUMNS:
+                blocks[name].append(numpy.array(block[name], dtype=dtype))
+                block[name] = []
+
+        for (chrom, start, end, rsid) in snps:
+            code = chrom_codes.get(chrom)
+            number = cls.rsid_number(rsid)
+            if code is None or number is None:
+                continue
+            block['rsid'].append(number)
+            block['chrom'].append(code)
+            block['start'].append(start)
+            block['end'].append(end)
+            if len(block['rsid']) >= REGDB_NUMPY_BLOCK_SIZE:
+                flush()
+        flush()
+        columns = {name: numpy.concatenate(blocks.pop(name)) for (name, _dtype) in cls.COLUMNS}
+        order = first_of_sorted(columns['rsid'])
+        os.makedirs(path, exist_ok=True)
+        for (name, _dtype) in cls.COLUMNS:
+            save_column(os.path.join(path, name + '.npy'), columns.pop(name)[order])
+        return len(order)
+
+
+class ScoreStore(object):
+    '''Precomputed regulome scores of dbSNP SNPs, built by generate-scored-snps --store.
+
+    A directory of .npy columns per chromosome, sorted by SNP start and
+    memory-mapped.  Each SNP keeps its ranking, probability, binary evidence
+    features as bits and bigWig signals: all a summary needs to report it.
+    SNPs without evidence are kept too, as known to have no score.
+    meta.json records the region indexer generation the scores were made
+    from, a store left behind by a later indexer cycle is not used.
+    '''
+
+    COLUMNS = (
+        ('start', numpy.uint32),
+        ('ranking', numpy.uint8),
+        ('features', numpy.uint8),
+        ('probability', numpy.float64),
+        ('IC_max', numpy.float64),
+        ('IC_matched_max', numpy.float64),
+    )
+    RANKINGS = REGDB_STR_SCORES + ['7']
+    UNSCORED = 255
+
+    def __init__(self, path, generation=None, check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL):
+        self.path = path
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self._chroms = {}
+        self._meta = None
+        self._current = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(os.path.join(self.path, 'meta.json')) as meta_file:
+                self._meta = json.load(meta_file)
+        return self._meta
+
+    def current(self):
+        '''True while the store was made from the region indexer's last cycle'''
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return self._current
+        with self._lock:
+            try:
+                self._meta = None  # a rebuilt store is picked up too
+                current = self.generation is None or (
+                    self.meta.get('generation') == list(self.generation())
+                )
+            except Exception:
+                current = False
+            if current != self._current:
+                self._chroms = {}
+                log.info(
+                    'Precomputed scores in %s %s', self.path, 'used' if current else 'not used'
+                )
+            self._current = current
+            self._checked = now
+        return current
+
+    def columns(self, chrom):
+        if chrom not in self._chroms:
+            if chrom not in self.meta.get('chroms', []):
+                self._chroms[chrom] = None
+            else:
+                self._chroms[chrom] = {
+                    name: numpy.load(
+                        os.path.join(self.path, '%s.%s.npy' % (chrom, name)), mmap_mode='r'
+                    )
+                    for (name, _dtype) in self.COLUMNS
+                }
+        return self._chroms[chrom]
+
+    def lookup(self, regions):
+        '''Given (chrom, start, end) regions returns (score, features) for each SNP stored,
+           in the form regulome_score() and evidence_to_features() give them, both empty
+           for a SNP without evidence.  None for regions not stored.'''
+        results = [None] * len(regions)
+        by_chrom = {}
+        for ix, (chrom, start, end) in enumerate(regions):
+            if int(end) - int(start) == 1:
+                by_chrom.setdefault(chrom, []).append(ix)
+        for chrom, indices in by_chrom.items():
+            columns = self.columns(chrom)
+            if columns is None:
+                continue
+            starts = numpy.array([int(regions[ix][1]) for ix in indices], dtype=numpy.uint32)
+            found = numpy.searchsorted(columns['start'], starts)
+            for ix, start, row in zip(indices, starts, found):
+                if row < len(columns['start']) and columns['start'][row] == start:
+                    results[ix] = self.record(columns, row)
+        return results
+
+    def record(self, columns, row):
+        if columns['ranking'][row] == self.UNSCORED:
+            return ({}, {})
+        score = {
+            'probability': str(round(float(columns['probability'][row]), 5)),
+            'ranking': self.RANKINGS[columns['ranking'][row]],
+        }
+        bits = int(columns['features'][row])
+        features = {
+            feature: bool(bits & (1 << bit)) for (bit, feature) in enumerate(REGDB_BINARY_FEATURES)
+        }
+        for feature in REGDB_NUMERIC_FEATURES:
+            features[feature] = float(columns[feature][row])
+        return (score, features)
+
+    @classmethod
+    def encode(cls, start, score, evidence):
+        '''Returns the row of columns storing a scored SNP, or an unscored one'''
+        if not score:
+            return (start, cls.UNSCORED, 0, 0.0, 0.0, 0.0)
+        return (
+            start,
+            cls.RANKINGS.index(score['ranking']),
+            evidence_bits(evidence),
+            float(score['probability']),
+            evidence.get('IC_max', 0.0),
+            evidence.get('IC_matched_max', 0.0),
+        )
+
+    @classmethod
+    def write_chrom(cls, path, chrom, rows):
+        '''Writes the encoded rows of a chromosome, keeping the first row for each start'''
+        os.makedirs(path, exist_ok=True)
+        rows = iter(rows)
+        blocks = {name: [numpy.empty(0, dtype=dtype)] for (name, dtype) in cls.COLUMNS}
+        while True:
+            block = list(itertools.islice(rows, REGDB_NUMPY_BLOCK_SIZE))
+            if not block:
+                break
+            for (name, dtype), values in zip(cls.COLUMNS, zip(*block)):
+                blocks[name].append(numpy.array(values, dtype=dtype))
+        columns = {name: numpy.concatenate(blocks.pop(name)) for (name, _dtype) in cls.COLUMNS}
+        order = first_of_sorted(columns['start'])
+        for (name, _dtype) in cls.COLUMNS:
+            save_column(os.path.join(path, '%s.%s.npy' % (chrom, name)), columns.pop(name)[order])
+        return len(order)
+
+    @staticmethod
+    def write_meta(path, chroms, generation):
+        '''Written last, so a store is only ever read once complete'''
+        tmp_file = os.path.join(path, 'meta.json.tmp')
+        with open(tmp_file, 'w') as meta_file:
+            json.dump({'chroms': chroms, 'generation': list(generation or [])}, meta_file)
+        os.replace(tmp_file, os.path.join(path, 'meta.json'))
 
 
 class RegulomeAtlas(object):
@@ -57,10 +1031,27 @@ class RegulomeAtlas(object):
     def __init__(
         self,
         region_es,
-        bw_signal_map=LOCAL_BIGWIGS,
+        bw_signal_map=None,
+        msearch_batch_size=REGDB_MSEARCH_BATCH_SIZE,
+        mget_batch_size=REGDB_MGET_BATCH_SIZE,
+        resident_cache=None,
+        resident_table=None,
+        result_cache=None,
+        rsid_indices=None,
+        rsid_fallback=True,
+        score_stores=None,
     ):
         self.region_es = region_es
         self.bw_signal_map = bw_signal_map
+        self.signals = BigWigSignals(bw_signal_map)
+        self.msearch_batch_size = max(msearch_batch_size, 1)
+        self.mget_batch_size = max(mget_batch_size, 1)
+        self.resident_cache = resident_cache
+        self.resident_table = resident_table
+        self.result_cache = result_cache
+        self.rsid_indices = rsid_indices or {}
+        self.rsid_fallback = rsid_fallback
+        self.score_stores = score_stores or {}
 
     def type(self):
         return 'regulome'
@@ -88,6 +1079,29 @@ class RegulomeAtlas(object):
 
         return res['_source']
 
+    def snps(self, assembly, rsids):
+        '''Return {rsid: SNP} for those of the rsids found, in _mget requests of mget_batch_size'''
+        snps = {}
+        for i in range(0, len(rsids), self.mget_batch_size):
+            try:
+                res = self.region_es.mget(
+                    index=snp_index_key(assembly),
+                    body={'ids': rsids[i:i + self.mget_batch_size]}
+                )
+            except Exception:
+                continue
+            for doc in res['docs']:
+                if doc.get('found'):
+                    snps[doc['_id']] = doc['_source']
+        return snps
+
+    def snp_coordinates(self, assembly, rsids):
+        '''Return {rsid: (chrom, start, end)} from the local rsid index, for those it has'''
+        rsid_index = self.rsid_indices.get(assembly)
+        if rsid_index is None:
+            return {}
+        return rsid_index.lookup(rsids)
+
     @staticmethod
     def _range_query(start, end, snps=False, with_inner_hits=False, max_results=SEARCH_MAX):
         '''private: return peak query'''
@@ -137,45 +1151,212 @@ class RegulomeAtlas(object):
 
         return query
 
-    def find_snps(
-        self, assembly, chrom, start, end, max_results=SEARCH_MAX, maf=None
-    ):
-        '''Return all SNPs in a region.'''
+    def _iter_hits(self, index, doc_type, query, results=None):
+        '''private: yields all hits of a query a page at a time, in no particular order.
+           A query whose hits fit the first page takes one plain search.  Only when the
+           first page overflows is a scroll opened, skipping hits already yielded, and
+           cleared when done.  results may pass a first page the caller already has.
+           Scroll as coordinates, an integer_range, has no doc values to search_after on.'''
+        if results is None:
+            results = self.region_es.search(
+                index=index, doc_type=doc_type,
+                body=dict(query, size=REGDB_SCROLL_SIZE, sort=['_doc']),
+            )
+        hits = results['hits']['hits']
+        yield from hits
+        if results['hits']['total'] <= len(hits):
+            return
+        seen = set(hit['_id'] for hit in hits)
+        results = self.region_es.search(
+            index=index, doc_type=doc_type, scroll=REGDB_SCROLL_TIMEOUT,
+            body=dict(query, size=REGDB_SCROLL_SIZE, sort=['_doc']),
+        )
+        scroll_id = results.get('_scroll_id')
+        try:
+            remaining = results['hits']['total']
+            hits = results['hits']['hits']
+            while hits:
+                for hit in hits:
+                    if hit['_id'] not in seen:
+                        yield hit
+                remaining -= len(hits)
+                if remaining <= 0:
+                    break
+                results = self.region_es.scroll(scroll_id, scroll=REGDB_SCROLL_TIMEOUT)
+                scroll_id = results.get('_scroll_id', scroll_id)
+                hits = results['hits']['hits']
+        finally:
+            if scroll_id:
+                self.region_es.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+
+    def iter_snps(self, assembly, chrom, start, end, maf=None):
+        '''Yields all SNPs in a region, streamed from es in pages.'''
         range_query = self._range_query(start, end, snps=True)
         if maf is not None:
             range_query['query']['bool']['filter'].append(
                 {'range': {'maf': {'gte': maf}}}
             )
+        for hit in self._iter_hits(snp_index_key(assembly), chrom, range_query):
+            yield hit['_source']
 
+    def find_snps(
+        self, assembly, chrom, start, end, max_results=SEARCH_MAX, maf=None
+    ):
+        '''Return all SNPs in a region.'''
         try:
-            results = self.region_es.search(index=snp_index_key(assembly), doc_type=chrom,
-                                            _source=True, body=range_query, size=max_results)
+            return list(itertools.islice(
+                self.iter_snps(assembly, chrom, start, end, maf=maf), max_results
+            ))
         except NotFoundError:
             return []
         except Exception:
             return []
 
-        return [hit['_source'] for hit in results['hits']['hits']]
+    def _msearch_responses(self, searches):
+        '''private: runs (header, body) searches in batches of _msearch requests.
+           Returns list of responses (None on failure) in the order of searches.'''
+        results = []
+        for i in range(0, len(searches), self.msearch_batch_size):
+            batch = searches[i:i + self.msearch_batch_size]
+            body = []
+            for header, query in batch:
+                body.extend([header, query])
+            try:
+                responses = self.region_es.msearch(body=body)['responses']
+            except Exception:
+                responses = [{}] * len(batch)
+            for response in responses:
+                if 'error' in response or 'hits' not in response:
+                    results.append(None)
+                else:
+                    results.append(response)
+        return results
+
+    def _msearch(self, searches):
+        '''private: runs (header, body) searches in batches of _msearch requests.
+           Returns list of hits (None on failure) in the order of searches.'''
+        results = []
+        for (header, query), response in zip(searches, self._msearch_responses(searches)):
+            if response is None:
+                results.append(None)
+                continue
+            hits = response['hits']['hits']
+            if response['hits']['total'] > len(hits) and query.get('size', 0) >= SEARCH_MAX:
+                # all hits were asked for but don't fit one response, so stream them instead
+                try:
+                    hits = list(self._iter_hits(
+                        header['index'], header.get('type'), query, results=response
+                    ))
+                except Exception:
+                    hits = None
+            results.append(hits)
+        return results
+
+    def density(self, index, doc_type, start, end, window=REGDB_DENSITY_WINDOW):
+        '''Returns [(window_start, window_end, count)] of hits intersecting each window of
+           a region, counted in one batch of _msearch.  Count is None where es failed.'''
+        windows = [
+            (window_start, min(window_start + window, end))
+            for window_start in range(start, end, window)
+        ]
+        searches = [
+            (
+                {'index': index, 'type': doc_type},
+                self._range_query(window_start, window_end, max_results=0)
+            )
+            for (window_start, window_end) in windows
+        ]
+        return [
+            (window_start, window_end, None if response is None else response['hits']['total'])
+            for ((window_start, window_end), response)
+            in zip(windows, self._msearch_responses(searches))
+        ]
+
+    def _chunks(self, index, doc_type, start, end):
+        '''private: yields (chunk_start, chunk_end) covering all hits of a region.
+           Windows without hits are skipped and the others cut into chunks of about
+           REGDB_SCORE_CHUNK_MAX_HITS hits, assuming hits are even within a window.'''
+        if end - start <= REGDB_SCORE_CHUNK_SIZE:
+            yield (start, end)
+            return
+        for (window_start, window_end, count) in self.density(index, doc_type, start, end):
+            if count == 0:
+                continue
+            if count is None:
+                chunk_size = REGDB_SCORE_CHUNK_SIZE
+            else:
+                chunk_size = max(
+                    (window_end - window_start) * REGDB_SCORE_CHUNK_MAX_HITS // count, 1
+                )
+            for chunk_start in range(window_start, window_end, chunk_size):
+                yield (chunk_start, min(chunk_start + chunk_size, window_end))
+
+    @staticmethod
+    def _chrom_ordered(regions):
+        '''private: returns region indices grouped by chromosome then position'''
+        return sorted(
+            range(len(regions)),
+            key=lambda ix: (regions[ix][0], int(regions[ix][1]))
+        )
+
+    def find_snps_multi(self, assembly, regions, maf=None):
+        '''Return all SNPs for each of a list of (chrom, start, end) regions.
+           Repeated regions are only searched once.'''
+        unique = list(OrderedDict.fromkeys(
+            (chrom, int(start), int(end)) for (chrom, start, end) in regions
+        ))
+        order = self._chrom_ordered(unique)
+        searches = []
+        for ix in order:
+            (chrom, start, end) = unique[ix]
+            range_query = self._range_query(start, end, snps=True)
+            if maf is not None:
+                range_query['query']['bool']['filter'].append(
+                    {'range': {'maf': {'gte': maf}}}
+                )
+            searches.append(
+                ({'index': snp_index_key(assembly), 'type': chrom}, range_query)
+            )
+        found = {}
+        for ix, hits in zip(order, self._msearch(searches)):
+            if hits:
+                found[unique[ix]] = [hit['_source'] for hit in hits]
+        # a fresh list for each region, callers may add to them
+        return [
+            list(found.get((chrom, int(start), int(end)), []))
+            for (chrom, start, end) in regions
+        ]
 
     # def snp_suggest(self, assembly, text):
     # Using suggest with 60M of rsids leads to es crashing during SNP indexing
 
-    def find_peaks(self, assembly, chrom, start, end, peaks_too=False, max_results=SEARCH_MAX):
-        '''Return all peaks intersecting a point'''
-        range_query = self._range_query(start, end, False, peaks_too, max_results)
+    @classmethod
+    def _peak_query(cls, start, end, peaks_too=False, max_results=SEARCH_MAX, profile='detail'):
+        '''private: return peak query with the _source of a REGDB_PEAK_SOURCE_PROFILES profile'''
+        range_query = cls._range_query(start, end, False, peaks_too, max_results)
+        range_query['_source'] = REGDB_PEAK_SOURCE_PROFILES[profile]
+        return range_query
+
+    def iter_peaks(self, assembly, chrom, start, end, peaks_too=False, profile='detail'):
+        '''Yields all peaks intersecting a region, streamed from es in pages.'''
+        range_query = self._peak_query(start, end, peaks_too, profile=profile)
+        yield from self._iter_hits(chrom.lower(), assembly, range_query)
 
+    def find_peaks(self, assembly, chrom, start, end, peaks_too=False, max_results=SEARCH_MAX,
+                   profile='detail'):
+        '''Return all peaks intersecting a point'''
         try:
-            results = self.region_es.search(index=chrom.lower(), doc_type=assembly, _source=True,
-                                            body=range_query, size=max_results)
+            return list(itertools.islice(
+                self.iter_peaks(assembly, chrom, start, end, peaks_too=peaks_too, profile=profile),
+                max_results
+            ))
         except NotFoundError:
             return None
         except Exception:
             return None
 
-        return list(results['hits']['hits'])
-
-    def _resident_details(self, uuids, max_results=SEARCH_MAX):
-        '''private: returns resident details filtered by use.'''
+    def _fetch_resident_details(self, uuids, max_results=SEARCH_MAX):
+        '''private: returns resident details filtered by use, straight from es.'''
         try:
             id_query = {"query": {"ids": {"values": uuids}}}
             res = self.region_es.search(index=RESIDENT_REGIONSET_KEY, body=id_query,
@@ -189,14 +1370,31 @@ class RegulomeAtlas(object):
 
         return details
 
-    def find_peaks_filtered(self, assembly, chrom, start, end, peaks_too=False):
+    def _resident_details(self, uuids, max_results=SEARCH_MAX, compact=False):
+        '''private: returns resident details filtered by use.
+           compact details (just enough for scoring) may come from the preloaded table.'''
+        if compact and self.resident_table is not None:
+            return self.resident_table.get_many(uuids)
+        if self.resident_cache is None:
+            return self._fetch_resident_details(uuids, max_results)
+        (details, missing) = self.resident_cache.get_many(uuids)
+        if missing:
+            fetched = self._fetch_resident_details(missing, max_results)
+            if fetched is None:
+                return None
+            self.resident_cache.put_many(missing, fetched)
+            details.update(fetched)
+        return details
+
+    def find_peaks_filtered(self, assembly, chrom, start, end, peaks_too=False, compact=False,
+                            profile='detail'):
         '''Return peaks in a region and resident details'''
         #TODO I don't know why this also returns details it's not ever used productively
-        peaks = self.find_peaks(assembly, chrom, start, end, peaks_too=peaks_too)
+        peaks = self.find_peaks(assembly, chrom, start, end, peaks_too=peaks_too, profile=profile)
         if not peaks:
             return (peaks, None)
         uuids = list(set([peak['_source']['uuid'] for peak in peaks]))
-        details = self._resident_details(uuids)
+        details = self._resident_details(uuids, compact=compact)
         if not details:
             return ([], details)
         filtered_peaks = []
@@ -208,20 +1406,53 @@ class RegulomeAtlas(object):
                 filtered_peaks.append(peak)
         return (filtered_peaks, details)
 
-    @staticmethod
-    def _peak_uuids_in_overlap(peaks, chrom, start, end=None):
-        '''private: returns set of only the uuids for peaks that overlap a given location'''
-        if end is None:
-            end = start
-
-        overlap = set()
-        for peak in peaks:
-            if chrom == peak['_index'] and \
-                    start <= peak['_source']['coordinates']['lt'] and \
-                    end >= peak['_source']['coordinates']['gte']:
-                overlap.add(peak['_source']['uuid'])
-
-        return overlap
+    def find_peaks_multi(self, assembly, regions, peaks_too=False, max_results=SEARCH_MAX,
+                         profile='detail'):
+        '''Return all peaks for each of a list of (chrom, start, end) regions'''
+        order = self._chrom_ordered(regions)
+        searches = [
+            (
+                {'index': regions[ix][0].lower(), 'type': assembly},
+                self._peak_query(regions[ix][1], regions[ix][2], peaks_too, max_results, profile)
+            )
+            for ix in order
+        ]
+        peaks = [None] * len(regions)
+        for ix, hits in zip(order, self._msearch(searches)):
+            peaks[ix] = hits
+        return peaks
+
+    def find_peaks_filtered_multi(self, assembly, regions, peaks_too=False, compact=False,
+                                  profile='detail'):
+        '''Return (peaks, resident details) for each of a list of (chrom, start, end) regions.
+           Resident details are looked up once for the whole batch.'''
+        all_peaks = self.find_peaks_multi(assembly, regions, peaks_too=peaks_too, profile=profile)
+        uuids = {
+            peak['_source']['uuid']
+            for peaks in all_peaks if peaks
+            for peak in peaks
+        }
+        details = self._resident_details(list(uuids), compact=compact) if uuids else {}
+        results = []
+        for peaks in all_peaks:
+            if not peaks:
+                results.append((peaks, None))
+                continue
+            if not details:
+                results.append(([], details))
+                continue
+            region_details = self._filter_details(details, peaks=peaks)
+            if not region_details:
+                results.append(([], region_details))
+                continue
+            filtered_peaks = []
+            for peak in peaks:
+                uuid = peak['_source']['uuid']
+                if uuid in region_details:
+                    peak['resident_detail'] = region_details[uuid]
+                    filtered_peaks.append(peak)
+            results.append((filtered_peaks, region_details))
+        return results
 
     @staticmethod
     def _filter_details(details, uuids=None, peaks=None):
@@ -292,8 +1523,14 @@ class RegulomeAtlas(object):
             return 'Single_Nucleotides'
         return '???'
 
-    def regulome_evidence(self, datasets, chrom, start, end):
-        '''Returns evidence for scoring: datasets in a characterized dict'''
+    def signal_evidence(self, regions):
+        '''Given (chrom, start, end) regions returns the bigWig signal evidence for each'''
+        return self.signals.means(regions)
+
+    def regulome_evidence(self, datasets, chrom, start, end, signals=None, ranking_only=False):
+        '''Returns evidence for scoring: datasets in a characterized dict.
+           Signals from signal_evidence may be given when read for many regions at once.
+           With ranking_only the bigWig signals, only needed by the model, are not read.'''
         evidence = {}
         targets = {'ChIP': [], 'PWM': [], 'Footprint': []}
         for dataset in datasets.values():
@@ -322,11 +1559,13 @@ class RegulomeAtlas(object):
                     evidence['Footprint_matched'] = []
                 evidence['Footprint_matched'].append(target)
 
+        if ranking_only:
+            return evidence
+
         # Get values/signals from bigWig
-        for k, bw in self.bw_signal_map.items():
-            values = bw.values(chrom, start, end)
-            average = sum(values) / max(len(values), 1)
-            evidence[k] = 0.0 if math.isnan(average) else average
+        if signals is None:
+            signals = self.signal_evidence([(chrom, start, end)])[0]
+        evidence.update(signals)
 
         return evidence
 
@@ -374,6 +1613,8 @@ class RegulomeAtlas(object):
         case = {}
         if 'evidence' in snp:
             for category in snp['evidence'].keys():
+                if category in REGDB_NUMERIC_FEATURES:
+                    continue  # bigWig signals are not listed evidence
                 if category.endswith('_matched'):
                     case[category] = ','.join(snp['evidence'][category])
                 else:
@@ -381,77 +1622,49 @@ class RegulomeAtlas(object):
         return case
 
     @staticmethod
-    def _score(characterization):
-        '''private: returns regulome score from characterization set'''
-        # Predict as probability of being a regulatory SNP from prediction
-        binary_keys = [
-            'ChIP',
-            'DNase',
-            'PWM',
-            'Footprint',
-            'QTL',
-            'PWM_matched',
-            'Footprint_matched'
-        ]
-        query = [int(k in characterization) for k in binary_keys]
-        numeric_keys = ['IC_max', 'IC_matched_max']
-        query += [characterization[k] for k in numeric_keys]
-        # The TRAINED_REG_MODEL is a `sklearn.ensemble.forest.RandomForestClassifier`
+    def evidence_features(characterization):
+        '''Returns the feature vector of a characterization for the trained model'''
+        query = [int(k in characterization) for k in REGDB_BINARY_FEATURES]
+        query += [characterization[k] for k in REGDB_NUMERIC_FEATURES]
+        return query
+
+    @staticmethod
+    def _ranking(characterization):
+        '''private: returns heuristic regulome ranking from characterization set'''
+        return REGDB_RANKINGS[evidence_bits(characterization)]
+
+    @staticmethod
+    def score_features(features):
+        '''Returns regulome scores for a matrix of evidence feature vectors'''
+        # The trained model is a `sklearn.ensemble.forest.RandomForestClassifier`
         # https://scikit-learn.org/stable/modules/generated/sklearn.ensemble.RandomForestClassifier.html
-        # In general, the input of the `predict_proba` method is a matrix of
+        # The input of the `predict_proba` method is a matrix of
         # shape = [n_variants, n_features]. There are two classes for variant
         # in RegulomeDB, being allele-specific TF binding or not. So the output
-        # is an numpy array of shape = [n_samples, 2]. Here, we only do one
-        # variant at a time. So `query` is a list of lists with
-        # shape = [1, n_features] and the output of
-        # `TRAINED_REG_MODEL.predict_proba([query])` is numpy array of
-        # shape = [1, 2]. Specifically, the second column is the probability we
-        # would like to output. So `[:, 1][0]` will be the desired score.
-        probability = str(round(TRAINED_REG_MODEL.predict_proba([query])[:, 1][0], 5))
-        ranking = '7'
-        if 'QTL' in characterization:
-            if 'ChIP' in characterization:
-                if 'DNase' in characterization:
-                    if 'PWM_matched' in characterization and 'Footprint_matched' in characterization:
-                        ranking = '1a'
-                    elif 'PWM' in characterization and 'Footprint' in characterization:
-                        ranking = '1b'
-                    elif 'PWM_matched' in characterization:
-                        ranking = '1c'
-                    elif 'PWM' in characterization:
-                        ranking = '1d'
-                    else:
-                        ranking = '1f'
-                elif 'PWM_matched' in characterization:
-                    ranking = '1e'
-                else:
-                    ranking = '1f'
-            elif 'DNase' in characterization:
-                ranking = '1f'
-            elif 'PWM' in characterization or 'Footprint' in characterization:
-                ranking = '6'
-        elif 'ChIP' in characterization:
-            if 'DNase' in characterization:
-                if 'PWM_matched' in characterization and 'Footprint_matched' in characterization:
-                    ranking = '2a'
-                elif 'PWM' in characterization and 'Footprint' in characterization:
-                    ranking = '2b'
-                elif 'PWM_matched' in characterization:
-                    ranking = '2c'
-                elif 'PWM' in characterization:
-                    ranking = '3a'
-                else:
-                    ranking = '4'
-            elif 'PWM_matched' in characterization:
-                ranking = '3b'
-            else:
-                ranking = '5'
-        elif 'DNase' in characterization:
-            ranking = '5'
-        elif ('PWM' in characterization
-              or 'Footprint' in characterization):
-            ranking = '6'
-        return {'probability': probability, 'ranking': ranking}
+        # is an numpy array of shape = [n_variants, 2]. Specifically, the second
+        # column is the probability we would like to output. Scoring all
+        # variants in one call pays the model's validation and tree traversal
+        # setup only once.
+        features = numpy.asarray(features, dtype=float)
+        if len(features) == 0:
+            return []
+        probabilities = SCORING_RESOURCES.model.predict_proba(features)[:, 1]
+        scores = []
+        weights = 1 << numpy.arange(len(REGDB_BINARY_FEATURES))
+        masks = (features[:, :len(REGDB_BINARY_FEATURES)] != 0).dot(weights)
+        for bits, probability in zip(masks, probabilities):
+            scores.append({
+                'probability': str(round(probability, 5)),
+                'ranking': REGDB_RANKINGS[bits],
+            })
+        return scores
+
+    @staticmethod
+    def _score(characterization):
+        '''private: returns regulome score from characterization set'''
+        return RegulomeAtlas.score_features(
+            [RegulomeAtlas.evidence_features(characterization)]
+        )[0]
 
     def regulome_score(self, datasets, evidence):
         '''Calculate RegulomeDB score based upon hits and voodoo'''
@@ -459,6 +1672,21 @@ class RegulomeAtlas(object):
             return None
         return self._score(evidence)
 
+    @staticmethod
+    def regulome_ranking(evidence):
+        '''Returns the heuristic ranking alone, without the model, for evidence'''
+        if not evidence:
+            return None
+        return REGDB_RANKINGS[evidence_bits(evidence)]
+
+    def regulome_scores(self, evidences):
+        '''Calculate RegulomeDB scores for a list of evidence in one batch'''
+        scorable = [evidence for evidence in evidences if evidence]
+        scores = iter(self.score_features(
+            [self.evidence_features(evidence) for evidence in scorable]
+        ))
+        return [next(scores) if evidence else None for evidence in evidences]
+
     @staticmethod
     def _snp_window(snps, window, center_pos=None):
         '''Reduce a list of snps to a set number of snps centered around position'''
@@ -482,23 +1710,31 @@ class RegulomeAtlas(object):
         snps = self.find_snps(assembly, chrom, start, end)
         if not snps:
             return
+        snps.sort(key=lambda snp: snp['coordinates']['gte'])
         if window > 0:
             snps = self._snp_window(snps, window, center_pos)
 
-        start = snps[0]['coordinates']['gte']  # SNPs must be in location order!
+        start = snps[0]['coordinates']['gte']  # SNPs are in location order
         end = snps[-1]['coordinates']['lt']                                        # MUST do SLOW peaks_too
-        (peaks, details) = self.find_peaks_filtered(assembly, chrom, start, end, peaks_too=True)
+        (peaks, details) = self.find_peaks_filtered(assembly, chrom, start, end, peaks_too=True,
+                                                    compact=True, profile='scoring')
         if not peaks or not details:
             for snp in snps:
                 snp['score'] = None
-                yield snp
-                return
+            yield from snps
+            return
 
+        # All SNPs come from one chromosome query.  Overlaps are half open, as es
+        # matches a single SNP to peaks, so a SNP scores the same either way.
+        overlaps = PeakIntervalIndex(peaks, half_open=True).overlaps(
+            snps[0]['chrom'], [snp['coordinates']['gte'] for snp in snps]
+        )
         last_uuids = {}
-        for snp in snps:
+        scorable = []
+        scorable_datasets = []
+        for snp, snp_uuids in zip(snps, overlaps):
             snp['score'] = None  # default
             snp['assembly'] = assembly
-            snp_uuids = self._peak_uuids_in_overlap(peaks, snp['chrom'], snp['coordinates']['gte'])
             if snp_uuids:
                 # Otherwise datasets hits would be the same
                 if snp_uuids != last_uuids:
@@ -508,26 +1744,39 @@ class RegulomeAtlas(object):
                         (snp_datasets, _snp_files) = self.details_breakdown(snp_details)
                     else:
                         snp_datasets = {}
-                # Regulome evidence now includes signals from bigWig.
-                # Better to recalculate for every new locations.
                 if snp_datasets:
-                    snp_evidence = self.regulome_evidence(
-                        snp_datasets,
-                        snp['chrom'],
-                        snp['coordinates']['gte'],
-                        snp['coordinates']['lt']
-                    )
-                    if snp_evidence:
-                        snp['score'] = self.regulome_score(snp_datasets, snp_evidence)
-                        snp['evidence'] = snp_evidence
-                        yield snp
-                        continue
-            # if we are here this snp had no score
-            yield snp
+                    scorable.append(snp)
+                    scorable_datasets.append(snp_datasets)
+
+        # Regulome evidence includes signals from bigWig, which differ for every location.
+        # They are read for all SNPs of the chunk at once.
+        signals = self.signal_evidence([
+            (snp['chrom'], snp['coordinates']['gte'], snp['coordinates']['lt'])
+            for snp in scorable
+        ])
+        evidences = [
+            self.regulome_evidence(
+                snp_datasets,
+                snp['chrom'],
+                snp['coordinates']['gte'],
+                snp['coordinates']['lt'],
+                signals=snp_signals
+            )
+            for (snp, snp_datasets, snp_signals) in zip(scorable, scorable_datasets, signals)
+        ]
+
+        # Score the whole chunk at once; SNPs without evidence keep no score
+        for snp, snp_evidence, score in zip(
+            scorable, evidences, self.regulome_scores(evidences)
+        ):
+            snp['score'] = score
+            snp['evidence'] = snp_evidence
+        yield from snps
 
     def _scored_regions(self, assembly, chrom, start, end):
         '''For a region, yields sub-regions (start, end, score) of contiguous numeric score > 0'''
-        (peaks, details) = self.find_peaks_filtered(assembly, chrom, start, end, peaks_too=True)
+        (peaks, details) = self.find_peaks_filtered(assembly, chrom, start, end, peaks_too=True,
+                                                    compact=True, profile='scoring')
         if not peaks or not details:
             return
 
@@ -536,15 +1785,14 @@ class RegulomeAtlas(object):
         region_end = 0
         region_score = 0
         num_score = 0
-        for base in range(start, end):
-            base_uuids = self._peak_uuids_in_overlap(peaks, chrom, base)
+        # Every base in a segment overlaps the same peaks, so only the first
+        # base of each segment needs to be considered.
+        for (base, last_base, base_uuids) in PeakIntervalIndex(peaks).segments(chrom, start, end):
             if base_uuids:
-                # For now we will combine nucleotides as long as peaks are the
-                # same. But keep in mind regulome evidence now includes signals
-                # from bigWigs, which are very likely different from nucleotide
-                # to nucleotide.
+                # Nucleotides are combined as long as peaks are the same: the
+                # ranking depends only on which datasets overlap.
                 if base_uuids == last_uuids:
-                    region_end = base  # extend region
+                    region_end = last_base  # extend region
                     continue
                 else:
                     last_uuids = base_uuids
@@ -552,20 +1800,23 @@ class RegulomeAtlas(object):
                     if base_details:
                         (base_datasets, _base_files) = self.details_breakdown(base_details)
                         if base_datasets:
-                            base_evidence = self.regulome_evidence(base_datasets, chrom, start, end)
+                            # Only the ranking is kept in the signal, so neither the
+                            # bigWig signals nor the model are needed.
+                            base_evidence = self.regulome_evidence(base_datasets, chrom, start, end,
+                                                                   ranking_only=True)
                             if base_evidence:
-                                score = self.regulome_score(base_datasets, base_evidence).get('ranking', '')
+                                score = self.regulome_ranking(base_evidence)
                                 if score:
                                     num_score = self.numeric_score(score)
                                     if num_score == region_score:
-                                        region_end = base
+                                        region_end = last_base
                                         continue
                                     if region_score > 0:  # end previous region?
                                         yield (region_start, region_end, region_score)
                                     # start new region
                                     region_score = num_score
                                     region_start = base
-                                    region_end = base
+                                    region_end = last_base
                                     continue
             # if we are here this base had no score
             if region_score > 0:  # end previous region?
@@ -600,38 +1851,38 @@ class RegulomeAtlas(object):
         '''For a region, iteratively yields all SNPs with scores.'''
         if end < start:
             return
-        chunk_size = REGDB_SCORE_CHUNK_SIZE
-        chunk_start = start
-        while chunk_start <= end:
-            chunk_end = chunk_start + chunk_size
-            if chunk_end > end:
-                chunk_end = end
-            yield from self._scored_snps(assembly, chrom, chunk_start, chunk_end)
-            chunk_start += chunk_size
+        for (chunk_start, chunk_end) in self._chunks(snp_index_key(assembly), chrom, start, end):
+            for snp in self._scored_snps(assembly, chrom, chunk_start, chunk_end):
+                # A SNP spanning two chunks is yielded by the chunk it starts in
+                if chunk_start == start or snp['coordinates']['gte'] >= chunk_start:
+                    yield snp
 
     def iter_scored_signal(self, assembly, chrom, start, end):
         '''For a region, iteratively yields all bedGraph styled regions
            of contiguous numeric score.'''
         if end < start:
             return
-        chunk_size = REGDB_SCORE_CHUNK_SIZE
-        chunk_start = start
-        while chunk_start <= end:
-            chunk_end = chunk_start + chunk_size
-            if chunk_end > end:
-                chunk_end = end
+        for (chunk_start, chunk_end) in self._chunks(chrom.lower(), assembly, start, end):
             yield from self._scored_regions(assembly, chrom, chunk_start, chunk_end)
-            chunk_start += chunk_size
 
     def live_score(self, assembly, chrom, pos):
         '''Returns score knowing single position and nothing more.'''
-        (peaks, details) = self.find_peaks_filtered(assembly, chrom, pos, pos)
+        (peaks, details) = self.find_peaks_filtered(assembly, chrom, pos, pos, compact=True,
+                                                    profile='scoring')
         if not peaks or not details:
             return None
         (datasets, _files) = self.details_breakdown(details)
         evidence = self.regulome_evidence(datasets, chrom, pos, pos + 1)
         return self.regulome_score(datasets, evidence)
 
+    def stored_scores(self, assembly, regions):
+        '''Given (chrom, start, end) regions returns (score, features) precomputed for each
+           dbSNP SNP among them, None for the others or when no current store is set up'''
+        store = self.score_stores.get(assembly)
+        if store is None or not store.current():
+            return [None] * len(regions)
+        return store.lookup(regions)
+
     @staticmethod
     def numeric_score(alpha_score):
         '''converst str score to numeric representation (for bedGraph)'''
@@ -1,23 +1,30 @@
 import datetime
+import itertools
+import queue
+import threading
 import urllib3
 from urllib3.util.retry import Retry
 from urllib3.exceptions import MaxRetryError, HTTPError
-import io
 import gzip
 import csv
 import logging
 import json
 import requests
 import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pkg_resources import resource_filename
 from pyramid.settings import asbool
 from pyramid.view import view_config
-from shutil import copyfileobj
 from elasticsearch.exceptions import (
     NotFoundError
 )
 from elasticsearch.helpers import (
-    bulk
+    streaming_bulk
 )
 from sqlalchemy.exc import StatementError
 from snovault.elasticsearch.indexer import (
@@ -54,6 +61,7 @@ log = logging.getLogger(__name__)
 # ##################################
 REGION_INDEXER_SHARDS = 2
 RETRYABLE_STATUS = (500, 502, 504,)
+SCORE_STORE_REBUILDS = {}  # assembly: running generate-scored-snps --store process
 
 
 # TEMPORARY: limit SNPs to major chroms
@@ -66,6 +74,7 @@ SUPPORTED_CHROMOSOMES = [
 ALLOWED_FILE_FORMATS = ['bed']
 RESIDENT_REGIONSET_KEY = 'resident_regionsets'  # keeps track of what datsets are resident
 FOR_REGULOME_DB = 'regulomedb'
+REGULOME_ATLAS = 'regulome_atlas'  # registry key of the app wide RegulomeAtlas
 
 REGULOME_SUPPORTED_ASSEMBLIES = ['hg19', 'GRCh38']
 REGULOME_ALLOWED_STATUSES = ['released', 'archived']  # no 'in progress' permission!
@@ -147,12 +156,29 @@ REGULOME_VALUE_STRAND_COL = {
 # SNP_DATASET_UUID = 'ff8dff4e-1de5-446b-8a13-bb6243bc64aa'  # works on demo, but...
 SNP_INDEX_PREFIX = 'snp_'
 
-# If files are too large then they will be copied locally and read
-MAX_IN_MEMORY_FILE_SIZE = (700 * 1024 * 1024)  # most files will be below this and index faster
-TEMPORARY_REGIONS_FILE = '/tmp/region_temp.bed.gz'
+# Files are streamed and parsed as they download, retrying while the app is unavailable
+REMOTE_READER_RETRIES = Retry(status_forcelist=RETRYABLE_STATUS, backoff_factor=1)
 
-# Max number of SNP docs hold in memory before putting into the index
-MAX_SNP_BULK = 3e6
+# Decompressed files are read and split into lines this many bytes at a time
+READ_BLOCK_SIZE = 1024 * 1024
+# Strands recognized in bed rows
+BED_STRANDS = (b'.', b'+', b'-')
+
+# SNP file progress is checkpointed in the indexer state after about this many rows
+SNP_CHECKPOINT_ROWS = 1000000
+
+# Bulk indexing requests are bounded by both number of docs and serialized size
+REGION_BULK_CHUNK_SIZE = 10000
+REGION_BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+# Files downloaded and parsed concurrently (regionindexer.file_workers in ini)
+REGION_INDEXER_FILE_WORKERS = 1
+# Max number of parsed batches (of REGION_BULK_CHUNK_SIZE docs) waiting to be bulk indexed
+REGION_INDEXER_QUEUE_SIZE = 4
+# A file's regions are only re-added once a running delete of them finished, checked this often
+REGION_DELETE_POLL_INTERVAL = 5
+# and given up on (the file is tried again next cycle) after this many seconds
+REGION_DELETE_WAIT = 3600
 
 
 def includeme(config):
@@ -313,12 +339,13 @@ def regulome_collection_type(dataset):
 class RemoteReader(object):
     # Tools for reading remote files
 
-    def __init__(self):
-        self.temp_file = TEMPORARY_REGIONS_FILE
-        self.max_memory = MAX_IN_MEMORY_FILE_SIZE
+    def __init__(self, maxsize=1):
+        # One pooled client shared by every file (and indexer thread) reading from the app
+        urllib3.disable_warnings()
+        self.http = urllib3.PoolManager(maxsize=maxsize, retries=REMOTE_READER_RETRIES)
 
     def readable_file(self, request, afile):
-        '''returns either an in memory file or a temp file'''
+        '''returns either a local file name or a streaming http response to open_gzip'''
 
         # Special case local instance so that tests can work...
         if asbool(request.registry.settings.get('testing')):
@@ -338,39 +365,32 @@ class RemoteReader(object):
         #     return href
         # assert(afile.get('file_format') == 'bed')
 
-        # Note: this reads the file into an in-memory byte stream.  If files get too large,
-        # We could replace this with writing a temp file, then reading it via gzip and tsvreader.
-        urllib3.disable_warnings()
-        http = urllib3.PoolManager()
-
-        # use afile.get(file_size) to decide between in mem file or temp file
-        file_to_read = None
-        if afile.get('file_size', 0) > self.max_memory:
-            with http.request('GET', href, preload_content=False) \
-                    as r, open(self.temp_file, 'wb') as out_file:
-                copyfileobj(r, out_file)
-            file_to_read = self.temp_file
-            log.warn('Wrote %s to %s', href, file_to_read)
-        else:
-            try:
-                r = http.request('GET', href, retries=Retry(status_forcelist=RETRYABLE_STATUS,
-                                                            backoff_factor=1))
-            except MaxRetryError as e:
-                log.warn(e.reason)
-                log.warn("File (%s or %s) not found" % (afile['@id'], href))
-                raise
-            else:
-                if r.status != 200:
-                    http_error_msg = "STATUS %s: File (%s or %s) not found" % (r.status, afile['@id'], href)
-                    log.warn(http_error_msg)
-                    raise HTTPError(http_error_msg)
-            file_in_mem = io.BytesIO()
-            file_in_mem.write(r.data)
-            file_in_mem.seek(0)
-            file_to_read = file_in_mem
-        r.release_conn()
-
-        return file_to_read
+        try:
+            r = self.http.request('GET', href, preload_content=False)
+        except MaxRetryError as e:
+            log.warn(e.reason)
+            log.warn("File (%s or %s) not found" % (afile['@id'], href))
+            raise
+        if r.status != 200:
+            r.release_conn()
+            http_error_msg = "STATUS %s: File (%s or %s) not found" % (r.status, afile['@id'], href)
+            log.warn(http_error_msg)
+            raise HTTPError(http_error_msg)
+        return r
+
+    @staticmethod
+    @contextmanager
+    def open_gzip(readable_file):
+        '''Decompresses a readable file while it is read,
+           returning a streaming response's connection to the pool when done'''
+        try:
+            with gzip.open(readable_file, mode='rb') as file_handle:
+                yield file_handle
+        finally:
+            if isinstance(readable_file, urllib3.response.HTTPResponse):
+                if not readable_file.closed:
+                    readable_file.close()  # never pool a half read connection
+                readable_file.release_conn()
 
     @staticmethod
     def tsv(file_handle):
@@ -378,6 +398,33 @@ class RemoteReader(object):
         for row in reader:
             yield row
 
+    @staticmethod
+    def row_blocks(file_handle, block_size=READ_BLOCK_SIZE, start=0):
+        '''Splits a binary file handle into rows of bytes columns, a block of lines at a time.
+           Yields (offset, rows) where offset is where the line following the block starts,
+           so reading may later resume there.  Skips blank lines.'''
+        if start:
+            file_handle.seek(start)  # gzip seeks forward by decompressing, without any parsing
+        offset = start
+        rest = b''
+        while True:
+            block = file_handle.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            offset += len(block)
+            yield (offset - len(rest), [line.split(b'\t') for line in lines if line])
+        if rest:
+            yield (offset, [rest.split(b'\t')])
+
+    @classmethod
+    def rows(cls, file_handle, block_size=READ_BLOCK_SIZE):
+        '''Splits a binary file handle into rows of bytes columns.
+           Faster than tsv() on large files, skips blank lines.'''
+        for (_offset, rows) in cls.row_blocks(file_handle, block_size):
+            yield from rows
+
     @staticmethod
     def region(row, value_col=None, strand_col=None):
         '''Read a region from an in memory row and returns chrom and document to index.
@@ -407,7 +454,60 @@ class RemoteReader(object):
         return (chrom, doc)
 
     @staticmethod
-    def snp(row):
+    def region_parser(value_col=None, strand_col=None):
+        '''Returns a function reading a region from a row of bytes, as region() does for str rows.
+           Columns are bound once per file rather than looked up for every row.'''
+        def parse(row):
+            return (row[0].decode(), {'coordinates': {'gte': int(row[1]), 'lt': int(row[2])}})
+
+        if not value_col and not strand_col:
+            return parse
+
+        def parse_value(row):
+            doc = {'coordinates': {'gte': int(row[1]), 'lt': int(row[2])}}
+            if value_col and value_col < len(row):
+                doc['value'] = row[value_col].decode()
+            if strand_col:
+                # Some PWMs annotation doesn't have strand info
+                if strand_col < len(row) and row[strand_col] in BED_STRANDS:
+                    doc['strand'] = row[strand_col].decode()
+                # Temporary hack for Footprint data
+                elif strand_col - 1 < len(row) and row[strand_col - 1] in BED_STRANDS:
+                    doc['strand'] = row[strand_col - 1].decode()
+                else:
+                    doc['strand'] = '.'
+            return (row[0].decode(), doc)
+
+        return parse_value
+
+    @staticmethod
+    def allele_freqs(snp_doc, ref_allele, alt_alleles, freq_tag):
+        '''Adds allele frequencies and maf from a dbSNP FREQ= tag to a SNP document'''
+        ref_allele_freq_map = {ref_allele: {}}
+        alt_allele_freq_map = {}
+        alt_allele_freqs = set()
+        for population_freq in freq_tag.split('|'):
+            population, freqs = population_freq.split(':')
+            ref_freq, *alt_freqs = freqs.split(',')
+            try:
+                ref_allele_freq_map[ref_allele][population] = float(ref_freq)
+            except ValueError:
+                pass
+            for allele, freq_str in zip(alt_alleles, alt_freqs):
+                alt_allele_freq_map.setdefault(allele, {})
+                try:
+                    freq = float(freq_str)
+                except (TypeError, ValueError):
+                    continue
+                alt_allele_freqs.add(freq)
+                alt_allele_freq_map[allele][population] = freq
+        snp_doc['ref_allele_freq'] = ref_allele_freq_map
+        snp_doc['alt_allele_freq'] = alt_allele_freq_map
+        if alt_allele_freqs:
+            snp_doc['maf'] = max(alt_allele_freqs)
+
+    @classmethod
+    def snp(cls, row):
         '''Read a SNP from an in memory row and returns chrom and document to index.'''
         chrom, start, end, rsid = row[0], int(row[1]), int(row[2]), row[3]
         if start == end:
@@ -428,29 +528,34 @@ class RemoteReader(object):
         except IndexError:
             freq_tag = None
         if freq_tag:
-            ref_allele_freq_map = {row[5]: {}}
-            alt_alleles = row[6].split(',')
-            alt_allele_freq_map = {}
-            alt_allele_freqs = set()
-            for population_freq in freq_tag.split('|'):
-                population, freqs = population_freq.split(':')
-                ref_freq, *alt_freqs = freqs.split(',')
-                try:
-                    ref_allele_freq_map[row[5]][population] = float(ref_freq)
-                except ValueError:
-                    pass
-                for allele, freq_str in zip(alt_alleles, alt_freqs):
-                    alt_allele_freq_map.setdefault(allele, {})
-                    try:
-                        freq = float(freq_str)
-                    except (TypeError, ValueError):
-                        continue
-                    alt_allele_freqs.add(freq)
-                    alt_allele_freq_map[allele][population] = freq
-            snp_doc['ref_allele_freq'] = ref_allele_freq_map
-            snp_doc['alt_allele_freq'] = alt_allele_freq_map
-            if alt_allele_freqs:
-                snp_doc['maf'] = max(alt_allele_freqs)
+            cls.allele_freqs(snp_doc, row[5], row[6].split(','), freq_tag)
+        return (chrom, snp_doc)
+
+    @classmethod
+    def snp_bytes(cls, row):
+        '''Read a SNP from a row of bytes, as snp() does for str rows.
+           Only the FREQ= tag of the INFO column is decoded and only when present.'''
+        chrom, start, end = row[0].decode(), int(row[1]), int(row[2])
+        if start == end:
+            end = end + 1
+        snp_doc = {
+            'rsid': row[3].decode(),
+            'chrom': chrom,
+            'coordinates': {
+                'gte': start,
+                'lt': end
+            },
+        }
+        info = row[8]
+        tag_start = info.find(b'FREQ=')
+        while tag_start > 0 and info[tag_start - 1:tag_start] != b';':
+            tag_start = info.find(b'FREQ=', tag_start + 1)
+        if tag_start >= 0:
+            tag_end = info.find(b';', tag_start)
+            freq_tag = info[tag_start + 5:(tag_end if tag_end >= 0 else len(info))]
+            if freq_tag:
+                cls.allele_freqs(snp_doc, row[5].decode(), row[6].decode().split(','),
+                                 freq_tag.decode())
         return (chrom, snp_doc)
 
     # TODO: support bigBeds
@@ -478,6 +583,7 @@ class RegionIndexerState(IndexerState):
         super(RegionIndexerState, self).__init__(es, key, title='region')
         self.files_added_set = self.title + '_files_added'
         self.files_dropped_set = self.title + '_files_dropped'
+        self.region_deletes_id = self.title + '_deletes'  # running delete_by_query tasks
         self.success_set = self.files_added_set
         # Clean these at beginning of next cycle:
         self.cleanup_last_cycle.extend([self.files_added_set, self.files_dropped_set])
@@ -489,7 +595,69 @@ class RegionIndexerState(IndexerState):
         self.list_extend(self.files_added_set, [uuid])
 
     def file_dropped(self, uuid):
-        self.list_extend(self.files_added_set, [uuid])
+        self.list_extend(self.files_dropped_set, [uuid])
+
+    def region_delete_started(self, uuid, task_id):
+        '''Records the task of an asynchronous delete of a file's regions'''
+        deletes = self.get_obj(self.region_deletes_id).get('tasks', [])
+        deletes.append({
+            'task': task_id,
+            'uuid': str(uuid),
+            'started': datetime.datetime.now().isoformat(),
+        })
+        self.put_obj(self.region_deletes_id, {'tasks': deletes})
+
+    def check_region_deletes(self, region_es):
+        '''Forgets region deletes that have finished, logging any failures.
+           Returns the deletes still running.'''
+        deletes = self.get_obj(self.region_deletes_id).get('tasks', [])
+        running = []
+        for delete in deletes:
+            try:
+                task = region_es.tasks.get(task_id=delete['task'])
+            except NotFoundError:
+                log.warn('Region delete task %s of %s is gone', delete['task'], delete['uuid'])
+                continue
+            except Exception:
+                running.append(delete)  # try again next time
+                continue
+            if not task.get('completed', False):
+                running.append(delete)
+                continue
+            response = task.get('response', {})
+            if task.get('error') or response.get('failures'):
+                log.error('Region delete of %s failed: %s', delete['uuid'],
+                          task.get('error') or response['failures'][:3])
+            else:
+                log.info('Deleted %d regions of %s', response.get('deleted', 0), delete['uuid'])
+        if len(running) != len(deletes):
+            self.put_obj(self.region_deletes_id, {'tasks': running})
+        return running
+
+    def wait_for_region_delete(self, region_es, uuid, timeout=None):
+        '''Waits for running deletes of a file's regions, which would also delete its regions
+           if they were added meanwhile.  Raises TimeoutError if they run past timeout.'''
+        timeout = REGION_DELETE_WAIT if timeout is None else timeout
+        begin = time.time()
+        while any(
+            delete['uuid'] == str(uuid) for delete in self.check_region_deletes(region_es)
+        ):
+            if time.time() - begin >= timeout:
+                raise TimeoutError('Regions of %s are still being deleted' % uuid)
+            time.sleep(REGION_DELETE_POLL_INTERVAL)
+
+    def checkpoint_id(self, uuid):
+        return self.title + '_checkpoint_' + str(uuid)
+
+    def get_checkpoint(self, uuid):
+        '''Returns progress of a partially indexed file, or {}'''
+        return self.get_obj(self.checkpoint_id(uuid))
+
+    def put_checkpoint(self, uuid, checkpoint):
+        self.put_obj(self.checkpoint_id(uuid), checkpoint)
+
+    def clear_checkpoint(self, uuid):
+        self.delete_objs([self.checkpoint_id(uuid)])
 
     @staticmethod
     def all_indexable_uuids_set(request):
@@ -595,11 +763,17 @@ class RegionIndexerState(IndexerState):
         state['status'] = 'done'
         state['cycles'] = state.get('cycles', 0) + 1
         state['cycle_took'] = self.elapsed('cycle')
+        state['cycle_finished'] = datetime.datetime.now().isoformat()
 
         self.put(state)
         self._del_is_reindex()
         return state
 
+    def cycle_generation(self):
+        '''Returns (cycles, cycle_finished) which changes whenever a cycle finishes.'''
+        state = self.get()
+        return (state.get('cycles', 0), state.get('cycle_finished'))
+
     @staticmethod
     def counts(region_es, assemblies=None):
         '''returns counts (region files, regulome files, snp files and all files)'''
@@ -627,6 +801,7 @@ class RegionIndexerState(IndexerState):
         display['staged_to_process'] = self.get_count(self.staged_cycles_list)
         display['files_added'] = self.get_count(self.files_added_set)
         display['files_dropped'] = self.get_count(self.files_dropped_set)
+        display['region_deletes'] = self.get_obj(self.region_deletes_id).get('tasks', [])
         return display
 
 
@@ -661,6 +836,11 @@ def regionindexer_state_show(request):
     counts = state.counts(regions_es, REGULOME_SUPPORTED_ASSEMBLIES)
     display['files_in_index'] = counts.get('all_files', 0)
     display['snps_in_index'] = counts.get('SNPs', 0)
+    atlas = request.registry.get(REGULOME_ATLAS)
+    if atlas is not None and atlas.resident_cache is not None:
+        display['resident_cache'] = atlas.resident_cache.stats()  # this process only
+    if atlas is not None and atlas.result_cache is not None:
+        display['result_cache'] = atlas.result_cache.stats()  # hits and misses of this process
 
     if not request.registry.settings.get('testing', False):  # NOTE: _indexer not working on local
         try:
@@ -678,6 +858,45 @@ def regionindexer_state_show(request):
     return display
 
 
+def rebuild_score_stores(settings):
+    '''Starts generate-scored-snps --store in the background for each score store set up,
+       as precomputed scores are not used past the region indexer cycle they were made from.
+       Only with regulome.score_store.rebuild, a rebuild still running from an earlier
+       cycle is stopped first since its scores are already out of date.'''
+    if not asbool(settings.get('regulome.score_store.rebuild', False)):
+        return []
+    config_uri = settings.get('__file__')
+    if config_uri is None:
+        log.error('Score stores not rebuilt: the app was not loaded from a config file')
+        return []
+    processes = int(settings.get('regulome.score_store.rebuild_processes', 1))
+    started = []
+    for assembly in REGULOME_SUPPORTED_ASSEMBLIES:
+        path = settings.get('regulome.score_store.' + assembly)
+        if not path:
+            continue
+        if os.path.basename(os.path.normpath(path)) != assembly:
+            log.error('Score store %s not rebuilt: it must be a directory named %s',
+                      path, assembly)
+            continue
+        running = SCORE_STORE_REBUILDS.pop(assembly, None)
+        if running is not None and running.poll() is None:
+            log.warn('Stopping the out of date rebuild of score store %s', path)
+            os.killpg(running.pid, signal.SIGTERM)  # along with its pool of workers
+            running.wait()
+        SCORE_STORE_REBUILDS[assembly] = subprocess.Popen(
+            [
+                sys.executable, '-m', 'encoded.commands.generate_scored_snps', config_uri,
+                '--store', os.path.dirname(os.path.normpath(path)),
+                '--assembly', assembly, '--processes', str(processes),
+            ],
+            start_new_session=True,
+        )
+        log.info('Rebuilding score store %s', path)
+        started.append(assembly)
+    return started
+
+
 @view_config(route_name='index_region', request_method='POST', permission="index")
 def index_regions(request):
     encoded_es = request.registry[ELASTIC_SEARCH]
@@ -693,6 +912,7 @@ def index_regions(request):
 
     (uuids, force) = state.get_one_cycle(request)
     state.log_reindex_init_state()
+    state.check_region_deletes(indexer.regions_es)
     # Note: if reindex=all_uuids then maybe we should delete the entire index
     # On the otherhand, that should probably be left for extreme cases done by hand
     # curl -XDELETE http://region-search-test-v5.instance.encodedcc.org:9200/resident_datasets/
@@ -710,6 +930,8 @@ def index_regions(request):
         result = state.start_cycle(uuids, result)
         errors = indexer.update_objects(request, uuids, force)
         result = state.finish_cycle(result, errors)
+        # Each finished cycle leaves precomputed scores out of date
+        rebuild_score_stores(request.registry.settings)
         if errors:
             result['errors'] = errors
         if result['indexed'] == 0:  # not unexpected, but worth logging otherwise silent cycle
@@ -737,11 +959,16 @@ class RegionIndexer(Indexer):
         self.residents_index = RESIDENT_REGIONSET_KEY
         # WARNING: updating 'state' could lead to race conditions if more than 1 worker
         self.state = RegionIndexerState(self.encoded_es, self.encoded_INDEX)
-        self.reader = RemoteReader()
+        self.file_workers = int(registry.settings.get(
+            'regionindexer.file_workers', REGION_INDEXER_FILE_WORKERS
+        ))
+        self.reader = RemoteReader(maxsize=self.file_workers)
 
     def update_objects(self, request, uuids, force):
         # pylint: disable=too-many-arguments, unused-argument
         '''Run indexing process on uuids'''
+        if self.file_workers > 1:
+            return self.update_objects_concurrently(request, uuids, force)
         errors = []
         for i, uuid in enumerate(uuids):
             error = self.update_object(request, uuid, force)
@@ -751,10 +978,139 @@ class RegionIndexer(Indexer):
                 log.info('Indexing %d', i + 1)
         return errors
 
-    def update_object(self, request, dataset_uuid, force):
+    @staticmethod
+    def _error(last_exc, dataset_uuid):
+        timestamp = datetime.datetime.now().isoformat()
+        return {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(dataset_uuid)}
+
+    def update_objects_concurrently(self, request, uuids, force):
+        '''Run indexing process on uuids, downloading and parsing files in a pool of workers.
+           Each worker reads the files of one dataset in turn, so that once a file fails the
+           rest of its dataset is skipped as update_object does.  Bulk indexing and all
+           indexer state accounting stay on this thread.'''
+        errors = {}
+        jobs = []
+        datasets_jobs = []
+        for i, dataset_uuid in enumerate(uuids):
+            (dataset, candidate_files, last_exc) = self.candidate_files(request, dataset_uuid)
+            if last_exc is not None:
+                errors[str(dataset_uuid)] = self._error(last_exc, dataset_uuid)
+                continue
+            dataset_jobs = []
+            for afile in candidate_files:
+                using = ""
+                if force:
+                    using = "with FORCE"
+                elif self.in_regions_es(afile['uuid']):
+                    # TODO: update residence doc but not file!
+                    continue
+                file_doc = self.metadata_doc(afile, dataset)
+                # A forced file is removed and read from the beginning once its turn comes
+                checkpoint = None if force else self.resume_file(file_doc)
+                dataset_jobs.append(len(jobs))
+                jobs.append((dataset_uuid, dataset, afile, file_doc, using, checkpoint))
+            if dataset_jobs:
+                datasets_jobs.append(dataset_jobs)
+            if (i + 1) % 1000 == 0:
+                log.info('Indexing %d', i + 1)
+
+        # Workers put (job index, batch of actions) on a bounded queue; None marks the end of a file
+        batches = queue.Queue(maxsize=REGION_INDEXER_QUEUE_SIZE)
+        stopped = threading.Event()
+        failed_datasets = set()  # a file failed: the rest of the dataset is skipped
+
+        def read_file(ix, afile, file_doc, checkpoint):
+            try:
+                chrom_actions = self.file_actions(request, afile, file_doc, checkpoint)
+                while not stopped.is_set() and jobs[ix][0] not in failed_datasets:
+                    batch = list(itertools.islice(chrom_actions, REGION_BULK_CHUNK_SIZE))
+                    if not batch:
+                        break
+                    batches.put((ix, batch))
+            except Exception as e:
+                batches.put((ix, e))
+            else:
+                batches.put((ix, None))
+
+        def read_dataset(dataset_jobs):
+            for ix in dataset_jobs:
+                if stopped.is_set() or jobs[ix][0] in failed_datasets:
+                    batches.put((ix, None))  # skipped
+                    continue
+                (_uuid, _dataset, afile, file_doc, _using, checkpoint) = jobs[ix]
+                read_file(ix, afile, file_doc, checkpoint)
+
+        def fail(ix, e):
+            (dataset_uuid, _dataset, afile, _file_doc, _using, _checkpoint) = jobs[ix]
+            failed_datasets.add(dataset_uuid)
+            log.warn("Fail to index file %s of dataset %s; "
+                     "skip the rest of files in this dataset.",
+                     afile['uuid'], dataset_uuid)
+            errors.setdefault(str(dataset_uuid), self._error(repr(e), dataset_uuid))
+
+        begun = set()
+        with ThreadPoolExecutor(max_workers=self.file_workers) as executor:
+            futures = [
+                executor.submit(read_dataset, dataset_jobs) for dataset_jobs in datasets_jobs
+            ]
+            remaining = len(jobs)
+            try:
+                while remaining > 0:
+                    (ix, batch) = batches.get()
+                    (dataset_uuid, dataset, afile, file_doc, using, _checkpoint) = jobs[ix]
+                    if not isinstance(batch, list):
+                        remaining -= 1
+                    if dataset_uuid in failed_datasets:
+                        continue  # drain what is left of a failed file or a skipped one
+                    if ix not in begun:
+                        begun.add(ix)
+                        if force:
+                            self.remove_from_regions_es(afile['uuid'])  # remove all regions first
+                            self.state.clear_checkpoint(afile['uuid'])
+                            self.resume_file(file_doc)
+                        try:
+                            self.state.wait_for_region_delete(self.regions_es, afile['uuid'])
+                        except Exception as e:
+                            fail(ix, e)
+                            continue
+                    if isinstance(batch, list):
+                        try:
+                            self.index_actions(batch, file_doc)
+                        except Exception as e:
+                            fail(ix, e)
+                        continue
+                    if isinstance(batch, Exception):
+                        fail(ix, batch)
+                        continue
+                    self.flush_file_indices(file_doc)
+                    try:
+                        self.add_to_residence(file_doc)
+                        if file_doc.get('snps', False):
+                            self.state.clear_checkpoint(file_doc['uuid'])
+                    except Exception as e:
+                        fail(ix, e)
+                        continue
+                    log.info("added file: %s %s %s", dataset['accession'], afile['href'], using)
+                    self.state.file_added(afile['uuid'])
+            finally:
+                # Unblock any worker still waiting on the queue before the pool shuts down
+                stopped.set()
+                for future in futures:
+                    future.cancel()
+                while not all(future.done() for future in futures):
+                    try:
+                        batches.get(timeout=1)
+                    except queue.Empty:
+                        pass
+        return list(errors.values())
+
+    def candidate_files(self, request, dataset_uuid):
+        '''Returns (dataset, candidate files, error) for a dataset uuid.
+           Files that are no longer candidates are removed from the region index.'''
         request.datastore = 'elasticsearch'  # Let's be explicit
 
         last_exc = None
+        dataset = None
         try:
             # less efficient than going to es directly but keeps methods in one place
             dataset = request.embed(str(dataset_uuid), as_user=True)
@@ -766,11 +1122,12 @@ class RegionIndexer(Indexer):
             last_exc = repr(e)
 
         if last_exc is None and not self.is_candidate_dataset(dataset):
-            return  # Note if dataset is NO LONGER a candidate its files won't get removed.
+            # Note if dataset is NO LONGER a candidate its files won't get removed.
+            return (dataset, [], None)
 
+        candidate_files = []
         if last_exc is None:
             files = dataset.get('files', [])
-            candidate_files = []
             released_only = False
             for afile in files:
                 # files may not be embedded
@@ -799,23 +1156,33 @@ class RegionIndexer(Indexer):
                     if self.remove_from_regions_es(afile['uuid']):
                         log.warn("dropped file: %s %s", dataset['accession'], afile['@id'])
                         self.state.file_dropped(afile['uuid'])
+            if released_only:
+                candidate_files = [
+                    afile for afile in candidate_files
+                    if afile.get('status', 'unknown') == 'released'
+                ]
+
+        return (dataset, candidate_files, last_exc)
+
+    def update_object(self, request, dataset_uuid, force):
+        (dataset, candidate_files, last_exc) = self.candidate_files(request, dataset_uuid)
 
         if last_exc is None:
             for afile in candidate_files:
-                if released_only and afile.get('status', 'unknown') != 'released':
-                    continue
                 file_uuid = afile['uuid']
                 file_doc = self.metadata_doc(afile, dataset)
                 using = ""
                 if force:
                     using = "with FORCE"
                     self.remove_from_regions_es(file_uuid)  # remove all regions first
+                    self.state.clear_checkpoint(file_uuid)
                 else:
                     if self.in_regions_es(file_uuid):
                         # TODO: update residence doc but not file!
                         continue
 
                 try:
+                    self.state.wait_for_region_delete(self.regions_es, file_uuid)
                     self.add_file_to_regions_es(request, afile, file_doc)
                 except Exception as e:
                     log.warn("Fail to index file %s of dataset %s; "
@@ -828,8 +1195,7 @@ class RegionIndexer(Indexer):
                     self.state.file_added(file_uuid)
 
         if last_exc is not None:
-            timestamp = datetime.datetime.now().isoformat()
-            return {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(dataset_uuid)}
+            return self._error(last_exc, dataset_uuid)
 
     @staticmethod
     def check_embedded_targets(request, dataset):
@@ -1017,14 +1383,21 @@ class RegionIndexer(Indexer):
                 log.error("Region indexer failed to delete %s index" % (doc['index']))
                 return False   # Will try next full cycle
         else:
-            for chrom in doc['chroms']:  # Could just try index='chr*'
-                try:
-                    self.regions_es.delete(index=chrom.lower(), doc_type=doc['assembly'],
-                                           id=str(uuid))
-                except Exception:
-                    # log.error("Region indexer failed to remove %s regions of %s" % (chrom, uuid))
-                    # return False # Will try next full cycle
-                    pass
+            # Regions have ids uuid-<n>, so they are deleted by uuid in the background.
+            # Stale peaks are harmless meanwhile: scoring drops peaks of non-resident files.
+            # Adding the file again waits for the delete (wait_for_region_delete).
+            try:
+                task = self.regions_es.delete_by_query(
+                    index='chr*',
+                    doc_type=doc['assembly'],
+                    body={'query': {'term': {'uuid': str(uuid)}}},
+                    conflicts='proceed',  # skip regions changed since the delete began
+                    wait_for_completion=False,
+                )
+            except Exception:
+                log.error("Region indexer failed to start removing regions of %s" % (uuid))
+                return False  # Will try next full cycle
+            self.state.region_delete_started(uuid, task['task'])
 
         try:
             self.regions_es.delete(index=self.residents_index, doc_type=use_type, id=str(uuid))
@@ -1054,150 +1427,164 @@ class RegionIndexer(Indexer):
                               id=str(uuid))
         return True
 
-    @staticmethod
-    def region_bulk_iterator(chrom, assembly, uuid, docs_for_chrom):
-        '''Given yields peaks packaged for bulk indexing'''
-        for idx, doc in enumerate(docs_for_chrom):
-            doc['uuid'] = uuid
-            yield {'_index': chrom, '_type': assembly, '_id': uuid+'-'+str(idx), '_source': doc}
-
-    def index_regions(self, assembly, regions, file_doc, chroms):
-        '''Given regions from some source (most likely encoded file)
-           loads the data into region search es'''
-        uuid = file_doc['uuid']
-
-        if chroms is None:
-            chroms = list(regions.keys())
-
-        for chrom in list(regions.keys()):
+    def prepare_index(self, chrom, file_doc):
+        '''Makes sure the index and mapping for a file's chromosome exist in region search es'''
+        assembly = file_doc['file']['assembly']
+        if file_doc.get('snps', False):
+            snp_index = snp_index_key(assembly)
+            file_doc['index'] = snp_index
+            if not self.regions_es.indices.exists(snp_index):
+                self.regions_es.indices.create(index=snp_index, body=index_settings())
+            if not self.regions_es.indices.exists_type(index=snp_index, doc_type=chrom):
+                mapping = get_snp_index_mapping(chrom)
+                self.regions_es.indices.put_mapping(index=snp_index, doc_type=chrom, body=mapping)
+        else:
             chrom_lc = chrom.lower()
             # Could be a chrom never seen before!
             if not self.regions_es.indices.exists(chrom_lc):
                 self.regions_es.indices.create(index=chrom_lc, body=index_settings())
-
             if not self.regions_es.indices.exists_type(index=chrom_lc, doc_type=assembly):
                 mapping = get_chrom_index_mapping(assembly)
                 self.regions_es.indices.put_mapping(index=chrom_lc, doc_type=assembly, body=mapping)
-
-            if len(regions[chrom]) == 0:
-                continue
-            bulk(self.regions_es,
-                 self.region_bulk_iterator(chrom_lc, assembly, uuid, regions[chrom]), chunk_size=500000)
-
-            file_doc['chroms'].append(chrom)
-
-            try:  # likely millions per chrom, so
-                self.regions_es.indices.flush_synced(index=chrom)
-            except Exception:
-                pass
-
-        return True
-
-    @staticmethod
-    def snps_bulk_iterator(snp_index, chrom, snps_for_chrom):
-        '''Given SNPs yields snps packaged for bulk indexing'''
-        for snp in snps_for_chrom:
-            yield {'_index': snp_index, '_type': chrom, '_id': snp['rsid'], '_source': snp}
-
-    def index_snps(self, assembly, snps, file_doc, chroms=None):
-        '''Given SNPs from file loads the data into region search es'''
-        snp_index = snp_index_key(assembly)
-        file_doc['index'] = snp_index
-
-        if not self.regions_es.indices.exists(snp_index):
-            self.regions_es.indices.create(index=snp_index, body=index_settings())
-
-        if chroms is None:
-            chroms = list(snps.keys())
-        for chrom in chroms:
-            if len(snps[chrom]) == 0:
-                continue
-            if not self.regions_es.indices.exists_type(index=snp_index, doc_type=chrom):
-                mapping = get_snp_index_mapping(chrom)
-                self.regions_es.indices.put_mapping(index=snp_index, doc_type=chrom, body=mapping)
-            # indexing in bulk 500K snps at a time...
-            bulk(self.regions_es,
-                 self.snps_bulk_iterator(snp_index, chrom, snps[chrom]), chunk_size=500000)
-            file_doc['chroms'].append(chrom)
-
-            try:  # likely millions per chrom, so
-                self.regions_es.indices.flush_synced(index=snp_index)
+        file_doc['chroms'].append(chrom)
+
+    def index_actions(self, chrom_actions, file_doc):
+        '''Given (chrom, action) pairs from file_actions streams them into region search es,
+           preparing indices for chromosomes as they are first seen.
+           A (None, checkpoint) pair is saved once every action before it has been indexed.'''
+        checkpoints = []  # (actions sent before it, checkpoint)
+        sent = 0
+
+        def actions():
+            nonlocal sent
+            last_chrom = None
+            for (chrom, action) in chrom_actions:
+                if chrom is None:
+                    checkpoints.append((sent, action))
+                    continue
+                if chrom != last_chrom:
+                    if chrom not in file_doc['chroms']:
+                        self.prepare_index(chrom, file_doc)
+                    last_chrom = chrom
+                sent += 1
+                yield action
+
+        count = 0
+        for _ok, _item in streaming_bulk(self.regions_es, actions(),
+                                         chunk_size=REGION_BULK_CHUNK_SIZE,
+                                         max_chunk_bytes=REGION_BULK_MAX_CHUNK_BYTES):
+            count += 1
+            while checkpoints and checkpoints[0][0] <= count:
+                self.save_checkpoint(file_doc, checkpoints.pop(0)[1])
+        for (_sent, checkpoint) in checkpoints:
+            self.save_checkpoint(file_doc, checkpoint)
+        return count
+
+    def save_checkpoint(self, file_doc, checkpoint):
+        '''Records how far a file has been indexed so an interrupted file may resume there'''
+        checkpoint['chroms'] = list(file_doc['chroms'])
+        checkpoint['index'] = file_doc.get('index')
+        self.state.put_checkpoint(file_doc['uuid'], checkpoint)
+
+    def resume_file(self, file_doc):
+        '''Returns the checkpoint of a partially indexed SNP file, restoring its file_doc.
+           Returns None if the file should be read from the beginning.'''
+        file_doc['chroms'] = []
+        if not file_doc.get('snps', False):
+            return None
+        checkpoint = self.state.get_checkpoint(file_doc['uuid'])
+        if not checkpoint:
+            return None
+        file_doc['chroms'] = checkpoint['chroms']
+        if checkpoint.get('index'):
+            file_doc['index'] = checkpoint['index']
+        return checkpoint
+
+    def flush_file_indices(self, file_doc):
+        '''Flushes the indices a file was loaded into; likely millions of docs'''
+        if 'index' in file_doc:
+            indices = [file_doc['index']]
+        else:
+            indices = [chrom.lower() for chrom in file_doc['chroms']]
+        for index in indices:
+            try:
+                self.regions_es.indices.flush_synced(index=index)
             except Exception:
                 pass
-            log.warn('Added %s/%s %d docs', snp_index, chrom, len(snps[chrom]))
-
-        return True
 
-    def add_file_to_regions_es(self, request, afile, file_doc, snp=False):
-        '''Given an encoded file object, reads the file to create regions data
-           then loads that into region search es.'''
+    def file_actions(self, request, afile, file_doc, checkpoint=None):
+        '''Given an encoded file object, reads the file and yields (chrom, action) pairs
+           of regions data packaged for bulk indexing into region search es.
+           SNP files also yield (None, checkpoint) pairs once the actions before them may be
+           checkpointed, and resume reading from a prior checkpoint when given one.'''
 
         assembly = file_doc['file']['assembly']
+        uuid = file_doc['uuid']
         snp_set = file_doc.get('snps', False)
+        if snp_set:
+            snp_index = snp_index_key(assembly)
         # ############### TEMPORARY  because snps take so long!
         # if snp_set:
         #     file_doc['chroms'] = SUPPORTED_CHROMOSOMES
         #     file_doc['index'] = snp_index_key(assembly)
         #     return self.add_to_residence(file_doc)
         # ############### TEMPORARY
-        big_file = (afile.get('file_size', 0) > MAX_IN_MEMORY_FILE_SIZE)
-        file_doc['chroms'] = []
-
         readable_file = self.reader.readable_file(request, afile)
 
-        file_data = {}
-        chroms = []
+        if snp_set:
+            parse_row = self.reader.snp_bytes
+        else:
+            parse_row = self.reader.region_parser(
+                **REGULOME_VALUE_STRAND_COL.get(file_doc['dataset']['collection_type'], {})
+            )
+
+        region_ids = {}  # next region id per chrom
+        count = 0
+        checkpoint = checkpoint or {}
+        start = checkpoint.get('offset', 0)
+        rows = checkpoint.get('rows', 0)
+        checkpointed = rows
+        if start:
+            log.warn('%s resuming at row %d', afile['href'], rows)
         if afile['file_format'] == 'bed':
-            # NOTE: requests doesn't require gzip but http.request does.
-            with gzip.open(readable_file, mode='rt') as file_handle:
-                for row in self.reader.tsv(file_handle):
-                    if row[0].startswith('#'):
-                        continue
-                    try:
+            with self.reader.open_gzip(readable_file) as file_handle:
+                for (offset, block) in self.reader.row_blocks(file_handle, start=start):
+                    rows += len(block)
+                    for row in block:
+                        if row[0].startswith(b'#'):
+                            continue
+                        try:
+                            (chrom, doc) = parse_row(row)
+                        except Exception:
+                            log.error('%s - failure to parse row %s, skipping row',
+                                      afile['href'], b':'.join(row[:3]).decode(errors='replace'))
+                            continue
+                        if doc['coordinates']['gte'] == doc['coordinates']['lt']:
+                            log.error(
+                                '%s - on chromosome %s, a start coordinate %s is '
+                                'larger than or equal to the end coordinate %s, '
+                                'skipping row',
+                                afile['href'],
+                                chrom,
+                                doc['coordinates']['gte'],
+                                doc['coordinates']['lt']
+                            )
+                            continue  # Skip for 63 invalid peak in a non-ENCODE ChIP-seq result, exo_HelaS3.CTCF.bed.gz
+                        if chrom not in SUPPORTED_CHROMOSOMES:
+                            continue   # TEMPORARY: limit both SNPs and regions to major chroms
+                        count += 1
                         if snp_set:
-                            (chrom, doc) = self.reader.snp(row)
+                            yield (chrom, {'_index': snp_index, '_type': chrom, '_id': doc['rsid'],
+                                           '_source': doc})
                         else:
-                            (chrom, doc) = self.reader.region(
-                                row,
-                                value_col=REGULOME_VALUE_STRAND_COL.get(
-                                    file_doc['dataset']['collection_type'], {}
-                                ).get('value_col'),
-                                strand_col=REGULOME_VALUE_STRAND_COL.get(
-                                    file_doc['dataset']['collection_type'], {}
-                                ).get('strand_col')
-                            )
-                    except Exception:
-                        log.error('%s - failure to parse row %s:%s:%s, skipping row',
-                                  afile['href'], row[0], row[1], row[2])
-                        continue
-                    if doc['coordinates']['gte'] == doc['coordinates']['lt']:
-                        log.error(
-                            '%s - on chromosome %s, a start coordinate %s is '
-                            'larger than or equal to the end coordinate %s, '
-                            'skipping row',
-                            afile['href'],
-                            row[0],
-                            row[1],
-                            row[2]
-                        )
-                        continue  # Skip for 63 invalid peak in a non-ENCODE ChIP-seq result, exo_HelaS3.CTCF.bed.gz
-                    if chrom not in SUPPORTED_CHROMOSOMES:
-                        continue   # TEMPORARY: limit both SNPs and regions to major chroms
-                    if (chrom not in file_data) or (len(file_data[chrom]) > MAX_SNP_BULK):
-                        # we are done with current chromosome and move on
-                        # 1 chrom at a time saves memory (but assumes the files are in chrom order!)
-                        if big_file and file_data and len(chroms) > 0:
-                            if snp_set:
-                                self.index_snps(assembly, file_data, file_doc,
-                                                list(file_data.keys()))
-                            else:
-                                self.index_regions(assembly, file_data, file_doc,
-                                                   list(file_data.keys()))
-                            file_data = {}  # Don't hold onto data already indexed
-                        file_data[chrom] = []
-                        if len(chroms) == 0 or chroms[-1] != chrom:
-                            chroms.append(chrom)
-                    file_data[chrom].append(doc)
+                            idx = region_ids.get(chrom, 0)
+                            region_ids[chrom] = idx + 1
+                            doc['uuid'] = uuid
+                            yield (chrom, {'_index': chrom.lower(), '_type': assembly,
+                                           '_id': uuid + '-' + str(idx), '_source': doc})
+                    if snp_set and rows - checkpointed >= SNP_CHECKPOINT_ROWS:
+                        checkpointed = rows
+                        yield (None, {'offset': offset, 'rows': rows})
         # TODO: Handle bigBeds...
         # elif afile['file_format'] == 'bedBed':  # Use pyBigWig?
         #    import pyBigWig  # https://github.com/deeptools/pyBigWig
@@ -1215,18 +1602,20 @@ class RegionIndexer(Indexer):
         #                    log.error('%s - failure to parse row %s:%s:%s, skipping row', \
         #                                                    afile['href'], chrom, row[0], row[1])
         # Could redesign with reader class, so this function is entirely ignorant of bed v. bigBed
-        # However, probably not worth as much as just abstracting the file_data building/indexing
 
-        if len(chroms) == 0 or not file_data:
+        if count == 0 and not start:
             raise IOError('Error parsing file %s' % afile['href'])
 
-        # Note if indexing by chrom (snp_set or big_file) then file_data will only have one chrom
-        if snp_set:
-            self.index_snps(assembly, file_data, file_doc, list(file_data.keys()))
-        else:
-            self.index_regions(assembly, file_data, file_doc, list(file_data.keys()))
-
-        if big_file and file_doc['chroms'] != chroms:
-            log.error('%s chromosomes %s indexed out of order!', file_doc['file']['@id'],
-                      ('SNPs' if snp_set else 'regions'))
-        return self.add_to_residence(file_doc)
+    def add_file_to_regions_es(self, request, afile, file_doc, snp=False):
+        '''Given an encoded file object, reads the file to create regions data
+           then streams that into region search es.'''
+        checkpoint = self.resume_file(file_doc)
+        count = self.index_actions(
+            self.file_actions(request, afile, file_doc, checkpoint), file_doc
+        )
+        self.flush_file_indices(file_doc)
+        log.info('Added %d docs from %s', count, afile['href'])
+        self.add_to_residence(file_doc)
+        if file_doc.get('snps', False):
+            self.state.clear_checkpoint(file_doc['uuid'])
+        return True
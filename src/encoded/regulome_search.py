@@ -3,17 +3,28 @@ from pyramid.httpexceptions import HTTPTemporaryRedirect
 from pyramid.view import view_config
 from snovault.elasticsearch.interfaces import (
     ELASTIC_SEARCH,
-    SNP_SEARCH_ES
 )
-from .regulome_atlas import RegulomeAtlas
+from .regulome_atlas import (
+    REGULOME_ATLAS,
+    REGDB_RESIDENT_CACHE_CHECK_INTERVAL,
+)
+from .regulome_indexer import RegionIndexerState
 from .vis_defines import (
     vis_format_url
 )
 import requests
 from urllib.parse import urlencode
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
+import os
 import re
+import sqlite3
+import tempfile
+import threading
 import time
 
 log = logging.getLogger(__name__)
@@ -46,6 +57,16 @@ _GENOME_TO_ALIAS = {
     'GRCh38': 'GRCh38',
 }
 
+REGULOME_SEARCH_POOL = 'regulome_search_pool'  # registry key of the thread pool for es lookups
+REGDB_SEARCH_WORKERS = 8
+
+REGULOME_QUERY_SESSIONS = 'regulome_query_sessions'  # registry key of resolved region queries
+REGDB_QUERY_SESSION_CAPACITY = 20
+REGDB_QUERY_SESSION_MAX_AGE = 3600  # seconds
+
+# Variants of a summary scored together: one batch of es requests and one model prediction each
+REGDB_SUMMARY_BATCH_SIZE = 1000
+
 
 def includeme(config):
     config.add_route('regulome-home', '/')
@@ -53,21 +74,210 @@ def includeme(config):
     config.add_route('regulome-search', '/regulome-search{slash:/?}')
     config.add_route('suggest', '/suggest{slash:/?}')
     config.add_route('jbrest', '/jbrest/snp141/{assembly}/{cmd}/{chrom}{slash:/?}')
+    settings = config.registry.settings
+    generation = None
+    if ELASTIC_SEARCH in config.registry:
+        # resolved queries only change when the region indexer finishes a cycle
+        generation = RegionIndexerState(
+            config.registry[ELASTIC_SEARCH], settings['snovault.elasticsearch.index']
+        ).cycle_generation
+    session_options = {
+        'capacity': int(settings.get(
+            'regulome.query_sessions.capacity', REGDB_QUERY_SESSION_CAPACITY
+        )),
+        'max_age': float(settings.get(
+            'regulome.query_sessions.max_age', REGDB_QUERY_SESSION_MAX_AGE
+        )),
+        'generation': generation,
+        'check_interval': float(settings.get(
+            'regulome.resident_cache.check_interval', REGDB_RESIDENT_CACHE_CHECK_INTERVAL
+        )),
+    }
+    if settings.get('regulome.query_sessions', 'memory') == 'sqlite':
+        config.registry[REGULOME_QUERY_SESSIONS] = SqliteQuerySessions(
+            settings.get('regulome.query_sessions.path') or os.path.join(
+                tempfile.gettempdir(), 'regulome_query_sessions.sqlite'
+            ),
+            **session_options
+        )
+    else:
+        config.registry[REGULOME_QUERY_SESSIONS] = QuerySessions(**session_options)
+    workers = int(config.registry.settings.get('regulome.search_workers', REGDB_SEARCH_WORKERS))
+    if workers > 0:
+        # threads only start on first use, so this is safe before workers fork
+        config.registry[REGULOME_SEARCH_POOL] = ThreadPoolExecutor(max_workers=workers)
     config.scan(__name__)
 
 
+class QuerySessions(object):
+    '''Process-local LRU of resolved region queries, keyed by a digest of the query.
+
+    A large submission is resolved once, then each page of it is sliced from the
+    session.  Sessions expire after max_age seconds, and all are dropped whenever
+    the region indexer finishes a cycle.  Only the process that resolved a query
+    knows its session: where several processes serve requests, SqliteQuerySessions
+    lets a page sending only the session key reach any of them.
+    '''
+
+    def __init__(self, capacity=REGDB_QUERY_SESSION_CAPACITY,
+                 max_age=REGDB_QUERY_SESSION_MAX_AGE, generation=None,
+                 check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self._sessions = OrderedDict()  # key: (created, session)
+        self._generation = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(assembly, region_queries, maf=None):
+        '''Returns the session key of a normalized query'''
+        query = json.dumps([assembly, region_queries, maf])
+        return hashlib.sha1(query.encode()).hexdigest()
+
+    def _validate(self):
+        '''private: drops all sessions if the region indexer finished a cycle since last check'''
+        if self.generation is None:
+            return
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            generation = self.generation()
+        except Exception:
+            return
+        if generation != self._generation:
+            with self._lock:
+                self._sessions.clear()
+                self._generation = generation
+
+    def get(self, key):
+        '''Returns the session of a key, or None if unknown or expired'''
+        self._validate()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return None
+            (created, session) = entry
+            if time.time() - created > self.max_age:
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return session
+
+    def put(self, key, session):
+        self._validate()
+        with self._lock:
+            self._sessions[key] = (time.time(), session)
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+
+
+class SqliteQuerySessions(object):
+    '''Resolved region queries in a local sqlite file shared by all processes of a host.
+
+    Same interface as QuerySessions, so a later page sending only the session key
+    is served by whichever process gets it.  Sessions of an older indexer generation
+    are deleted by the first process noticing the change.  Beyond capacity the least
+    recently used sessions are dropped.
+    '''
+
+    def __init__(self, path, capacity=REGDB_QUERY_SESSION_CAPACITY,
+                 max_age=REGDB_QUERY_SESSION_MAX_AGE, generation=None,
+                 check_interval=REGDB_RESIDENT_CACHE_CHECK_INTERVAL):
+        self.path = path
+        self.capacity = capacity
+        self.max_age = max_age
+        self.generation = generation  # callable returning current indexer generation
+        self.check_interval = check_interval
+        self._connection = None  # opened on first use, after workers fork
+        self._checked = None
+        self._lock = threading.Lock()
+
+    key = staticmethod(QuerySessions.key)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(key TEXT PRIMARY KEY, created REAL, used REAL, value TEXT)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)'
+            )
+            self._connection.commit()
+        return self._connection
+
+    def _validate(self):
+        '''private: drops all sessions if the region indexer finished a cycle since last check'''
+        if self.generation is None:
+            return
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            generation = json.dumps(self.generation())
+        except Exception:
+            return
+        with self._lock, self.connection as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE name = 'generation'"
+            ).fetchone()
+            if row is None or row[0] != generation:
+                connection.execute('DELETE FROM sessions')
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,)
+                )
+
+    def get(self, key):
+        '''Returns the session of a key, or None if unknown or expired'''
+        self._validate()
+        now = time.time()
+        with self._lock, self.connection as connection:
+            row = connection.execute(
+                'SELECT created, value FROM sessions WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            (created, session) = row
+            if now - created > self.max_age:
+                connection.execute('DELETE FROM sessions WHERE key = ?', (key,))
+                return None
+            connection.execute('UPDATE sessions SET used = ? WHERE key = ?', (now, key))
+        return json.loads(session)
+
+    def put(self, key, session):
+        self._validate()
+        now = time.time()
+        with self._lock, self.connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                (key, now, now, json.dumps(session))
+            )
+            connection.execute(
+                'DELETE FROM sessions WHERE key NOT IN '
+                '(SELECT key FROM sessions ORDER BY used DESC LIMIT ?)',
+                (self.capacity,)
+            )
+
+
 @view_config(route_name='regulome-home', request_method='GET')
 def regulome_home(context, request):
     raise HTTPTemporaryRedirect(location='/regulome-search/')
 
 
-def region_get_hits(atlas, assembly, chrom, start, end, peaks_too=False):
-    '''Returns a list of file uuids AND dataset paths for chromosome location'''
+def _region_hits(atlas, peaks, peak_details, peaks_too=False):
+    '''private: Returns hits summary from filtered peaks and their resident details'''
 
     all_hits = {}  # { 'dataset_paths': [], 'files': {}, 'datasets': {}, 'peaks': [], 'message': ''}
 
-    (peaks, peak_details) = atlas.find_peaks_filtered(_GENOME_TO_ALIAS[assembly], chrom, start, end,
-                                                      peaks_too)
     if not peaks:
         return {'message': 'No hits found in this location'}
     if peak_details is None:
@@ -92,6 +302,57 @@ def region_get_hits(atlas, assembly, chrom, start, end, peaks_too=False):
     return all_hits
 
 
+def region_get_hits(atlas, assembly, chrom, start, end, peaks_too=False):
+    '''Returns a list of file uuids AND dataset paths for chromosome location'''
+    (peaks, peak_details) = atlas.find_peaks_filtered(_GENOME_TO_ALIAS[assembly], chrom, start, end,
+                                                      peaks_too)
+    return _region_hits(atlas, peaks, peak_details, peaks_too)
+
+
+def region_stored_score(atlas, assembly, chrom, start, end):
+    '''Returns the precomputed (score, features) of a scored dbSNP SNP, or None'''
+    stored_score = atlas.stored_scores(
+        _GENOME_TO_ALIAS.get(assembly, 'hg19'), [(chrom, start, end)]
+    )[0]
+    if stored_score is None or not stored_score[0]:
+        return None  # without evidence the live search reports why
+    return stored_score
+
+
+def _timed_stage(func, args, kwargs):
+    '''private: runs a stage returning (result, exception, seconds)'''
+    begin = time.time()
+    try:
+        return (func(*args, **kwargs), None, time.time() - begin)
+    except Exception as e:
+        return (None, e, time.time() - begin)
+
+
+def run_stages(pool, stages):
+    '''Runs independent {name: (func, args, kwargs)} stages, all at once on the pool if given.
+       Returns {name: (result, exception, seconds)}'''
+    if pool is None:
+        return OrderedDict(
+            (name, _timed_stage(*stage)) for (name, stage) in stages.items()
+        )
+    futures = OrderedDict(
+        (name, pool.submit(_timed_stage, *stage)) for (name, stage) in stages.items()
+    )
+    return OrderedDict((name, future.result()) for (name, future) in futures.items())
+
+
+def regions_get_hits(atlas, assembly, regions, peaks_too=False, compact=False,
+                     profile='detail'):
+    '''Returns region_get_hits results for each of a list of (chrom, start, end) regions,
+       using batched es requests'''
+    return [
+        _region_hits(atlas, peaks, peak_details, peaks_too)
+        for (peaks, peak_details) in atlas.find_peaks_filtered_multi(
+            _GENOME_TO_ALIAS[assembly], regions, peaks_too, compact=compact, profile=profile
+        )
+    ]
+
+
 def sanitize_coordinates(term):
     ''' Sanitize the input string and return coordinates '''
 
@@ -192,6 +453,35 @@ def get_rsid_coordinates(rsid, assembly, atlas=None, webfetch=True):
         return ('', '', '',)
 
 
+def resolve_rsids(rsids, assembly, atlas=None, webfetch=True):
+    '''Returns {rsid: (chrom, start, end)} for many rsids at once.
+       The local rsid index answers in one batch.  Only rsids it lacks fall back,
+       if the atlas allows, to batched es _mget and then to Ensembl one by one.
+       Unresolved rsids map to blanks.'''
+    coordinates = {}
+    if atlas is not None:
+        coordinates.update(atlas.snp_coordinates(_GENOME_TO_ALIAS.get(assembly), rsids))
+        missing = [rsid for rsid in rsids if rsid not in coordinates]
+        if not atlas.rsid_fallback:
+            coordinates.update((rsid, ('', '', '')) for rsid in missing)
+            return coordinates
+        if missing and assembly in ['GRCh38', 'hg19', 'GRCh37']:
+            for rsid, snp in atlas.snps(_GENOME_TO_ALIAS[assembly], missing).items():
+                try:
+                    coordinates[rsid] = (
+                        snp['chrom'], snp['coordinates']['gte'], snp['coordinates']['lt']
+                    )
+                except KeyError as e:
+                    log.warning("Could not find %s on %s, using ensemble" % (rsid, assembly))
+                    if not webfetch:
+                        log.error("Do not lookup: %s", e)
+                        raise
+    for rsid in rsids:
+        if rsid not in coordinates:
+            coordinates[rsid] = get_rsid_coordinates(rsid, assembly)
+    return coordinates
+
+
 def get_ensemblid_coordinates(eid, assembly):
     species = _GENOME_TO_SPECIES.get(assembly, 'homo_sapiens')
     url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
@@ -255,7 +545,7 @@ def update_viusalize(result, assembly, dataset_paths, file_statuses):
     return {assembly: vis_assembly}
 
 
-def get_coordinate(query_term, assembly='GRCh37', atlas=None):
+def get_coordinate(query_term, assembly='GRCh37', atlas=None, rsid_coordinates=None):
     query_term_lower = query_term.lower()
     chrom, start, end = None, None, None
     query_match = re.match(
@@ -267,8 +557,10 @@ def get_coordinate(query_term, assembly='GRCh37', atlas=None):
     else:
         query_match = re.match(r'^rs\d+', query_term_lower)
         if query_match:
-            chrom, start, end = get_rsid_coordinates(query_match.group(0),
-                                                     assembly, atlas)
+            rsid = query_match.group(0)
+            if rsid_coordinates is None or rsid not in rsid_coordinates:
+                rsid_coordinates = resolve_rsids([rsid], assembly, atlas)
+            chrom, start, end = rsid_coordinates[rsid]
     try:
         start, end = int(start), int(end)
     except (ValueError, TypeError):
@@ -286,58 +578,46 @@ def get_rsids(atlas, assembly, chrom, start, end):
     return [rsid['rsid'] for rsid in rsids if 'rsid' in rsid]
 
 
-def parse_region_query(request):
-    # Get raw parameters from request
-    # TODO process "format", "frame" or other params
-    if request.method == 'GET':
-        assembly = request.params.get('genome', 'GRCh37')
-        regions = request.params.getall('regions')
-        from_ = request.params.get('from', 0)
-        size = request.params.get('limit', 200)
-        format = request.params.get('format', 'json')
-        maf = request.params.get('maf', None)
-    else:  # request.method == 'POST'
-        assembly = request.json_body.get('genome', 'GRCh37')
-        regions = request.json_body.get('regions', [])
-        if not isinstance(regions, list):
-            regions = [regions]
-        from_ = request.json_body.get('from', 0)
-        size = request.json_body.get('limit', 200)
-        format = request.json_body.get('format', 'json')
-        maf = request.json_body.get('maf', None)
-
-    # Parse parameters
-    if assembly not in _GENOME_TO_ALIAS.keys():
-        assembly = 'GRCh37'
-    # Split lines and ignore lines here; `get_coordinate` raises ValueError and
-    # doesn't handle ignoring query_term.
-    region_queries = [region_query
-                      for query in regions
-                      for region_query in re.split(r'[\r\n]+', query)
-                      if not re.match(r'^(#.*)|(\s*)$', region_query)]
-
+def resolve_region_queries(atlas, assembly, region_queries, maf=None):
+    '''Returns (query_coordinates, notifications, variants) for region queries, where
+       variants are sorted (chrom, start, end, rsids) of all known variants found'''
     variants = dict()
     notifications = {}
-    atlas = RegulomeAtlas(request.registry[SNP_SEARCH_ES])
     # Return query coordinates. i.e. dbSNP ID inputs will be mapped, so that
     # 1) Users can double check their queries in return results;
     # 2) regulome_search will use and will only use one single coordinate from
     # this list.
     query_coordinates = []
+    coordinates = []
+    rsid_coordinates = resolve_rsids(
+        list(OrderedDict.fromkeys(
+            query_match.group(0)
+            for query_match in (re.match(r'^rs\d+', region_query.lower())
+                                for region_query in region_queries)
+            if query_match
+        )),
+        assembly,
+        atlas
+    )
     for region_query in region_queries:
         # Get coordinate for queried region
         try:
-            chrom, start, end = get_coordinate(region_query, assembly, atlas)
+            chrom, start, end = get_coordinate(region_query, assembly, atlas, rsid_coordinates)
         except ValueError:
             notifications[region_query] = 'Failed: invalid region input'
             continue
         query_coordinates.append('{}:{}-{}'.format(chrom, int(start), int(end)))
-        # If query is a rsid, it should be put in snps regardless of its MAF.
-        # However, find_snps is still called in case there are overlapping
-        # variants passing the MAF cutoff
-        snps = atlas.find_snps(
-            _GENOME_TO_ALIAS.get(assembly, 'hg19'), chrom, start, end, maf=maf
-        )
+        coordinates.append((region_query, chrom, start, end))
+
+    # If query is a rsid, it should be put in snps regardless of its MAF.
+    # However, find_snps is still called in case there are overlapping
+    # variants passing the MAF cutoff
+    all_snps = atlas.find_snps_multi(
+        _GENOME_TO_ALIAS.get(assembly, 'hg19'),
+        [(chrom, start, end) for (_, chrom, start, end) in coordinates],
+        maf=maf
+    )
+    for (region_query, chrom, start, end), snps in zip(coordinates, all_snps):
         if re.match(r'^rs\d+', region_query.lower()):
             snps.append(
                 {
@@ -368,6 +648,62 @@ def parse_region_query(request):
             else:
                 variants[coord] = {snp['rsid']}
 
+    return (
+        query_coordinates,
+        notifications,
+        [(chrom, start, end, sorted(variants[(chrom, start, end)]))
+         for chrom, start, end in sorted(variants)]
+    )
+
+
+def parse_region_query(request, keep_session=True):
+    # Get raw parameters from request
+    # TODO process "format", "frame" or other params
+    if request.method == 'GET':
+        assembly = request.params.get('genome', 'GRCh37')
+        regions = request.params.getall('regions')
+        from_ = request.params.get('from', 0)
+        size = request.params.get('limit', 200)
+        format = request.params.get('format', 'json')
+        maf = request.params.get('maf', None)
+        session_key = request.params.get('query_session')
+    else:  # request.method == 'POST'
+        assembly = request.json_body.get('genome', 'GRCh37')
+        regions = request.json_body.get('regions', [])
+        if not isinstance(regions, list):
+            regions = [regions]
+        from_ = request.json_body.get('from', 0)
+        size = request.json_body.get('limit', 200)
+        format = request.json_body.get('format', 'json')
+        maf = request.json_body.get('maf', None)
+        session_key = request.json_body.get('query_session')
+
+    # Parse parameters
+    if assembly not in _GENOME_TO_ALIAS.keys():
+        assembly = 'GRCh37'
+    # Split lines and ignore lines here; `get_coordinate` raises ValueError and
+    # doesn't handle ignoring query_term.
+    region_queries = [region_query
+                      for query in regions
+                      for region_query in re.split(r'[\r\n]+', query)
+                      if not re.match(r'^(#.*)|(\s*)$', region_query)]
+
+    # Pages of a large submission share one resolved query session
+    sessions = request.registry.get(REGULOME_QUERY_SESSIONS) if keep_session else None
+    requested_key = session_key
+    if region_queries or not session_key:
+        session_key = QuerySessions.key(assembly, region_queries, maf)
+    session = sessions.get(session_key) if sessions is not None else None
+    resolved = False
+    if session is None and not region_queries and requested_key:
+        session = ([], {'Failed': 'Query session expired, please submit the regions again'}, [])
+    elif session is None:
+        session = resolve_region_queries(
+            request.registry[REGULOME_ATLAS], assembly, region_queries, maf
+        )
+        resolved = True
+    (query_coordinates, notifications, variants) = session
+
     total = len(variants)
     try:
         from_ = max(int(from_), 0)
@@ -380,12 +716,16 @@ def parse_region_query(request):
             to_ = min(from_ + max(int(size), 0), total)
         except ValueError:
             to_ = min(from_ + 200, total)
+    # Only a submission spanning several pages is paged by its key, so only it is kept
+    if resolved and to_ - from_ < total and sessions is not None:
+        sessions.put(session_key, session)
 
     result = {
         '@context': request.route_path('jsonld_context'),
         '@id': request.path_qs,
         'assembly': assembly,
-        'query_coordinates': query_coordinates,
+        'query_coordinates': list(query_coordinates),
+        'query_session': session_key,
         'format': format,
         'from': from_,
         'total': total,
@@ -394,11 +734,11 @@ def parse_region_query(request):
                 'chrom': chrom,
                 'start': start,
                 'end': end,
-                'rsids': sorted(variants[(chrom, start, end)])
+                'rsids': list(rsids)
             }
-            for chrom, start, end in sorted(variants)[from_:to_]
+            for chrom, start, end, rsids in variants[from_:to_]
         ],
-        'notifications': notifications,
+        'notifications': dict(notifications),  # callers add to them
     }
     return result
 
@@ -423,6 +763,141 @@ def evidence_to_features(evidence):
     return features
 
 
+def cached_results(atlas, keys):
+    '''Returns {key: result} for the (assembly, chrom, start, end, profile) keys
+       the atlas result cache holds'''
+    if atlas.result_cache is None or not keys:
+        return {}
+    return atlas.result_cache.get_many(keys)[0]
+
+
+def cache_results(atlas, results):
+    '''Caches {(assembly, chrom, start, end, profile): result} in the atlas result cache'''
+    if atlas.result_cache is not None and results:
+        atlas.result_cache.put_many(list(results), results)
+
+
+def score_variants(atlas, assembly, variants, timing):
+    '''Returns [(variant, regulome_score, features)] for summary variants, scored together'''
+    # dbSNP SNPs may have their scores precomputed, the rest are scored live
+    begin = time.time()  # DEBUG: timing
+    stored = atlas.stored_scores(
+        _GENOME_TO_ALIAS.get(assembly, 'hg19'),
+        [(v['chrom'], int(v['start']), int(v['end'])) for v in variants]
+    )
+    timing.append({'stored_scores': (time.time() - begin)})  # DEBUG: timing
+    # others may have been scored by recent queries
+    begin = time.time()  # DEBUG: timing
+    keys = [
+        (_GENOME_TO_ALIAS.get(assembly, 'hg19'), v['chrom'], int(v['start']), int(v['end']),
+         'summary')
+        for v in variants
+    ]
+    cached = cached_results(atlas, [
+        key for key, stored_score in zip(keys, stored) if stored_score is None
+    ])
+    live_variants = [
+        variant for variant, key, stored_score in zip(variants, keys, stored)
+        if stored_score is None and key not in cached
+    ]
+    timing.append({'cached_results': (time.time() - begin)})  # DEBUG: timing
+
+    # Look up peaks for all unique regions in batches, then gather evidence
+    begin = time.time()  # DEBUG: timing
+    all_hits_list = regions_get_hits(
+        atlas,
+        assembly,
+        [(v['chrom'], v['start'], v['end']) for v in live_variants],
+        compact=True,  # only scores are returned
+        profile='scoring'
+    )
+    timing.append({'regions_get_hits': (time.time() - begin)})  # DEBUG: timing
+    # Read bigWig signals for all variants at once
+    begin = time.time()  # DEBUG: timing
+    try:
+        signals = atlas.signal_evidence(
+            [(v['chrom'], int(v['start']), int(v['end'])) for v in live_variants]
+        )
+    except Exception:
+        signals = [None] * len(live_variants)  # read again per variant
+    timing.append({'signal_evidence': (time.time() - begin)})  # DEBUG: timing
+    evidences = []
+    for variant, all_hits, variant_signals in zip(live_variants, all_hits_list, signals):
+        begin = time.time()  # DEBUG: timing
+        chrom = variant['chrom']
+        start = variant['start']
+        end = variant['end']
+        # parse_region_query makes sure variants returned are all scorable
+        try:
+            evidence = atlas.regulome_evidence(all_hits['datasets'], chrom, int(start), int(end),
+                                               signals=variant_signals)
+        except Exception:
+            evidence = None
+        evidences.append(evidence)
+        timing.append(
+            {'{}:{}-{}'.format(chrom, start, end): (time.time() - begin)}
+        )  # DEBUG timing
+
+    # Score all variants with one model prediction
+    begin = time.time()  # DEBUG: timing
+    live_scores = iter(zip(evidences, atlas.regulome_scores(evidences)))
+    timing.append({'regulome_scores': (time.time() - begin)})  # DEBUG: timing
+
+    scored = []
+    results = {}
+    for variant, key, stored_score in zip(variants, keys, stored):
+        if stored_score is not None:
+            (regulome_score, features) = stored_score
+        elif key in cached:
+            (regulome_score, features) = (cached[key]['regulome_score'], cached[key]['features'])
+        else:
+            (evidence, regulome_score) = next(live_scores)
+            if evidence is None:
+                features = {}
+                regulome_score = {}
+            else:
+                features = evidence_to_features(evidence)
+                results[key] = {'regulome_score': regulome_score, 'features': features}
+        scored.append((variant, regulome_score, features))
+    cache_results(atlas, results)  # failures to find evidence are not cached
+    return scored
+
+
+def iter_scored_variants(atlas, assembly, variants, timing, batch_size=REGDB_SUMMARY_BATCH_SIZE):
+    '''Yields (variant, regulome_score, features) for summary variants.
+       Batches are only scored when reached, so output can stream while the rest waits.'''
+    for i in range(0, len(variants), batch_size):
+        yield from score_variants(atlas, assembly, variants[i:i + batch_size], timing)
+
+
+def summary_table_rows(scored_variants, header=True):
+    '''Yields encoded tsv rows of scored variants, columns following the first variant'''
+    columns = None
+    for (variant, regulome_score, features) in scored_variants:
+        if columns is None:
+            columns = ['chrom', 'start', 'end', 'rsids']
+            columns.extend(sorted(regulome_score.keys()))
+            columns.extend(sorted(features.keys()))
+            if header:
+                yield '\t'.join(columns).encode()
+        row = [variant['chrom'], str(variant['start']), str(variant['end']),
+               ', '.join(variant['rsids'])]
+        row.extend([
+            str(features.get(col, '')) or str(regulome_score.get(col, ''))
+            for col in columns
+            if col in regulome_score or col in features
+        ])
+        yield '\t'.join(row).encode()
+
+
+def summary_ndjson_rows(scored_variants):
+    '''Yields one encoded json document per scored variant'''
+    for (variant, regulome_score, features) in scored_variants:
+        yield json.dumps(
+            dict(variant, regulome_score=regulome_score, features=features), sort_keys=True
+        ).encode()
+
+
 @view_config(route_name='regulome-summary', request_method=('GET', 'POST'),
              permission='search')
 def regulome_summary(context, request):
@@ -456,57 +931,28 @@ def regulome_summary(context, request):
             result['notifications'] = {'Failed': 'No variants found'}
         return result
 
-    # Loop through coordinates and score each unique region
-    regulome_es = request.registry[SNP_SEARCH_ES]
-    atlas = RegulomeAtlas(regulome_es)
-    assembly = result['assembly']
-    if result['format'] in ['tsv', 'bed']:
-        table = []
-    for variant in result['variants']:
-        begin = time.time()  # DEBUG: timing
-        chrom = variant['chrom']
-        start = variant['start']
-        end = variant['end']
-        # parse_region_query makes sure variants returned are all scorable
-        try:
-            all_hits = region_get_hits(atlas, assembly, chrom, start, end)
-            evidence = atlas.regulome_evidence(all_hits['datasets'], chrom, int(start), int(end))
-            regulome_score = atlas.regulome_score(all_hits['datasets'],
-                                                  evidence)
-            features = evidence_to_features(evidence)
-        except Exception:
-            features = {}
-            regulome_score = {}
-        if result['format'] in ['tsv', 'bed']:
-            if not table:
-                columns = ['chrom', 'start', 'end', 'rsids']
-                columns.extend(sorted(regulome_score.keys()))
-                columns.extend(sorted(features.keys()))
-                if result['format'] == 'tsv':
-                    table.append('\t'.join(columns).encode())
-            row = [chrom, start, end, ', '.join(variant['rsids'])]
-            row.extend([
-                str(features.get(col, '')) or str(regulome_score.get(col, ''))
-                for col in columns
-                if col in regulome_score or col in features
-            ])
-            table.append('\t'.join(row).encode())
-            continue
+    atlas = request.registry[REGULOME_ATLAS]
+    scored_variants = iter_scored_variants(
+        atlas, result['assembly'], result['variants'], result['timing']
+    )
+    if result['format'] in ['tsv', 'bed', 'ndjson']:
+        # Rows are scored batch by batch as the response streams
+        if result['format'] == 'ndjson':
+            request.response.content_type = 'application/x-ndjson'
+            rows = summary_ndjson_rows(scored_variants)
         else:
-            variant['features'] = features
-            variant['regulome_score'] = regulome_score
-        result['timing'].append(
-            {'{}:{}-{}'.format(chrom, start, end): (time.time() - begin)}
-        )  # DEBUG timing
-    if result['format'] in ['tsv', 'bed']:
-        request.response.content_type = 'text/tsv'
+            request.response.content_type = 'text/tsv'
+            rows = summary_table_rows(scored_variants, header=(result['format'] == 'tsv'))
         request.response.content_disposition = (
             'attachment;filename="regulome_{}.{}"'.format(
                 time.strftime('%Y%m%d-%Hh%Mm%Ss'), result['format']
             )
         )
-        request.response.app_iter = (row + b'\n' for row in table)
+        request.response.app_iter = (row + b'\n' for row in rows)
         return request.response
+    for (variant, regulome_score, features) in scored_variants:
+        variant['features'] = features
+        variant['regulome_score'] = regulome_score
     return result
 
 
@@ -526,7 +972,7 @@ def regulome_search(context, request):
             'title': 'RegulomeDB search',
         }
     begin = time.time()  # DEBUG: timing
-    result = parse_region_query(request)
+    result = parse_region_query(request, keep_session=False)  # one region is never paged
     result['@type'] = ['regulome-search']
     result['title'] = 'RegulomeDB search'
     result['timing'] = [{'parse_region_query': (time.time() - begin)}]  # DEBUG: timing
@@ -542,8 +988,7 @@ def regulome_search(context, request):
 
     # Start search
     begin = time.time()  # DEBUG: timing
-    regulome_es = request.registry[SNP_SEARCH_ES]
-    atlas = RegulomeAtlas(regulome_es)
+    atlas = request.registry[REGULOME_ATLAS]
     assembly = result['assembly']
     coord = result['query_coordinates'][0]
     chrom, start_end = coord.split(':')
@@ -551,50 +996,85 @@ def regulome_search(context, request):
     start = int(start)
     end = int(end)
 
-    try:
-        all_hits = region_get_hits(
-            atlas, assembly, chrom, start, end, peaks_too=True
-        )
-        evidence = atlas.regulome_evidence(
-            all_hits['datasets'], chrom, start, end
+    # A recent search of the same region may have its results cached
+    cache_key = (_GENOME_TO_ALIAS.get(assembly, 'hg19'), chrom, start, end, 'detail')
+    cached = cached_results(atlas, [cache_key]).get(cache_key)
+
+    # Peaks, the stored score and nearby SNPs only depend on the query coordinate,
+    # so their es round trips overlap on the search pool.
+    stages = OrderedDict()
+    if cached is None:
+        stages['region_get_hits'] = (
+            region_get_hits, (atlas, assembly, chrom, start, end), {'peaks_too': True}
         )
-        result['regulome_score'] = atlas.regulome_score(
-            all_hits['datasets'], evidence
+        stages['stored_score'] = (
+            region_stored_score, (atlas, assembly, chrom, start, end), {}
         )
-        result['features'] = evidence_to_features(evidence)
-    except Exception as e:
-        result['notifications'][coord] = 'Failed: (exception) {}'.format(e)
-    peak_details = []
-    for peak in all_hits.get('peaks', []):
-        peak_details.append({
-            'chrom': peak['_index'],
-            'start': peak['_source']['coordinates']['gte'],
-            'end': peak['_source']['coordinates']['lt'],
-            'strand': peak['_source'].get('strand'),
-            'value': peak['_source'].get('value'),
-
-            'file': peak['resident_detail']['file']['@id'].split('/')[2],
-
-            'dataset': peak['resident_detail']['dataset']['@id'],
-            'documents': peak['resident_detail']['dataset']['documents'],
-            'biosample_ontology': peak['resident_detail']['dataset']['biosample_ontology'],
-            'method': peak['resident_detail']['dataset']['collection_type'],
-            'targets': peak['resident_detail']['dataset'].get('target', []),
-        })
-    result['@graph'] = peak_details
-    result['timing'].append({'regulome_search_scoring': (time.time() - begin)})  # DEBUG: timing
-
-    begin = time.time()  # DEBUG: timing
-    result['nearby_snps'] = atlas.nearby_snps(
-        _GENOME_TO_ALIAS.get(assembly, 'hg19'),
-        chrom,
-        int((start + end) / 2),
+    stages['nearby_snps'] = (
+        atlas.nearby_snps,
+        (_GENOME_TO_ALIAS.get(assembly, 'hg19'), chrom, int((start + end) / 2)),
         # No guarentee the query coordinate corresponds to one RefSNP.
-        max_snps=len(result['variants'])+10
+        {'max_snps': len(result['variants']) + 10}
     )
+    stages = run_stages(request.registry.get(REGULOME_SEARCH_POOL), stages)
+    for (name, (_stage_result, _error, took)) in stages.items():
+        result['timing'].append({name: took})  # DEBUG: timing
+
+    if cached is not None:
+        result.update(cached)
+    else:
+        all_hits = {}
+        try:
+            (region_hits, error, _took) = stages['region_get_hits']
+            if error is not None:
+                raise error
+            all_hits = region_hits
+            (stored_score, error, _took) = stages['stored_score']
+            if error is not None:
+                raise error
+            if stored_score is not None:
+                (result['regulome_score'], result['features']) = stored_score
+            else:
+                evidence = atlas.regulome_evidence(
+                    all_hits['datasets'], chrom, start, end
+                )
+                result['regulome_score'] = atlas.regulome_score(
+                    all_hits['datasets'], evidence
+                )
+                result['features'] = evidence_to_features(evidence)
+        except Exception as e:
+            result['notifications'][coord] = 'Failed: (exception) {}'.format(e)
+        peak_details = []
+        for peak in all_hits.get('peaks', []):
+            peak_details.append({
+                'chrom': peak['_index'],
+                'start': peak['_source']['coordinates']['gte'],
+                'end': peak['_source']['coordinates']['lt'],
+                'strand': peak['_source'].get('strand'),
+                'value': peak['_source'].get('value'),
+
+                'file': peak['resident_detail']['file']['@id'].split('/')[2],
+
+                'dataset': peak['resident_detail']['dataset']['@id'],
+                'documents': peak['resident_detail']['dataset']['documents'],
+                'biosample_ontology': peak['resident_detail']['dataset']['biosample_ontology'],
+                'method': peak['resident_detail']['dataset']['collection_type'],
+                'targets': peak['resident_detail']['dataset'].get('target', []),
+            })
+        result['@graph'] = peak_details
+        if coord not in result['notifications']:
+            cache_results(atlas, {cache_key: {
+                'regulome_score': result['regulome_score'],
+                'features': result['features'],
+                '@graph': peak_details,
+            }})
+    result['timing'].append({'regulome_search_scoring': (time.time() - begin)})  # DEBUG: timing
+
+    (result['nearby_snps'], error, _took) = stages['nearby_snps']
+    if error is not None:
+        raise error
     # Use nearby_snps instead
     result.pop('variants', None)
-    result['timing'].append({'nearby_snps': (time.time() - begin)})  # DEBUG: timing
     return result
 
 
@@ -616,7 +1096,7 @@ def jbrest(context, request):
         log.error('jbrest: unsupported request %s', request.url)
         return request.response
 
-    atlas = RegulomeAtlas(request.registry['snp_search'])
+    atlas = request.registry[REGULOME_ATLAS]
     what = parts.pop(0)
     if what == 'features':
         chrom = parts.pop(0)
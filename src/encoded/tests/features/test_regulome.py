@@ -63,6 +63,71 @@ def test_regulome_summary(testapp, workbook, region_index):
     assert res.json['notifications'] == expected_notes
 
 
+@pytest.mark.parametrize("format", ['tsv', 'ndjson'])
+def test_regulome_summary_stream(testapp, workbook, region_index, format):
+    import json
+    res = testapp.get(
+        '/regulome-summary/?regions=rs3768324%0Ars10905307&genome=GRCh37&format=' + format
+    )
+    lines = res.text.splitlines()
+    if format == 'tsv':
+        assert lines[0].split('\t')[:4] == ['chrom', 'start', 'end', 'rsids']
+        assert lines[1].split('\t')[:4] == ['chr1', '39492461', '39492462', 'rs3768324']
+    else:
+        variants = [json.loads(line) for line in lines]
+        assert [v['rsids'] for v in variants] == [['rs3768324'], ['rs10905307']]
+        assert variants[0]['regulome_score'] == {'probability': '0.99267', 'ranking': '1a'}
+
+
+def test_regulome_search_without_pool(testapp, app, workbook, region_index, monkeypatch):
+    from encoded.regulome_atlas import REGULOME_ATLAS
+    from encoded.regulome_search import REGULOME_SEARCH_POOL
+    url = '/regulome-search/?regions=rs3768324&genome=GRCh37'
+    monkeypatch.setattr(app.registry[REGULOME_ATLAS], 'result_cache', None)
+    pooled = testapp.get(url).json
+    monkeypatch.delitem(app.registry, REGULOME_SEARCH_POOL, raising=False)
+    serial = testapp.get(url).json
+    for key in ['regulome_score', 'features', '@graph', 'nearby_snps', 'notifications']:
+        assert serial[key] == pooled[key]
+    assert [list(timing) for timing in serial['timing']] == \
+        [list(timing) for timing in pooled['timing']]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_run_stages(workers):
+    import threading
+    from collections import OrderedDict
+    from concurrent.futures import ThreadPoolExecutor
+    from encoded.regulome_search import run_stages
+    pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+    # On a pool both lookups must be running at once to get past the barrier
+    barrier = threading.Barrier(2 if pool else 1, timeout=10)
+
+    def lookup(value, scale=1):
+        barrier.wait()
+        return value * scale
+
+    def unavailable():
+        raise ConnectionError('es is unavailable')
+
+    try:
+        stages = run_stages(pool, OrderedDict([
+            ('first', (lookup, (2,), {'scale': 3})),
+            ('failing', (unavailable, (), {})),
+            ('second', (lookup, (5,), {})),
+        ]))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    assert list(stages) == ['first', 'failing', 'second']
+    assert stages['first'][:2] == (6, None)
+    assert stages['second'][:2] == (5, None)
+    (result, error, took) = stages['failing']
+    assert result is None
+    assert isinstance(error, ConnectionError)
+    assert all(took >= 0 for (_result, _error, took) in stages.values())
+
+
 @pytest.mark.parametrize("query_term,expected,valid", [
     ('chrx:5894499-5894500', ('chrX', 5894499, 5894500), True),
     ('chr10:5894499-5894500extra string ', ('chr10', 5894499, 5894500), True),
@@ -78,3 +143,109 @@ def test_get_coordinate(query_term, expected, valid):
         with pytest.raises(ValueError) as excinfo:
             get_coordinate(query_term)
         assert str(excinfo.value) == error_msg
+
+
+def test_query_sessions():
+    from encoded.regulome_search import QuerySessions
+    sessions = QuerySessions(capacity=2)
+    keys = [QuerySessions.key('GRCh37', [region]) for region in ('rs1', 'rs2', 'rs3')]
+    assert keys[0] == QuerySessions.key('GRCh37', ['rs1'])
+    assert keys[0] != QuerySessions.key('GRCh38', ['rs1'])
+    for key in keys:
+        sessions.put(key, key)
+    assert sessions.get(keys[0]) is None
+    assert sessions.get(keys[2]) == keys[2]
+    sessions.max_age = -1
+    assert sessions.get(keys[2]) is None
+    generation = [1]
+    sessions = QuerySessions(generation=lambda: generation[0], check_interval=0)
+    sessions.put(keys[0], keys[0])
+    assert sessions.get(keys[0]) == keys[0]
+    generation[0] = 2
+    assert sessions.get(keys[0]) is None
+
+
+def test_sqlite_query_sessions(tmpdir):
+    from encoded.regulome_search import SqliteQuerySessions
+    path = str(tmpdir.join('query_sessions.sqlite'))
+    generation = [1]
+    sessions = SqliteQuerySessions(path, capacity=2, generation=lambda: generation[0],
+                                   check_interval=0)
+    keys = [SqliteQuerySessions.key('GRCh37', [region]) for region in ('rs1', 'rs2', 'rs3')]
+    session = (['chr1:39492461-39492462'], {}, [('chr1', 39492461, 39492462, ['rs3768324'])])
+    sessions.put(keys[0], session)
+    # Another process only knowing the key finds the session
+    fresh = SqliteQuerySessions(path, generation=lambda: generation[0], check_interval=0)
+    assert fresh.get(keys[0]) == [
+        ['chr1:39492461-39492462'], {}, [['chr1', 39492461, 39492462, ['rs3768324']]]
+    ]
+    sessions.put(keys[1], session)
+    assert fresh.get(keys[0]) is not None  # now more recently used than keys[1]
+    sessions.put(keys[2], session)
+    assert sessions.get(keys[1]) is None
+    assert sessions.get(keys[0]) is not None
+    generation[0] = 2
+    assert fresh.get(keys[2]) is None
+    assert sessions.get(keys[0]) is None
+    sessions.put(keys[0], session)
+    sessions.max_age = -1
+    assert sessions.get(keys[0]) is None
+
+
+def test_regulome_summary_query_session(testapp, app, workbook, region_index, monkeypatch,
+                                        tmpdir):
+    from encoded.regulome_search import REGULOME_QUERY_SESSIONS, SqliteQuerySessions
+    path = str(tmpdir.join('query_sessions.sqlite'))
+    monkeypatch.setitem(app.registry, REGULOME_QUERY_SESSIONS, SqliteQuerySessions(path))
+    first = testapp.get(
+        '/regulome-summary/?regions=rs3768324%0Ars10905307%0Achr1:100-101&genome=GRCh37&limit=2'
+    ).json
+    assert first['total'] == 3
+    # The next page goes to a process that never saw the regions, only their key
+    monkeypatch.setitem(app.registry, REGULOME_QUERY_SESSIONS, SqliteQuerySessions(path))
+    page = testapp.get(
+        '/regulome-summary/?query_session={}&genome=GRCh37&limit=2'.format(first['query_session'])
+    ).json
+    assert page['total'] == 3
+    assert [v['rsids'] for v in page['variants']] == [v['rsids'] for v in first['variants']]
+    assert 'Failed' not in page['notifications']
+
+
+def test_parse_region_query_sessions(monkeypatch):
+    from webob.multidict import MultiDict
+    from encoded import regulome_search
+    from encoded.regulome_search import QuerySessions, REGULOME_QUERY_SESSIONS
+
+    class Request(object):
+        method = 'GET'
+        path_qs = '/regulome-summary/'
+
+        def __init__(self, **params):
+            self.params = MultiDict(params)
+            self.registry = registry
+
+        def route_path(self, name):
+            return '/terms/'
+
+    variants = [('chr1', pos, pos + 1, []) for pos in (100, 200, 300)]
+    resolved = []
+
+    def resolve_region_queries(atlas, assembly, region_queries, maf):
+        resolved.append(region_queries)
+        return (['chr1:100-301'], {}, variants[:len(region_queries)])
+
+    monkeypatch.setattr(regulome_search, 'resolve_region_queries', resolve_region_queries)
+    sessions = QuerySessions()
+    registry = {REGULOME_QUERY_SESSIONS: sessions, regulome_search.REGULOME_ATLAS: None}
+    regions = 'chr1:100-101\nchr1:200-201\nchr1:300-301'
+    # Neither a submission fitting one page nor a regulome-search region is kept
+    regulome_search.parse_region_query(Request(regions=regions, limit='all'))
+    regulome_search.parse_region_query(Request(regions='chr1:100-101'), keep_session=False)
+    assert len(sessions._sessions) == 0
+    first = regulome_search.parse_region_query(Request(regions=regions, limit='2'))
+    assert len(sessions._sessions) == 1
+    page = regulome_search.parse_region_query(
+        Request(query_session=first['query_session'], limit='2', **{'from': '2'})
+    )
+    assert [variant['start'] for variant in page['variants']] == [300]
+    assert len(resolved) == 3
@@ -193,6 +193,72 @@ def test_find_peaks_filtered(assembly, location, dbdetails, region_index, regulo
             assert deets[part] == peak['resident_detail'][part]
 
 
+def test_find_peaks_scoring_profile(region_index, regulome_atlas):
+    peaks = regulome_atlas.find_peaks('hg19', 'chr10', 5894499, 5894500, profile='scoring')
+    assert len(peaks) == 3
+    assert all(set(peak['_source']) == {'uuid', 'coordinates'} for peak in peaks)
+
+
+def test_find_peaks_scrolled(monkeypatch, region_index, regulome_atlas):
+    from encoded import regulome_atlas as atlas_module
+
+    peaks = regulome_atlas.find_peaks('hg19', 'chr10', 5894499, 5894500)
+    monkeypatch.setattr(atlas_module, 'REGDB_SCROLL_SIZE', 1)
+    scrolled = regulome_atlas.find_peaks('hg19', 'chr10', 5894499, 5894500)
+    assert sorted(p['_id'] for p in scrolled) == sorted(p['_id'] for p in peaks)
+    assert len(list(regulome_atlas.iter_snps('hg19', 'chr10', 5894499, 5894500))) == 1
+
+
+def test_iter_hits_pages(monkeypatch):
+    from encoded import regulome_atlas as atlas_module
+    from encoded.regulome_atlas import RegulomeAtlas
+
+    class PagedES(object):
+        def __init__(self, total):
+            self.hits = [{'_id': str(n)} for n in range(total)]
+            self.calls = []
+
+        def page(self, offset):
+            return {'_scroll_id': 'scroll-%d' % offset, 'hits': {
+                'total': len(self.hits), 'hits': self.hits[offset:offset + 2]
+            }}
+
+        def search(self, index, doc_type, body, scroll=None):
+            self.calls.append(('search', body['size'], body['sort'], scroll))
+            return self.page(0)
+
+        def scroll(self, scroll_id, scroll):
+            self.calls.append(('scroll', scroll_id))
+            return self.page(int(scroll_id.split('-')[1]) + 2)
+
+        def clear_scroll(self, body, ignore):
+            self.calls.append(('clear_scroll', body['scroll_id']))
+
+    monkeypatch.setattr(atlas_module, 'REGDB_SCROLL_SIZE', 2)
+    query = RegulomeAtlas._range_query(0, 100)
+    # One page of hits takes one plain search and no scroll
+    es = PagedES(2)
+    hits = list(RegulomeAtlas(es)._iter_hits('chr1', 'hg19', query))
+    assert [hit['_id'] for hit in hits] == ['0', '1']
+    assert es.calls == [('search', 2, ['_doc'], None)]
+
+    # An overflowing first page is kept and a scroll skips the hits already yielded
+    es = PagedES(5)
+    hits = list(RegulomeAtlas(es)._iter_hits('chr1', 'hg19', query))
+    assert [hit['_id'] for hit in hits] == ['0', '1', '2', '3', '4']
+    assert es.calls == [
+        ('search', 2, ['_doc'], None), ('search', 2, ['_doc'], '1m'),
+        ('scroll', 'scroll-0'), ('scroll', 'scroll-2'), ('clear_scroll', ['scroll-4']),
+    ]
+
+    # A caller stopping within the first page never opens a scroll
+    es = PagedES(5)
+    hits = RegulomeAtlas(es)._iter_hits('chr1', 'hg19', query)
+    assert next(hits)['_id'] == '0'
+    hits.close()
+    assert es.calls == [('search', 2, ['_doc'], None)]
+
+
 @pytest.mark.parametrize("assembly,rsid,location", [
     ('hg19', 'rs3768324', ('chr1', 39492461, 39492462)),
     ('hg19', 'rs10905307', ('chr10', 5894499, 5894500)),
@@ -204,6 +270,12 @@ def test_snp(assembly, rsid, location, region_index, regulome_atlas):
     assert snp['coordinates']['lt'] == location[2]
 
 
+def test_snps(region_index, regulome_atlas):
+    snps = regulome_atlas.snps('hg19', ['rs3768324', 'rs10905307', 'rs1'])
+    assert sorted(snps) == ['rs10905307', 'rs3768324']
+    assert snps['rs10905307']['coordinates'] == {'gte': 5894499, 'lt': 5894500}
+
+
 @pytest.mark.parametrize("assembly,chrom,pos,rsids", [
     ('hg19', 'chr1', 39492462, ['rs3768324']),
     ('hg19', 'chr10', 104574063, ['rs7092340', 'rs284857'])
@@ -950,3 +1022,378 @@ def test_get_rsid_coordinates_internet(rsid, assembly, location):
     from encoded import regulome_search
     coords = regulome_search.get_rsid_coordinates(rsid, assembly, atlas=None, webfetch=True)
     assert coords == location
+
+
+def test_regulome_scores_batch(regulome_atlas):
+    evidences = [
+        {'QTL': [], 'ChIP': [], 'DNase': [], 'PWM_matched': [], 'Footprint_matched': [],
+         'IC_max': 0.5, 'IC_matched_max': 0.2},
+        None,
+        {'DNase': [], 'IC_max': 0.0, 'IC_matched_max': 0.0},
+        {'IC_max': 0.0, 'IC_matched_max': 0.0},
+    ]
+    scores = regulome_atlas.regulome_scores(evidences)
+    assert len(scores) == len(evidences)
+    assert scores[1] is None
+    assert [score['ranking'] for score in scores if score] == ['1a', '5', '7']
+    for evidence, score in zip(evidences, scores):
+        if evidence:
+            assert score == regulome_atlas.regulome_score({}, evidence)
+            assert score['ranking'] == regulome_atlas.regulome_ranking(evidence)
+    assert regulome_atlas.regulome_ranking(None) is None
+
+
+@pytest.mark.parametrize("characterization,ranking", [
+    (['QTL', 'ChIP', 'DNase', 'PWM', 'PWM_matched'], '1c'),
+    (['QTL', 'ChIP', 'PWM_matched'], '1e'),
+    (['QTL', 'Footprint'], '6'),
+    (['QTL'], '7'),
+    (['ChIP', 'DNase', 'PWM', 'Footprint'], '2b'),
+    (['ChIP', 'PWM', 'PWM_matched'], '3b'),
+    (['DNase'], '5'),
+    ([], '7'),
+])
+def test_ranking_table(characterization, ranking):
+    from encoded.regulome_atlas import RegulomeAtlas
+    from encoded.regulome_atlas import REGDB_RANKINGS
+    from encoded.regulome_atlas import evidence_bits
+
+    assert REGDB_RANKINGS[evidence_bits(characterization)] == ranking
+    assert RegulomeAtlas._ranking(characterization) == ranking
+
+
+def test_regulome_evidence_ranking_only():
+    from encoded.regulome_atlas import RegulomeAtlas
+
+    atlas = RegulomeAtlas(None)
+    datasets = {
+        '/experiments/E1/': {'collection_type': 'ChIP-seq', 'target': 'CTCF'},
+        '/experiments/E2/': {'collection_type': 'PWMs', 'target': 'CTCF'},
+    }
+    evidence = atlas.regulome_evidence(datasets, 'chr1', 100, 101, ranking_only=True)
+    assert sorted(evidence) == ['ChIP', 'PWM', 'PWM_matched']
+    assert atlas.regulome_ranking(evidence) == '3b'
+
+
+def test_peak_interval_index():
+    from encoded.regulome_atlas import PeakIntervalIndex
+    peaks = [
+        {'_index': 'chr1', '_source': {'uuid': 'a', 'coordinates': {'gte': 10, 'lt': 20}}},
+        {'_index': 'chr1', '_source': {'uuid': 'b', 'coordinates': {'gte': 15, 'lt': 30}}},
+        {'_index': 'chr1', '_source': {'uuid': 'a', 'coordinates': {'gte': 25, 'lt': 26}}},
+        {'_index': 'chr2', '_source': {'uuid': 'c', 'coordinates': {'gte': 0, 'lt': 100}}},
+    ]
+    index = PeakIntervalIndex(peaks)
+    assert index.overlaps('chr1', [31, 9, 10, 20, 21, 25]) == [
+        set(), set(), {'a'}, {'a', 'b'}, {'b'}, {'a', 'b'}
+    ]
+    assert index.overlaps('chr3', [10]) == [set()]
+    assert list(index.segments('chr1', 12, 28)) == [
+        (12, 14, {'a'}), (15, 20, {'a', 'b'}), (21, 24, {'b'}),
+        (25, 26, {'a', 'b'}), (27, 27, {'b'}),
+    ]
+    # Half open, as es matches a position, a peak no longer overlaps its lt
+    index = PeakIntervalIndex(peaks + [
+        {'_index': 'chr1', '_source': {'uuid': 'd', 'coordinates': {'gte': 5, 'lt': 5}}},
+    ], half_open=True)
+    assert index.overlaps('chr1', [31, 9, 10, 20, 21, 25, 26, 5]) == [
+        set(), set(), {'a'}, {'b'}, {'b'}, {'a', 'b'}, {'b'}, set()
+    ]
+    assert list(index.segments('chr1', 12, 28)) == [
+        (12, 14, {'a'}), (15, 19, {'a', 'b'}), (20, 24, {'b'}),
+        (25, 25, {'a', 'b'}), (26, 27, {'b'}),
+    ]
+
+
+def test_resident_details_cache():
+    from encoded.regulome_atlas import ResidentDetailsCache
+    generation = [1]
+    cache = ResidentDetailsCache(capacity=2, generation=lambda: generation[0], check_interval=0)
+    assert cache.get_many(['a', 'b']) == ({}, ['a', 'b'])
+    cache.put_many(['a', 'b'], {'a': {'uuid': 'a'}})
+    assert cache.get_many(['a', 'b']) == ({'a': {'uuid': 'a'}}, [])
+    cache.put_many(['c'], {'c': {'uuid': 'c'}})
+    assert cache.get_many(['a', 'c']) == ({'c': {'uuid': 'c'}}, ['a'])
+    generation[0] = 2
+    assert cache.get_many(['c']) == ({}, ['c'])
+    assert cache.stats() == {'capacity': 2, 'size': 0, 'hits': 3, 'misses': 4}
+
+
+def test_region_result_cache():
+    from encoded.regulome_atlas import RegionResultCache
+    generation = [1]
+    cache = RegionResultCache(capacity=2, generation=lambda: generation[0], check_interval=0)
+    keys = [('hg19', 'chr1', n, n + 1, 'summary') for n in range(3)]
+    result = {'regulome_score': {'probability': '0.99267', 'ranking': '1a'}, 'features': {}}
+    cache.put_many(keys[:2], {keys[0]: result})
+    # a key without a result is never cached
+    assert cache.get_many(keys[:2]) == ({keys[0]: result}, [keys[1]])
+    cache.put_many(keys[1:], {key: result for key in keys[1:]})
+    assert cache.get_many(keys) == ({keys[1]: result, keys[2]: result}, [keys[0]])
+    generation[0] = 2
+    assert cache.get_many(keys[1:]) == ({}, keys[1:])
+    assert cache.stats() == {'capacity': 2, 'size': 0, 'hits': 3, 'misses': 4}
+
+
+def test_sqlite_region_result_cache(tmpdir):
+    from encoded.regulome_atlas import SqliteRegionResultCache
+    generation = [1]
+    path = str(tmpdir.join('results.sqlite'))
+    cache = SqliteRegionResultCache(path, capacity=2, generation=lambda: generation[0],
+                                    check_interval=0)
+    key = ('hg19', 'chr1', 39492461, 39492462, 'summary')
+    result = {'regulome_score': {'probability': '0.99267', 'ranking': '1a'}, 'features': {}}
+    assert cache.get_many([key]) == ({}, [key])
+    cache.put_many([key], {key: result})
+    other = SqliteRegionResultCache(path, generation=lambda: generation[0], check_interval=0)
+    assert other.get_many([key]) == ({key: result}, [])
+    cache.put_many([key[:3] + (n, 'summary') for n in range(3)],
+                   {key[:3] + (n, 'summary'): result for n in range(3)})
+    assert cache.stats()['size'] == 2
+    generation[0] = 2
+    assert cache.get_many([key]) == ({}, [key])
+    assert cache.stats() == {'capacity': 2, 'size': 0, 'hits': 0, 'misses': 2}
+
+
+def test_resident_details_table(monkeypatch):
+    import threading
+    from encoded import regulome_atlas
+    from encoded.regulome_atlas import ResidentDetailsTable
+
+    def resident(uuid):
+        return {'_source': {
+            'uuid': uuid, 'file': {'@id': '/files/' + uuid + '/'},
+            'dataset': {'@id': '/experiments/ENCSR000AAA/', 'collection_type': 'ChIP-seq'},
+        }}
+
+    residents = [[resident('a')]]
+    reads = []
+
+    def scan(es, **kwargs):
+        reads.append(kwargs['index'])
+        if residents[0] is None:
+            raise ConnectionError('es is unavailable')
+        return iter(residents[0])
+
+    def refreshers():
+        return [t for t in threading.enumerate() if t.name == 'resident-details-refresh']
+
+    monkeypatch.setattr(regulome_atlas, 'scan', scan)
+    before = len(refreshers())
+    generation = [1]
+    table = ResidentDetailsTable(None, generation=lambda: generation[0], check_interval=3600)
+    assert table.load()
+    assert table.get_many(['a', 'b']) == {'a': {
+        'uuid': 'a', 'file': {'@id': '/files/a/'},
+        'dataset': {'@id': '/experiments/ENCSR000AAA/', 'collection_type': 'ChIP-seq'},
+    }}
+    assert len(reads) == 1  # served from memory after preload
+    assert not table.refresh()  # same generation, nothing to reload
+    assert len(reads) == 1
+
+    residents[0] = None
+    generation[0] = 2
+    assert not table.refresh()
+    assert len(reads) == 2
+    assert set(table.get_many(['a', 'b'])) == {'a'}  # previous table kept
+
+    residents[0] = [resident('a'), resident('b')]
+    assert table.refresh()
+    assert set(table.get_many(['a', 'b'])) == {'a', 'b'}
+
+    requests = [threading.Thread(target=table.get_many, args=(['a'],)) for _ in range(8)]
+    for request in requests:
+        request.start()
+    for request in requests:
+        request.join()
+    assert len(refreshers()) == before + 1
+    table.stop()
+    assert len(refreshers()) == before
+
+
+def test_bigwig_signals():
+    import numpy
+    from encoded.regulome_atlas import BigWigSignals
+
+    class ArrayBigWig(object):
+        def __init__(self, values):
+            self.values_read = 0
+            self.array = numpy.array(values, dtype=float)
+
+        def values(self, chrom, start, end, numpy=False):
+            self.values_read += 1
+            values = self.array[start:end]
+            return values if numpy else values.tolist()
+
+    bw = ArrayBigWig([0.0, 1.0, 2.0, float('nan'), 4.0, 5.0])
+    signals = BigWigSignals({'IC_max': bw}, max_window=4)
+    means = signals.means([('chr1', 4, 6), ('chr1', 0, 2), ('chr1', 2, 4), ('chr1', 1, 2)])
+    assert [mean['IC_max'] for mean in means] == [4.5, 0.5, 0.0, 1.0]
+    assert bw.values_read == 2
+
+
+def test_rsid_index(tmpdir):
+    import gzip
+    from pkg_resources import resource_filename
+    from encoded import regulome_search
+    from encoded.commands.build_rsid_index import bed_snps
+    from encoded.regulome_atlas import RsidIndex, RegulomeAtlas
+
+    path = str(tmpdir.join('hg19'))
+    with gzip.open(resource_filename('encoded', 'tests/data/files/ENCFF542TST.bed.gz')) as bed:
+        assert RsidIndex.build(bed_snps(bed), path) == 18
+    rsid_index = RsidIndex(path)
+    assert rsid_index.lookup(['rs10905307', 'rs3768324', 'rs1', 'chr1:1-2']) == {
+        'rs10905307': ('chr10', 5894499, 5894500),
+        'rs3768324': ('chr1', 39492461, 39492462),
+    }
+    atlas = RegulomeAtlas(None, rsid_indices={'hg19': rsid_index}, rsid_fallback=False)
+    assert regulome_search.resolve_rsids(['rs3768324', 'rs1'], 'GRCh37', atlas) == {
+        'rs3768324': ('chr1', 39492461, 39492462),
+        'rs1': ('', '', ''),
+    }
+
+
+def test_score_store(tmpdir):
+    from encoded.regulome_atlas import ScoreStore
+
+    path = str(tmpdir)
+    score = {'probability': '0.12345', 'ranking': '2b'}
+    evidence = {'ChIP': [], 'DNase': [], 'PWM': [], 'Footprint': [],
+                'IC_max': 0.1, 'IC_matched_max': 0.3}
+    rows = [
+        ScoreStore.encode(300, {'probability': '0.9', 'ranking': '7'}, {'IC_max': 0.0}),
+        ScoreStore.encode(100, score, evidence),
+        ScoreStore.encode(100, {'probability': '0.1', 'ranking': '1a'}, {}),
+        ScoreStore.encode(500, None, None),
+    ]
+    assert ScoreStore.write_chrom(path, 'chr1', rows) == 3
+    generation = [(1, 'yesterday')]
+    ScoreStore.write_meta(path, ['chr1'], generation[0])
+    store = ScoreStore(path, generation=lambda: generation[0], check_interval=0)
+    assert store.current()
+    (stored_score, features) = store.lookup([('chr1', 100, 101)])[0]
+    assert stored_score == score
+    assert features == {
+        'ChIP': True, 'DNase': True, 'PWM': True, 'Footprint': True, 'QTL': False,
+        'PWM_matched': False, 'Footprint_matched': False, 'IC_max': 0.1, 'IC_matched_max': 0.3,
+    }
+    assert store.lookup([('chr1', 500, 501), ('chr1', 200, 201), ('chr1', 100, 102),
+                         ('chr2', 100, 101)]) == [({}, {}), None, None, None]
+    generation[0] = (2, 'today')
+    assert not store.current()
+
+
+def test_scored_snps_without_peaks(monkeypatch):
+    from encoded.commands.generate_scored_snps import store_rows
+    from encoded.regulome_atlas import RegulomeAtlas, ScoreStore
+
+    atlas = RegulomeAtlas(None)
+    snps = [
+        {'rsid': 'rs%d' % n, 'chrom': 'chr1', 'coordinates': {'gte': pos, 'lt': pos + 1}}
+        for (n, pos) in enumerate([300, 100, 200])
+    ]
+    monkeypatch.setattr(atlas, 'find_snps', lambda *args, **kwargs: [dict(s) for s in snps])
+    monkeypatch.setattr(atlas, 'find_peaks_filtered', lambda *args, **kwargs: ([], {}))
+    monkeypatch.setattr(atlas, '_chunks', lambda index, doc_type, start, end: [(start, end)])
+    scored = list(atlas._scored_snps('hg19', 'chr1', 0, 1000))
+    assert [snp['rsid'] for snp in scored] == ['rs1', 'rs2', 'rs0']
+    assert all(snp['score'] is None for snp in scored)
+    # every SNP of a chunk without evidence is stored as known to have no score
+    assert list(store_rows(atlas, 'hg19', 'chr1', 0, 1000)) == [
+        ScoreStore.encode(pos, None, None) for pos in (100, 200, 300)
+    ]
+
+
+def test_scored_snps_shards(monkeypatch, tmpdir):
+    import gzip
+    import struct
+    from encoded.commands import generate_scored_snps
+    from encoded.commands.generate_scored_snps import (
+        BGZF_EOF, bed_header, merge_shards, shards, write_shard
+    )
+    from encoded.regulome_atlas import RegulomeAtlas
+    from encoded.regulome_indexer import REGULOME_ATLAS
+
+    atlas = RegulomeAtlas(None)
+    snps = {
+        'chr1': [(95, 96), (98, 102), (100, 101), (150, 151), (199, 203), (250, 251)],
+        'chr2': [(10, 11), (60, 61)],
+    }
+
+    def find_snps(assembly, chrom, start, end, **kwargs):
+        return [
+            {'rsid': 'rs%d' % gte, 'chrom': chrom, 'coordinates': {'gte': gte, 'lt': lt}}
+            for (gte, lt) in snps[chrom] if gte < end and lt > start
+        ]
+
+    monkeypatch.setattr(atlas, 'find_snps', find_snps)
+    monkeypatch.setattr(atlas, 'find_peaks_filtered', lambda *args, **kwargs: ([], {}))
+    monkeypatch.setattr(atlas, '_chunks', lambda index, doc_type, start, end: [
+        (chunk_start, min(chunk_start + 25, end)) for chunk_start in range(start, end, 25)
+    ])
+    # SNPs spanning chunks are yielded once, by the chunk they start in
+    assert [snp['rsid'] for snp in atlas.iter_scored_snps('hg19', 'chr1', 0, 300)] == [
+        'rs95', 'rs98', 'rs100', 'rs150', 'rs199', 'rs250'
+    ]
+    # but those spanning the start of the region are kept
+    assert [snp['rsid'] for snp in atlas.iter_scored_snps('hg19', 'chr1', 99, 160)] == [
+        'rs98', 'rs100', 'rs150'
+    ]
+
+    monkeypatch.setitem(generate_scored_snps.CHROM_SIZES, 'hg19', {'chr1': 300, 'chr2': 120})
+    monkeypatch.setattr(generate_scored_snps, 'BGZF_BLOCK_SIZE', 64)
+    monkeypatch.setattr(generate_scored_snps, 'WORKER_APP', type('App', (object,), {
+        'registry': {REGULOME_ATLAS: atlas}
+    }))
+    assembly_shards = shards('hg19', ['chr1', 'chr2'], shard_size=100)
+    assert [shard[1:] for shard in assembly_shards] == [
+        ('chr1', 0, 100), ('chr1', 100, 200), ('chr1', 200, 300), ('chr2', 0, 100),
+        ('chr2', 100, 120),
+    ]
+    shard_dir = str(tmpdir.mkdir('shards'))
+    # Shards are written out of order, as a pool of workers may
+    counts = {
+        shard: write_shard((shard_dir, shard, False)) for shard in reversed(assembly_shards)
+    }
+    assert [counts[shard] for shard in assembly_shards] == [2, 3, 1, 2, 0]
+    bed_file_name = str(tmpdir.join('regulome_SNPs_hg19.bed.gz'))
+    merge_shards(bed_file_name, bed_header(), shard_dir, assembly_shards)
+
+    with gzip.open(bed_file_name, 'rt') as bed_file:
+        lines = bed_file.read().splitlines()
+    assert lines[0] + '\n' == bed_header()
+    assert [tuple(line.split('\t')[:4]) for line in lines[1:]] == [
+        ('chr1', '95', '96', 'rs95'), ('chr1', '98', '102', 'rs98'),
+        ('chr1', '100', '101', 'rs100'), ('chr1', '150', '151', 'rs150'),
+        ('chr1', '199', '203', 'rs199'), ('chr1', '250', '251', 'rs250'),
+        ('chr2', '10', '11', 'rs10'), ('chr2', '60', '61', 'rs60'),
+    ]
+    # Every bgzip block records its own size, and the file ends with the empty block
+    with open(bed_file_name, 'rb') as bed_file:
+        data = bed_file.read()
+    offset = 0
+    blocks = 0
+    while offset < len(data):
+        assert data[offset:offset + 4] == bytes([31, 139, 8, 4])
+        assert data[offset + 12:offset + 14] == b'BC'
+        offset += struct.unpack('<H', data[offset + 16:offset + 18])[0] + 1
+        blocks += 1
+    assert offset == len(data)
+    assert blocks > 2
+    assert data.endswith(BGZF_EOF)
+
+
+def test_score_chunks(monkeypatch):
+    from encoded import regulome_atlas
+    from encoded.regulome_atlas import RegulomeAtlas
+
+    monkeypatch.setattr(regulome_atlas, 'REGDB_SCORE_CHUNK_SIZE', 500)
+    monkeypatch.setattr(regulome_atlas, 'REGDB_SCORE_CHUNK_MAX_HITS', 10)
+    atlas = RegulomeAtlas(None)
+    density = [(0, 1000, 0), (1000, 2000, 20), (2000, 3000, None), (3000, 3500, 5)]
+    monkeypatch.setattr(atlas, 'density', lambda index, doc_type, start, end: density)
+    assert list(atlas._chunks('snp_hg19', 'chr1', 0, 3500)) == [
+        (1000, 1500), (1500, 2000), (2000, 2500), (2500, 3000), (3000, 3500),
+    ]
+    assert list(atlas._chunks('snp_hg19', 'chr1', 0, 100)) == [(0, 100)]
@@ -174,6 +174,434 @@ def test_indexer_region_state(dummy_request):
     assert 'files_dropped' in display
 
 
+def test_indexer_region_deletes(dummy_request):
+    from encoded.regulome_indexer import RegionIndexerState
+    INDEX = dummy_request.registry.settings['snovault.elasticsearch.index']
+    es = dummy_request.registry['elasticsearch']
+    state = RegionIndexerState(es, INDEX)
+    state.get_initial_state()
+    state.region_delete_started('file-1', 'node:1')
+    state.region_delete_started('file-2', 'node:2')
+
+    class Tasks(object):
+        def get(self, task_id):
+            return {'completed': task_id == 'node:1', 'response': {'deleted': 5, 'failures': []}}
+
+    class RegionES(object):
+        tasks = Tasks()
+
+    running = state.check_region_deletes(RegionES())
+    assert [delete['uuid'] for delete in running] == ['file-2']
+    assert [delete['task'] for delete in state.display()['region_deletes']] == ['node:2']
+
+
+def test_rebuild_score_stores(monkeypatch):
+    from encoded import regulome_indexer
+
+    class Process(object):
+        def __init__(self, args, start_new_session):
+            self.args = args
+            self.pid = len(started) + 100
+            self.running = True
+            started.append(self)
+
+        def poll(self):
+            return None if self.running else 0
+
+        def wait(self):
+            self.running = False
+
+    started = []
+    killed = []
+    monkeypatch.setattr(regulome_indexer.subprocess, 'Popen', Process)
+    monkeypatch.setattr(regulome_indexer.os, 'killpg', lambda pid, sig: killed.append(pid))
+    monkeypatch.setattr(regulome_indexer, 'SCORE_STORE_REBUILDS', {})
+    settings = {
+        '__file__': 'production.ini',
+        'regulome.score_store.hg19': '/srv/scores/hg19/',
+        'regulome.score_store.GRCh38': '/srv/scores/grch38',
+    }
+    assert regulome_indexer.rebuild_score_stores(settings) == []
+    settings['regulome.score_store.rebuild'] = 'true'
+    assert regulome_indexer.rebuild_score_stores(settings) == ['hg19']
+    assert started[0].args[-7:] == [
+        'production.ini', '--store', '/srv/scores', '--assembly', 'hg19', '--processes', '1'
+    ]
+    # the next cycle stops a rebuild still running
+    assert regulome_indexer.rebuild_score_stores(settings) == ['hg19']
+    assert killed == [started[0].pid]
+    started[1].running = False
+    assert regulome_indexer.rebuild_score_stores(settings) == ['hg19']
+    assert killed == [started[0].pid]
+
+
+@pytest.mark.parametrize("filename,collection_type", [
+    ('ENCFF001UYL.bed.gz', 'ChIP-seq'),
+    ('ENCFF122TST.bed.gz', 'eQTLs'),
+    ('ENCFF284TST.bed.gz', 'PWMs'),
+    ('ENCFF542TST.bed.gz', None),
+    ('ENCFF852TST.bed.gz', 'Footprints'),
+    ('ENCFF943TST.bed.gz', 'chromatin state'),
+])
+def test_region_parsers_agree(filename, collection_type):
+    from pkg_resources import resource_filename
+    from encoded.commands.benchmark_region_parser import bytes_parse, csv_parse
+    path = resource_filename('encoded', 'tests/data/files/' + filename)
+    snps = collection_type is None
+    docs = bytes_parse(path, collection_type, snps)
+    assert docs
+    assert docs == csv_parse(path, collection_type, snps)
+
+
+def test_region_row_blocks_resume():
+    import gzip
+    from pkg_resources import resource_filename
+    from encoded.regulome_indexer import RemoteReader
+    path = resource_filename('encoded', 'tests/data/files/ENCFF002CSK.bed.gz')
+    with gzip.open(path, mode='rb') as file_handle:
+        blocks = list(RemoteReader.row_blocks(file_handle, block_size=4096))
+    assert len(blocks) > 2
+    (offset, _rows) = blocks[1]
+    with gzip.open(path, mode='rb') as file_handle:
+        resumed = list(RemoteReader.row_blocks(file_handle, block_size=4096, start=offset))
+    assert [row for (_offset, rows) in resumed for row in rows] == \
+        [row for (_offset, rows) in blocks[2:] for row in rows]
+
+
+class StubConnectionPool(object):
+    def __init__(self):
+        self.released = []
+
+    def _put_conn(self, connection):
+        self.released.append(connection)
+
+
+class StubConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def stub_streaming_response(body, status=200):
+    import io
+    from urllib3.response import HTTPResponse
+    pool = StubConnectionPool()
+    connection = StubConnection()
+    response = HTTPResponse(body=io.BytesIO(body), status=status, preload_content=False,
+                            connection=connection, pool=pool)
+    return (response, connection, pool)
+
+
+def test_remote_reader_streams_response():
+    import gzip
+    from pkg_resources import resource_filename
+    from encoded.regulome_indexer import RemoteReader
+    path = resource_filename('encoded', 'tests/data/files/ENCFF002CSK.bed.gz')
+    with open(path, 'rb') as bed:
+        body = bed.read()
+    with gzip.open(path, mode='rb') as file_handle:
+        expected = list(RemoteReader.rows(file_handle))
+    (response, connection, pool) = stub_streaming_response(body)
+
+    class StubPoolManager(object):
+        def request(self, method, url, preload_content=True):
+            assert (method, url, preload_content) == (
+                'GET', 'http://localhost/files/ENCFF002CSK/@@download/ENCFF002CSK.bed.gz', False
+            )
+            return response
+
+    request = type('Request', (object,), {})()
+    request.registry = type('Registry', (object,), {'settings': {}})()
+    request.host_url = 'http://localhost'
+    reader = RemoteReader()
+    reader.http = StubPoolManager()
+    readable_file = reader.readable_file(request, {
+        '@id': '/files/ENCFF002CSK/',
+        'href': '/files/ENCFF002CSK/@@download/ENCFF002CSK.bed.gz',
+    })
+    assert readable_file is response
+    with reader.open_gzip(readable_file) as file_handle:
+        assert list(reader.rows(file_handle, block_size=4096)) == expected
+    # fully read: the connection goes back to the pool as is
+    assert pool.released == [connection]
+    assert not connection.closed
+
+
+def test_remote_reader_releases_connection_early():
+    import gzip
+    from encoded.regulome_indexer import RemoteReader
+    from urllib3.exceptions import HTTPError
+    body = gzip.compress(b'chr1\t10\t20\n' * 100000)
+    (response, connection, pool) = stub_streaming_response(body)
+    with pytest.raises(ValueError):
+        with RemoteReader.open_gzip(response) as file_handle:
+            for (_offset, _rows) in RemoteReader.row_blocks(file_handle, block_size=4096):
+                raise ValueError('stop after the first block')
+    # half read: the connection is closed rather than reused, and still released
+    assert connection.closed
+    assert pool.released == [connection]
+
+    (response, connection, pool) = stub_streaming_response(b'', status=404)
+
+    class StubPoolManager(object):
+        def request(self, method, url, preload_content=True):
+            return response
+
+    request = type('Request', (object,), {})()
+    request.registry = type('Registry', (object,), {'settings': {}})()
+    request.host_url = 'http://localhost'
+    reader = RemoteReader()
+    reader.http = StubPoolManager()
+    with pytest.raises(HTTPError):
+        reader.readable_file(request, {'@id': '/files/ENCFF000MIS/', 'href': '/files/missing'})
+    assert pool.released == [connection]
+
+
+class StubRegionState(object):
+    def __init__(self):
+        self.added = []
+        self.checkpoints = {}
+        self.deletes = {}  # uuid: times a delete of its regions is still seen running
+
+    def check_region_deletes(self, region_es):
+        running = [{'uuid': uuid} for (uuid, polls) in self.deletes.items() if polls > 0]
+        for delete in running:
+            self.deletes[delete['uuid']] -= 1
+        return running
+
+    def wait_for_region_delete(self, region_es, uuid, timeout=None):
+        from encoded.regulome_indexer import RegionIndexerState
+        return RegionIndexerState.wait_for_region_delete(self, region_es, uuid, timeout)
+
+    def file_added(self, uuid):
+        self.added.append(uuid)
+
+    def get_checkpoint(self, uuid):
+        return self.checkpoints.get(uuid)
+
+    def put_checkpoint(self, uuid, checkpoint):
+        self.checkpoints[uuid] = dict(checkpoint)
+
+    def clear_checkpoint(self, uuid):
+        self.checkpoints.pop(uuid, None)
+
+
+class StubRegionES(object):
+    '''Region search es accepting bulk requests, except for the uuids in fail_uuids'''
+
+    class Indices(object):
+        def exists(self, index):
+            return True
+
+        def exists_type(self, index, doc_type):
+            return True
+
+        def flush_synced(self, index):
+            pass
+
+    def __init__(self, fail_uuids=(), fail_after=None):
+        from elasticsearch.serializer import JSONSerializer
+        self.fail_uuids = set(fail_uuids)
+        self.fail_after = fail_after  # number of bulk requests accepted before failing
+        self.indices = self.Indices()
+        self.transport = type('Transport', (object,), {'serializer': JSONSerializer()})()
+        self.docs = []
+
+    def bulk(self, body, **kwargs):
+        import json
+        lines = [json.loads(line) for line in body.splitlines()]
+        docs = lines[1::2]
+        if any(doc.get('uuid') in self.fail_uuids for doc in docs):
+            raise ConnectionError('bulk request failed')
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise ConnectionError('bulk request failed')
+            self.fail_after -= 1
+        self.docs.extend(docs)
+        return {'items': [{'index': {'status': 201}} for _doc in docs]}
+
+
+def stub_region_indexer(monkeypatch, region_es, file_workers, fail_reading=()):
+    '''A RegionIndexer indexing datasets {uuid: [file uuid, ...]} of 5 regions per file'''
+    from encoded import regulome_indexer
+    from encoded.regulome_indexer import RegionIndexer
+
+    monkeypatch.setattr(regulome_indexer, 'REGION_BULK_CHUNK_SIZE', 2)
+    monkeypatch.setattr(regulome_indexer, 'REGION_INDEXER_QUEUE_SIZE', 1)
+    indexer = RegionIndexer.__new__(RegionIndexer)
+    indexer.regions_es = region_es
+    indexer.state = StubRegionState()
+    indexer.file_workers = file_workers
+    indexer.residents = []
+
+    def candidate_files(request, dataset_uuid):
+        return ({'accession': dataset_uuid}, [
+            {'uuid': uuid, 'href': '/files/%s/@@download' % uuid}
+            for uuid in request.datasets[dataset_uuid]
+        ], None)
+
+    def file_actions(request, afile, file_doc, checkpoint=None):
+        for n in range(5):
+            if afile['uuid'] in fail_reading and n == 3:
+                raise IOError('Error parsing file %s' % afile['href'])
+            yield ('chr1', {'_index': 'chr1', '_type': 'hg19', '_id': '%s-%d' % (afile['uuid'], n),
+                            '_source': {'uuid': afile['uuid']}})
+
+    indexer.candidate_files = candidate_files
+    indexer.file_actions = file_actions
+    indexer.metadata_doc = lambda afile, dataset: {
+        'uuid': afile['uuid'], 'file': {'assembly': 'hg19'}, 'chroms': [],
+    }
+    indexer.in_regions_es = lambda uuid: False
+    indexer.add_to_residence = lambda file_doc: indexer.residents.append(file_doc['uuid'])
+    return indexer
+
+
+@pytest.mark.parametrize("file_workers", [1, 3])
+def test_region_indexer_update_objects(monkeypatch, file_workers):
+    import threading
+    request = type('Request', (object,), {})()
+    request.datasets = {'d1': ['f1', 'f2'], 'd2': ['f3'], 'd3': ['f4'], 'd4': ['f5']}
+    region_es = StubRegionES(fail_uuids=['f4'])
+    indexer = stub_region_indexer(monkeypatch, region_es, file_workers, fail_reading=['f3'])
+    result = {}
+    update = threading.Thread(target=lambda: result.setdefault(
+        'errors', indexer.update_objects(request, list(request.datasets), False)
+    ))
+    update.start()
+    update.join(timeout=30)
+    assert not update.is_alive()
+    # A file failing to read (f3) or to index (f4) is reported against its dataset alone
+    assert sorted(error['uuid'] for error in result['errors']) == ['d2', 'd3']
+    assert 'Error parsing file' in [e for e in result['errors'] if e['uuid'] == 'd2'][0][
+        'error_message']
+    assert sorted(indexer.state.added) == ['f1', 'f2', 'f5']
+    assert sorted(indexer.residents) == ['f1', 'f2', 'f5']
+    indexed = [doc['uuid'] for doc in region_es.docs]
+    assert all(indexed.count(uuid) == 5 for uuid in ['f1', 'f2', 'f5'])
+    assert 'f4' not in indexed
+
+
+@pytest.mark.parametrize("file_workers", [1, 3])
+def test_region_indexer_skips_rest_of_dataset(monkeypatch, file_workers):
+    request = type('Request', (object,), {})()
+    request.datasets = {'d1': ['f1', 'f2', 'f3'], 'd2': ['f4', 'f5', 'f6'], 'd3': ['f7']}
+    region_es = StubRegionES(fail_uuids=['f5'])
+    indexer = stub_region_indexer(monkeypatch, region_es, file_workers, fail_reading=['f1'])
+    errors = indexer.update_objects(request, list(request.datasets), False)
+    assert sorted(error['uuid'] for error in errors) == ['d1', 'd2']
+    # files after the failing one of a dataset are neither read nor added
+    assert sorted(indexer.state.added) == ['f4', 'f7']
+    indexed = set(doc['uuid'] for doc in region_es.docs)
+    assert not indexed & {'f2', 'f3', 'f5', 'f6'}
+
+
+@pytest.mark.parametrize("file_workers", [1, 3])
+def test_region_indexer_waits_for_region_deletes(monkeypatch, file_workers):
+    from encoded import regulome_indexer
+    monkeypatch.setattr(regulome_indexer, 'REGION_DELETE_POLL_INTERVAL', 0)
+    monkeypatch.setattr(regulome_indexer, 'REGION_DELETE_WAIT', 60)
+    request = type('Request', (object,), {})()
+    request.datasets = {'d1': ['f1'], 'd2': ['f2']}
+    region_es = StubRegionES()
+    indexer = stub_region_indexer(monkeypatch, region_es, file_workers)
+    indexer.state.deletes = {'f1': 3}
+    bulk = region_es.bulk
+    early = []
+
+    def bulk_after_deletes(body, **kwargs):
+        early.extend(uuid for (uuid, polls) in indexer.state.deletes.items() if polls > 0)
+        return bulk(body, **kwargs)
+
+    region_es.bulk = bulk_after_deletes
+    assert indexer.update_objects(request, list(request.datasets), True) == []
+    assert sorted(indexer.state.added) == ['f1', 'f2']
+    assert 'f1' not in early  # re-added only once the running delete of f1 finished
+
+    # A delete running past REGION_DELETE_WAIT fails its dataset until the next cycle
+    monkeypatch.setattr(regulome_indexer, 'REGION_DELETE_WAIT', 0)
+    region_es = StubRegionES()
+    indexer = stub_region_indexer(monkeypatch, region_es, file_workers)
+    indexer.state.deletes = {'f1': 1000}
+    errors = indexer.update_objects(request, list(request.datasets), True)
+    assert [error['uuid'] for error in errors] == ['d1']
+    assert 'still being deleted' in errors[0]['error_message']
+    assert indexer.state.added == ['f2']
+    assert 'f1' not in set(doc['uuid'] for doc in region_es.docs)
+
+
+def test_region_indexer_update_objects_consumer_failure(monkeypatch):
+    import threading
+    request = type('Request', (object,), {})()
+    request.datasets = {'d%d' % n: ['f%d' % n] for n in range(6)}
+    indexer = stub_region_indexer(monkeypatch, StubRegionES(), 3)
+
+    def file_added(uuid):
+        raise RuntimeError('indexer state unavailable')
+
+    indexer.state.file_added = file_added
+    result = {}
+
+    def update():
+        try:
+            indexer.update_objects(request, list(request.datasets), False)
+        except RuntimeError as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=update)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()  # workers blocked on the full queue were released
+    assert str(result['error']) == 'indexer state unavailable'
+
+
+def test_region_indexer_resumes_snp_file(monkeypatch):
+    from encoded import regulome_indexer
+    from encoded.regulome_indexer import RegionIndexer, RemoteReader
+
+    monkeypatch.setattr(regulome_indexer, 'REGION_BULK_CHUNK_SIZE', 2)
+    monkeypatch.setattr(regulome_indexer, 'SNP_CHECKPOINT_ROWS', 1)
+    request = type('Request', (object,), {})()
+    request.registry = type('Registry', (object,), {'settings': {'testing': True}})()
+    afile = {'href': '/files/ENCFF542TST/@@download/ENCFF542TST.bed.gz', 'file_format': 'bed'}
+    reader = RemoteReader()
+    # a few rows per block, so the file is checkpointed many times
+    reader.row_blocks = lambda file_handle, start=0: RemoteReader.row_blocks(
+        file_handle, block_size=700, start=start
+    )
+
+    def run(region_es, state):
+        indexer = RegionIndexer.__new__(RegionIndexer)
+        indexer.regions_es = region_es
+        indexer.state = state
+        indexer.reader = reader
+        indexer.add_to_residence = lambda file_doc: True
+        file_doc = {'uuid': 'snp-file', 'file': {'assembly': 'hg19'}, 'snps': True}
+        return indexer.add_file_to_regions_es(request, afile, file_doc)
+
+    everything = StubRegionES()
+    assert run(everything, StubRegionState())
+    rsids = [doc['rsid'] for doc in everything.docs]
+    assert len(rsids) == 18
+
+    # Indexing stops when the third bulk request fails, after two were acknowledged
+    state = StubRegionState()
+    interrupted = StubRegionES(fail_after=2)
+    with pytest.raises(ConnectionError):
+        run(interrupted, state)
+    checkpoint = state.get_checkpoint('snp-file')
+    assert 0 < checkpoint['rows'] <= len(interrupted.docs) == 4
+    assert checkpoint['index'] == 'snp_hg19'
+    assert checkpoint['chroms']
+
+    resumed = StubRegionES()
+    assert run(resumed, state)
+    # rows before the checkpoint are not sent again, nothing after it is skipped
+    assert [doc['rsid'] for doc in resumed.docs] == rsids[checkpoint['rows']:]
+    assert state.get_checkpoint('snp-file') is None
+
+
 def test_listening(testapp, listening_conn):
     import time
     testapp.post_json('/testing-post-put-patch/', {'required': ''})